@@ -1,6 +1,29 @@
+import startup  # First: with SOSISKA_STARTUP set it times the imports below
+
+import os
 import tkinter as tk
-from tkinter import filedialog, messagebox, simpledialog
-from PIL import Image, ImageTk, ImageFilter, ImageDraw
+from tkinter import colorchooser, filedialog, messagebox, simpledialog
+from PIL import ImageTk
+
+import autocrop
+import diskcache
+import encoding
+import keying
+import layers
+import overlap
+import perf
+from export import Exporter, export_collage, export_layers
+from history import History
+from layers import Layer, LayerStack
+from loader import ImageLoader, open_full
+from scene import CanvasScene
+from scaling import ScaledImageCache
+from snapping import ContentCache, SnapIndex
+from spool import FrameSpool
+from thumbnails import MemoryWindow, ThumbnailCache
+
+# Imported on first use, the window shows up without them: outline and chatlog
+# (ImageFilter, ImageDraw, fonts), session (zipfile), watcher (batch, multiprocessing, ctypes)
 
 class ImageProcessor:
     def __init__(self, master):
@@ -9,25 +32,83 @@ class ImageProcessor:
 
         self.canvas_width = 650
         self.canvas_height = 650
-        self.memory_limit = 5
-        self.memory = []
+        self.memory_limit = None  # None - без ограничения
+        self.memory = []  # Frames are spooled to disk, the list holds handles
+        self.memory_spool = FrameSpool()
 
         # Guide lines settings
         self.guide_line_offset = 10
         self.guide_lines_visible = True
         self.magnetic = False
+        self.snap_distance = 10
+        self.user_guides_x = []  # Added with "v" key
+        self.user_guides_y = []  # Added with "h" key
+        self.previous_baselines = []  # Text baselines of the last frame saved to memory
+        self.snap_index = SnapIndex()
+
+        # Chat content bbox/baselines and outlines, recomputed only when the image changes.
+        # chat_revision is bumped on in-place edits, new images are told apart by identity
+        self.chat_revision = 0
+        self.chat_content = ContentCache()
+        self.outline_cache = None  # outline.OutlineCache, made on the first outline
+
+        # Chat blocks pinned to the canvas (layers.Layer), under the chat being edited
+        self.pinned = []
+        self.pinned_photos = {}  # id(layer) -> (layer, PhotoImage)
+        self.chat_opacity = 1.0
+        self.opacity_job = None
+        # Flattened canvas for memory frames, redrawn only where layers changed; saving
+        # composites on the export thread in a stack of its own
+        self.layer_stack = LayerStack((self.canvas_width, self.canvas_height))
+        self.export_stack = LayerStack((self.canvas_width, self.canvas_height))
+
+        # Keyed/cropped/outlined chats on disk between runs (see diskcache.py).
+        # chat_source says how the current chat was made, None after edits that can't be repeated
+        self.chat_cache = diskcache.DiskCache()
+        self.chat_source = None
 
         # Chat state flags
         self.chat_cropped = False
         self.chat_outlined = False
         self.magnetic_override = False  # Manual magnetic control
 
-        # Undo/Redo history
-        self.history = []
-        self.history_index = -1
+        # Black background keying settings
+        self.key_threshold = 50
+        self.key_softness = 0  # 0 - hard cut, >0 - width of the soft alpha ramp
+
+        # Outline settings
+        self.outline_radius = 1
+        self.outline_color = "#000000"
+        self.outline_softness = 0
+
+        # Lines taken from the end of chatlog.txt (the game shows 10 by default)
+        self.chatlog_lines = 10
+
+        # Timing overlay (see perf.py)
+        self.perf_overlay_job = None
+
+        # Undo/Redo history (images are shared by reference, size limited in bytes)
+        self.history = History(budget=256 * 1024 * 1024)
+
+        # Background decoding of loaded files
+        self.loader = ImageLoader(master)
+
+        # Saving runs in the background too, options are shared by all exports (see encoding.py)
+        self.exporter = Exporter(master)
+        self.export_options = encoding.export_options()
+        self.export_extension = ".png"  # Last used, offered first next time
+        self.session_path = None
+
+        # Memory thumbnails and collage preview (see thumbnails.py), while the memory window is open
+        self.thumbnails = None
+        self.memory_window = None
+
+        # Screenshot folder watched for new captures (see watcher.py), None when off
+        self.ingest = None
 
         # UI elements initialization
         self.setup_ui()
+        master.protocol("WM_DELETE_WINDOW", self.on_close)
 
     def setup_ui(self):
         # Frame for buttons
@@ -40,9 +121,15 @@ class ImageProcessor:
         self.load_chat_button = tk.Button(button_frame, text="Загрузить Чат", command=self.load_chat)
         self.load_chat_button.pack(side=tk.LEFT, padx=5)
 
+        self.auto_crop_button = tk.Button(button_frame, text="Обрезать Авто", command=self.auto_crop_chat)
+        self.auto_crop_button.pack(side=tk.LEFT, padx=5)
+
         self.outline_button = tk.Button(button_frame, text="Добавить Обводку", command=self.add_outline)
         self.outline_button.pack(side=tk.LEFT, padx=5)
 
+        self.pin_chat_button = tk.Button(button_frame, text="Закрепить Чат", command=self.pin_chat)
+        self.pin_chat_button.pack(side=tk.LEFT, padx=5)
+
         self.save_button = tk.Button(button_frame, text="Сохранить", command=self.save_image)
         self.save_button.pack(side=tk.LEFT, padx=5)
 
@@ -52,6 +139,24 @@ class ImageProcessor:
         self.process_memory_button = tk.Button(button_frame, text="Склеить и Сохранить", command=self.process_memory)
         self.process_memory_button.pack(side=tk.LEFT, padx=5)
 
+        self.show_memory_button = tk.Button(button_frame, text="Просмотр Памяти", command=self.show_memory)
+        self.show_memory_button.pack(side=tk.LEFT, padx=5)
+
+        self.save_session_button = tk.Button(button_frame, text="Сохранить Сессию", command=self.save_session)
+        self.save_session_button.pack(side=tk.LEFT, padx=5)
+
+        self.open_session_button = tk.Button(button_frame, text="Открыть Сессию", command=self.open_session)
+        self.open_session_button.pack(side=tk.LEFT, padx=5)
+
+        self.watch_button = tk.Button(button_frame, text="Следить за Папкой", command=self.toggle_watch)
+        self.watch_button.pack(side=tk.LEFT, padx=5)
+
+        self.outline_settings_button = tk.Button(button_frame, text="Настройки Обводки", command=self.change_outline_settings)
+        self.outline_settings_button.pack(side=tk.LEFT, padx=5)
+
+        self.export_settings_button = tk.Button(button_frame, text="Настройки Экспорта", command=self.change_export_settings)
+        self.export_settings_button.pack(side=tk.LEFT, padx=5)
+
         self.change_canvas_size_button = tk.Button(button_frame, text="Изменить Размер Холста", command=self.change_canvas_size)
         self.change_canvas_size_button.pack(side=tk.LEFT, padx=5)
 
@@ -66,6 +171,10 @@ class ImageProcessor:
         self.scale = tk.Scale(button_frame, variable=self.scale_var, orient=tk.HORIZONTAL, from_=0.1, to=5.0, resolution=0.1, label="Масштаб", command=self.rescale_background)
         self.scale.pack(side=tk.LEFT, padx=5)
 
+        self.opacity_var = tk.DoubleVar(value=1.0)
+        self.opacity_scale = tk.Scale(button_frame, variable=self.opacity_var, orient=tk.HORIZONTAL, from_=0.1, to=1.0, resolution=0.05, label="Непрозрачность", command=self.change_chat_opacity)
+        self.opacity_scale.pack(side=tk.LEFT, padx=5)
+
         # Canvas setup
         self.canvas = tk.Canvas(self.master, width=self.canvas_width, height=self.canvas_height, bg="white")
         self.canvas.pack()
@@ -87,23 +196,34 @@ class ImageProcessor:
 
         # Bindings for deletion tool
         self.canvas.bind("s", self.start_delete_selection)
+
+        # Bindings for user guides
+        self.canvas.bind("v", self.add_vertical_guide)
+        self.canvas.bind("h", self.add_horizontal_guide)
+        self.canvas.bind("c", self.clear_user_guides)
+
+        # Timing overlay and statistics export, only with SOSISKA_PERF=1
+        if perf.ENABLED:
+            self.canvas.bind("p", self.toggle_perf_overlay)
+            self.canvas.bind("P", self.save_perf_stats)
         self.canvas.bind("<Control-z>", self.undo)
         self.canvas.bind("<Control-y>", self.redo)
 
         # Image data
         self.bg_image = None
-        self.bg_image_tk = None
+        self.bg_view = None  # (scaler, scale, final quality) shown on the canvas in tiles
+        self.bg_scaler = None  # Scaled rendering of bg_image
+        self.bg_scale = 1.0  # Last settled slider value (kept in history)
+        self.rescale_job = None
         self.bg_x = 0
         self.bg_y = 0
         self.moving_bg = False
-        self.bg_rect_id = None # Id of the rectangle around bg image
 
         self.chat_image = None
         self.chat_image_tk = None
         self.chat_x = 0  # Start at top-left corner
         self.chat_y = 0  # Start at top-left corner
         self.moving_chat = False
-        self.chat_rect_id = None # Id of the rectangle around chat image
 
         # Selection tool data
         self.rect_start_x = None
@@ -117,15 +237,19 @@ class ImageProcessor:
         self.delete_rect_id = None
         self.delete_coords = None
 
-        # Canvas outline
-        self.canvas.create_rectangle(0, 0, self.canvas_width, self.canvas_height, outline="black")
+        # Retained canvas items (canvas outline, images, frames, guide lines)
+        self.scene = CanvasScene(self.canvas, self.canvas_width, self.canvas_height)
 
         # Memory images indicator
-        self.memory_indicator = tk.Label(self.master, text=f"В памяти: {len(self.memory)}/{self.memory_limit}")
+        self.memory_indicator = tk.Label(self.master, text=self.memory_text())
         self.memory_indicator.pack()
 
-        # Add tooltips
-        self.add_tooltips()
+        # Export progress
+        self.export_status = tk.Label(self.master, text="")
+        self.export_status.pack()
+
+        # Tooltips are bound once the window is up
+        self.master.after_idle(self.add_tooltips)
 
         self.update_magnetic_button_state() # Initial magnetic button state
 
@@ -133,10 +257,18 @@ class ImageProcessor:
         tooltips = {
             self.load_bg_button: "Загружает фоновое изображение",
             self.load_chat_button: "Загружает изображение чата",
+            self.auto_crop_button: "Сам находит чат на скриншоте и обрезает его",
             self.outline_button: "Добавляет обводку к изображению чата",
+            self.pin_chat_button: "Оставляет чат на холсте отдельным слоем, можно загрузить следующий блок",
             self.save_button: "Сохраняет изображение",
             self.memory_button: "Сохраняет текущий вид холста в память",
             self.process_memory_button: "Склеивает все изображения из памяти и сохраняет",
+            self.show_memory_button: "Миниатюры кадров из памяти и склейка до сохранения, кадры можно перетаскивать",
+            self.save_session_button: "Сохраняет фон, чат, позиции и память в файл сессии",
+            self.open_session_button: "Открывает сохранённую сессию и продолжает работу",
+            self.watch_button: "Новые скриншоты из папки сами обрабатываются и попадают в память",
+            self.outline_settings_button: "Толщина, цвет и мягкость обводки",
+            self.export_settings_button: "Качество и сжатие PNG, JPEG и WebP",
             self.change_canvas_size_button: "Изменяет размер холста",
             self.toggle_guide_lines_button: "Показывает или скрывает направляющие",
             self.toggle_magnetic_button: "Включает или выключает примагничивание",
@@ -165,68 +297,126 @@ class ImageProcessor:
         filename = filedialog.askopenfilename(initialdir=".", title="Выберите фоновое изображение",
                                               filetypes=(("Изображения", "*.png;*.jpg;*.jpeg"), ("Все файлы", "*.*")))
         if filename:
-            self.bg_image = Image.open(filename)
-            self.bg_image_tk = ImageTk.PhotoImage(self.bg_image)
-            self.rescale_background(self.scale_var.get())  # Изначальное масштабирование
-            self.draw_images()
-            self.save_state()
+            # Decoding and mode conversion happen in the loader thread, the preview pyramid
+            # is built when a preview first needs it
+            self.loader.load("bg", filename, self.on_background_loaded, on_preview=self.on_background_preview,
+                             on_error=self.on_load_error, process=self.prepare_background)
+
+    def prepare_background(self, image):
+        # Loader thread
+        return image, ScaledImageCache(image)
+
+    def on_background_preview(self, preview, full_size):
+        # Reduced JPEG decode, stretched to the final size until the full image is ready
+        self.bg_view = (ScaledImageCache(preview, base_size=full_size), self.scale_var.get(), False)
+        self.draw_images()
+
+    def on_background_loaded(self, result):
+        self.bg_image, self.bg_scaler = result
+        self.bg_scale = self.scale_var.get()
+        self.show_background(self.bg_scale)  # Изначальное масштабирование
+        self.save_state()
+
+    def on_load_error(self, error):
+        messagebox.showerror("Ошибка", f"Не удалось открыть изображение: {error}")
 
     def load_chat(self):
         filename = filedialog.askopenfilename(initialdir=".", title="Выберите изображение чата",
-                                              filetypes=(("Изображения", "*.png;*.jpg;*.jpeg"), ("Все файлы", "*.*")))
-        if filename:
-            self.chat_image = Image.open(filename)
-            self.remove_black_background()
-            self.chat_x = 0 # Resetting coordinates for chat image
-            self.chat_y = 0 # Resetting coordinates for chat image
-            self.draw_chat()
-            self.save_state()
-
-    def remove_black_background(self, threshold=50):
-        if self.chat_image:
-            img = self.chat_image.convert("RGBA")
-            data = img.getdata()
-            new_data = []
-            for item in data:
-                if item[0] < threshold and item[1] < threshold and item[2] < threshold:
-                    new_data.append((0, 0, 0, 0))
-                else:
-                    new_data.append(item)
-            img.putdata(new_data)
-            self.chat_image = img
-            # Force rasterization of chat image
-            self.chat_image = self.chat_image.copy()
+                                              filetypes=(("Изображения", "*.png;*.jpg;*.jpeg"), ("Чатлог SA-MP", "*.txt"), ("Все файлы", "*.*")))
+        if filename and filename.lower().endswith(".txt"):
+            self.load_chatlog(filename)
+        elif filename:
+            # Keying runs in the loader thread too, or is taken from the disk cache
+            threshold, softness = self.key_threshold, self.key_softness
+            self.loader.load("chat", filename, self.on_screenshot_loaded, on_error=self.on_load_error,
+                             opener=lambda path: self.open_chat(path, threshold, softness))
+
+    def open_chat(self, path, threshold, softness):
+        # Loader thread: (keyed chat, its source)
+        source = diskcache.derive(diskcache.file_source(path), "key", threshold, softness)
+        image = self.chat_cache.cached(source, lambda: keying.remove_black_background(open_full(path), threshold, softness))
+        return image, source
+
+    def load_chatlog(self, filename):
+        # Чат рисуется прямо из chatlog.txt: уже без фона и с обводкой
+        count = simpledialog.askinteger("Чатлог", "Сколько последних строк взять?",
+                                        initialvalue=self.chatlog_lines, minvalue=1)
+        if count is None:
+            return
+        self.chatlog_lines = count
+        radius, color, softness = self.outline_radius, self.outline_color, self.outline_softness
+        self.loader.load("chat", filename, self.on_chatlog_loaded, on_error=self.on_load_error,
+                         opener=lambda path: self.open_chatlog(path, count, radius, color, softness))
+
+    def open_chatlog(self, path, count, radius, color, softness):
+        # Loader thread; an unchanged chatlog.txt comes from the disk cache
+        source = diskcache.derive(diskcache.file_source(path), "chatlog", count, radius, color, softness)
+        import chatlog
+        image = self.chat_cache.cached(source, lambda: chatlog.render_chatlog(path, count, outline_radius=radius,
+                                                                              outline_color=color, outline_softness=softness))
+        return image, source
+
+    def on_chatlog_loaded(self, result):
+        # Nothing to crop or outline, snapping works right away
+        self.chat_cropped = True
+        self.chat_outlined = True
+        self.update_magnetic_state()
+        self.on_chat_loaded(*result)
+
+    def on_screenshot_loaded(self, result):
+        # A new screenshot has to be cropped and outlined again, whatever the last chat was
+        self.chat_cropped = False
+        self.chat_outlined = False
+        self.update_magnetic_state()
+        self.on_chat_loaded(*result)
+
+    def on_chat_loaded(self, image, source=None):
+        self.chat_image = image
+        self.chat_source = source
+        self.chat_x = 0 # Resetting coordinates for chat image
+        self.chat_y = 0 # Resetting coordinates for chat image
+        self.draw_chat()
+        self.save_state()
 
+    @perf.timed("draw_images")
     def draw_images(self):
-        self.canvas.delete("all")
-        self.canvas.create_rectangle(0, 0, self.canvas_width, self.canvas_height, outline="black")  # Redraw outline
-
-        if self.bg_image_tk:
-            self.canvas.create_image(self.bg_x, self.bg_y, anchor=tk.NW, image=self.bg_image_tk)
-            # Draw rectangle around background image
-            if self.bg_image:
-                width, height = self.bg_image.size
-                x1, y1 = self.bg_x, self.bg_y
-                x2, y2 = self.bg_x + width, self.bg_y + height
-                if self.bg_rect_id:
-                    self.canvas.delete(self.bg_rect_id)
-                self.bg_rect_id = self.canvas.create_rectangle(x1, y1, x2, y2, outline="blue")
-
-        if self.chat_image_tk:
-            self.canvas.create_image(self.chat_x, self.chat_y, anchor=tk.NW, image=self.chat_image_tk)
-            # Draw rectangle around chat image
-            if self.chat_image:
-                width, height = self.chat_image.size
-                x1, y1 = self.chat_x, self.chat_y
-                x2, y2 = self.chat_x + width, self.chat_y + height
-                if self.chat_rect_id:
-                    self.canvas.delete(self.chat_rect_id)
-                self.chat_rect_id = self.canvas.create_rectangle(x1, y1, x2, y2, outline="green")
-
-        self.draw_guide_lines()
-
-    def draw_chat(self):
-        self.chat_image_tk = ImageTk.PhotoImage(self.chat_image)
+        # Existing canvas items are only moved/reconfigured, nothing is recreated
+        self.scene.cancel()
+        self.scene.resize(self.canvas_width, self.canvas_height)
+
+        bg = None
+        if self.bg_view:
+            bg = (self.bg_view, self.bg_x, self.bg_y)
+
+        chat = None
+        if self.chat_image_tk and self.chat_image:
+            chat = (self.chat_image_tk, self.chat_x, self.chat_y, self.chat_image.size)
+
+        self.scene.update(bg, chat, self.guide_lines(), self.pinned_views())
+
+    def pinned_views(self):
+        # (photo, x, y, size) of the pinned chats; photos are made once per layer
+        photos = {}
+        for layer in self.pinned:
+            entry = self.pinned_photos.get(id(layer))
+            if entry is None or entry[0] is not layer:
+                entry = (layer, ImageTk.PhotoImage(layers.fade(layer.source, layer.opacity)))
+            photos[id(layer)] = entry
+        self.pinned_photos = photos
+        return [(photos[id(layer)][1], layer.x, layer.y, layer.size) for layer in self.pinned]
+
+    def schedule_redraw(self):
+        # Motion events are coalesced: at most one redraw per idle cycle
+        self.scene.schedule(self.draw_images)
+
+    def draw_chat(self, dirty=None):
+        # dirty: changed box of a same-sized image, only that part of the PhotoImage is updated
+        shown = self.scene.chat.photo
+        if dirty and shown is self.chat_image_tk and self.chat_image_tk and self.chat_opacity >= 1 and \
+                (self.chat_image_tk.width(), self.chat_image_tk.height()) == self.chat_image.size:
+            self.scene.chat.patch(self.chat_image, dirty)
+        else:
+            self.chat_image_tk = ImageTk.PhotoImage(layers.fade(self.chat_image, self.chat_opacity))
         self.draw_images()
 
     def start_move_bg(self, event):
@@ -239,7 +429,7 @@ class ImageProcessor:
         if self.moving_bg:
             self.bg_x = event.x - self.start_x
             self.bg_y = event.y - self.start_y
-            self.draw_images()
+            self.schedule_redraw()
 
     def stop_move_bg(self, event):
         self.moving_bg = False
@@ -249,6 +439,7 @@ class ImageProcessor:
             self.moving_chat = True
             self.start_x = event.x - self.chat_x
             self.start_y = event.y - self.chat_y
+            self.snap_index = self.build_snap_index()
 
     def move_chat(self, event):
         if self.moving_chat:
@@ -256,7 +447,7 @@ class ImageProcessor:
             self.chat_y = event.y - self.start_y
             if self.is_magnetic_enabled():
                 self.apply_magnetic()
-            self.draw_images()
+            self.schedule_redraw()
 
     def stop_move_chat(self, event):
         self.moving_chat = False
@@ -283,12 +474,12 @@ class ImageProcessor:
             old_chat_y = self.chat_y
 
             self.canvas.delete(self.rect_id)
-            self.crop_chat()
+            crop_box = self.crop_chat()
             self.chat_cropped = True # Setting cropped to True
             self.chat_x = old_chat_x
             self.chat_y = old_chat_y
             self.update_magnetic_state()
-            self.save_state()
+            self.save_state(dirty={"chat_image": ("crop", crop_box)} if crop_box else None)
 
     def crop_chat(self):
         if self.chat_image and self.selection_coords:
@@ -308,81 +499,162 @@ class ImageProcessor:
             # Проверяем, что ширина и высота обрезки больше нуля
             if img_x2 - img_x1 > 0 and img_y2 - img_y1 > 0:
                 try:
-                    cropped_chat = self.chat_image.crop((img_x1, img_y1, img_x2, img_y2))
+                    crop_box = (img_x1, img_y1, img_x2, img_y2)
+                    cropped_chat = self.chat_image.crop(crop_box)
                     self.chat_image = cropped_chat
+                    self.chat_source = diskcache.crop_source(self.chat_source, crop_box)
                     self.draw_chat()
+                    return crop_box
                 except Exception as e:
                     messagebox.showerror("Ошибка", f"Ошибка при обрезке: {e}")
             else:
                 messagebox.showinfo("Внимание", "Выделенная область слишком мала для обрезки.")
 
-    def add_outline(self):
+    def auto_crop_chat(self):
         if self.chat_image:
-            img = self.chat_image.convert("RGBA")
-
-            # Create a mask of the text
-            alpha = img.convert('L')
+            found = autocrop.detect_chat(self.chat_image, self.key_threshold)
+            if not found:
+                messagebox.showinfo("Внимание", "Не удалось найти чат на изображении.")
+                return
+
+            # Same path as a manual selection, in canvas coordinates
+            x1, y1, x2, y2 = found["block"]
+            self.selection_coords = (x1 + self.chat_x, y1 + self.chat_y, x2 + self.chat_x, y2 + self.chat_y)
+            crop_box = self.crop_chat()
+            if crop_box:
+                self.chat_cropped = True
+                self.update_magnetic_state()
+                self.save_state(dirty={"chat_image": ("crop", crop_box)})
 
-            # Expand the mask (dilate)
-            blurred = alpha.filter(ImageFilter.MaxFilter(3))  # Adjust the radius as needed
+    def add_outline(self):
+        if self.chat_image:
+            import outline
+            if self.outline_cache is None:
+                self.outline_cache = outline.OutlineCache()
+            # Disk cache and outline run on the loader thread, the same chain batch and the
+            # watcher store their results under
+            image, revision = self.chat_image, self.chat_revision
+            radius, color, softness = self.outline_radius, self.outline_color, self.outline_softness
+            source = diskcache.outline_source(self.chat_source, radius, color, softness)
+            dirty = outline.outline_area(image, radius, softness)
+            self.loader.load("outline", None, lambda outlined: self.on_outlined(image, revision, source, dirty, outlined),
+                             on_error=self.on_outline_error,
+                             opener=lambda _: self.chat_cache.cached(
+                                 source, lambda: self.outline_cache.get(image, revision, radius, color, softness)))
+
+    def on_outlined(self, image, revision, source, dirty, outlined):
+        if image is not self.chat_image or revision != self.chat_revision:
+            return  # The chat was replaced or edited meanwhile
+        self.chat_image = outlined
+        self.chat_source = source
+        self.draw_chat(dirty)
+        self.chat_outlined = True # Setting outlined to True
+        self.update_magnetic_state()
+        self.save_state()
 
-            # Create a new image for the outline
-            new = Image.new("RGBA", img.size, (0, 0, 0, 0))
-            draw = ImageDraw.Draw(new)
+    def on_outline_error(self, error):
+        messagebox.showerror("Ошибка", f"Не удалось добавить обводку: {error}")
 
-            # Draw the outline
-            draw.bitmap((0, 0), blurred, fill="black")  # Outline color
+    def pin_chat(self):
+        # Чат остаётся на холсте слоем под следующим, на сохранении все слои собираются вместе
+        if self.chat_image:
+            self.pinned = self.pinned + [Layer(self.chat_image, self.chat_x, self.chat_y, self.chat_opacity)]
+            self.chat_image = None
+            self.chat_image_tk = None
+            self.chat_source = None
+            self.selection_coords = None
+            self.chat_cropped = False
+            self.chat_outlined = False
+            self.update_magnetic_state()
+            self.draw_images()
+            self.save_state()
 
-            # Combine the original image with the outline
-            self.chat_image = Image.alpha_composite(new, img)  # Drawing new image before
+    def change_chat_opacity(self, value):
+        # Preview right away, one history entry once the slider stops
+        self.chat_opacity = float(value)
+        if self.chat_image:
             self.draw_chat()
-            self.chat_outlined = True # Setting outlined to True
-            self.update_magnetic_state()
+        if self.opacity_job:
+            self.master.after_cancel(self.opacity_job)
+        self.opacity_job = self.master.after(250, self.finish_chat_opacity)
+
+    def finish_chat_opacity(self):
+        self.opacity_job = None
+        if self.chat_image:
             self.save_state()
 
     def save_image(self):
         #Сохраняем текущее изображение на холсте как файл
-        filename = filedialog.asksaveasfilename(defaultextension=".jpg",
-                                               filetypes=(("JPEG файлы", "*.jpg"), ("Все файлы", "*.*")))
+        filename = self.ask_export_filename()
         if filename:
-            try:
-                # Создаем новое изображение с нужным размером и белым фоном
-                final_image = Image.new("RGB", (self.canvas_width, self.canvas_height), "white")
-
-                # Если есть фоновое изображение, вставляем его
-                if self.bg_image:
-                  final_image.paste(self.bg_image, (self.bg_x, self.bg_y))
-
-                # Если есть чат, вставляем его
-                if self.chat_image:
-                    final_image.paste(self.chat_image, (self.chat_x, self.chat_y), self.chat_image) # Третий аргумент - маска прозрачности
-
-                # Сохраняем итоговое изображение
-                final_image.save(filename)
-                messagebox.showinfo("Сохранено", "Изображение успешно сохранено!")
-                self.clear_canvas() # Очищаем канву после сохранения
-                self.magnetic_override = False
-                self.update_magnetic_button_state()
-                self.save_state()
-            except Exception as e:
-                messagebox.showerror("Ошибка", f"Ошибка при сохранении: {e}")
+            # Кадр собирается из слоёв и кодируется в фоне. Слои не меняются на месте:
+            # правки заменяют картинку или копируют её, пока на неё ссылается история
+            options = dict(self.export_options)
+            stack, size, frame_layers = self.export_stack, (self.canvas_width, self.canvas_height), self.canvas_layers()
+            self.exporter.submit(lambda progress: export_layers(stack, size, frame_layers, filename, options, progress),
+                                 lambda written: self.on_exported(written, "Изображение успешно сохранено!"),
+                                 on_progress=lambda done, total: self.show_export_progress("Сохранение", done, total),
+                                 on_error=lambda e: self.on_export_error(f"Ошибка при сохранении: {e}"))
+            self.clear_canvas() # Очищаем канву (вернуть можно через Ctrl+Z)
+            self.magnetic_override = False
+            self.update_magnetic_button_state()
+            self.save_state()
 
-    def save_to_memory(self):
-        if len(self.memory) < self.memory_limit:
-            # Создаем новое изображение с нужным размером и белым фоном (как в save_image)
-            temp_image = Image.new("RGB", (self.canvas_width, self.canvas_height), "white")
+    def ask_export_filename(self):
+        filetypes = (("PNG файлы", "*.png"), ("JPEG файлы", "*.jpg;*.jpeg"), ("WebP файлы", "*.webp"), ("Все файлы", "*.*"))
+        # Last used format first
+        filetypes = tuple(sorted(filetypes, key=lambda ft: self.export_extension not in ft[1]))
+        filename = filedialog.asksaveasfilename(defaultextension=self.export_extension, filetypes=filetypes)
+        if not filename:
+            return None
+        try:
+            encoding.image_format(filename)
+        except ValueError as e:
+            messagebox.showerror("Ошибка", f"Ошибка при сохранении: {e}")
+            return None
+        self.export_extension = os.path.splitext(filename)[1].lower()
+        return filename
+
+    def canvas_layers(self):
+        # Bottom to top: background, pinned chats, the chat being edited
+        return layers.canvas_layers(self.background_scaler() if self.bg_image else None, (self.bg_x, self.bg_y),
+                                    self.scale_var.get(), self.pinned, self.chat_image, (self.chat_x, self.chat_y),
+                                    self.chat_opacity, self.chat_revision)
+
+    def compose_canvas(self, transparent=False):
+        self.layer_stack.resize((self.canvas_width, self.canvas_height))
+        return self.layer_stack.composite(self.canvas_layers(), transparent)
+
+    def show_export_progress(self, title, done, total):
+        self.export_status.config(text=f"{title}: {done * 100 // max(1, total)}%")
+
+    def on_exported(self, written, message):
+        self.export_status.config(text="")
+        if len(written) > 1:
+            messagebox.showinfo("Сохранено", f"Склейка слишком высокая для одного файла, сохранено частей: {len(written)}")
+        else:
+            messagebox.showinfo("Сохранено", message)
 
-            # Если есть фоновое изображение, вставляем его
-            if self.bg_image:
-                temp_image.paste(self.bg_image, (self.bg_x, self.bg_y))
+    def on_export_error(self, message):
+        self.export_status.config(text="")
+        messagebox.showerror("Ошибка", message)
 
-            # Если есть чат, вставляем его
+    def save_to_memory(self):
+        if self.memory_limit is None or len(self.memory) < self.memory_limit:
+            # Собираем кадр так же, как в save_image (белый фон, фон, закреплённые чаты, чат)
+            temp_image = self.compose_canvas()
+
+            lines = None
             if self.chat_image:
-                temp_image.paste(self.chat_image, (self.chat_x, self.chat_y), self.chat_image) # Третий аргумент - маска прозрачности
-            self.memory.append(temp_image)
+                # Следующий кадр можно примагнитить к строкам этого
+                info = self.chat_content.get(self.chat_image, self.chat_revision, self.key_threshold)
+                self.previous_baselines = [self.chat_y + baseline for baseline in info.baselines]
+                # Строки чата, по ним при склейке убираются повторы
+                lines = overlap.text_lines(self.chat_image, (self.chat_x, self.chat_y), self.canvas_height, self.key_threshold)
+            self.memory.append(self.memory_spool.append(temp_image, lines))
 
             self.update_memory_indicator()
-            messagebox.showinfo("Память", f"Изображение сохранено в памяти ({len(self.memory)}/{self.memory_limit})")
+            messagebox.showinfo("Память", f"Изображение сохранено в памяти ({self.memory_text()})")
             self.clear_canvas() # Очищаем канву после сохранения
             self.magnetic_override = False
             self.update_magnetic_button_state()
@@ -400,43 +672,159 @@ class ImageProcessor:
         if num_images is None:  # Пользователь отменил ввод
             return
 
-        filename = filedialog.asksaveasfilename(defaultextension=".jpg",
-                                                 filetypes=(("JPEG файлы", "*.jpg"), ("Все файлы", "*.*")))
+        # PNG пишется по частям и не держит всю склейку в памяти
+        filename = self.ask_export_filename()
         if filename:
-          try:
-            # Создаем новое изображение, достаточно высокое, чтобы вместить выбранное количество изображений из памяти
-            combined_image = Image.new("RGB", (self.canvas_width, self.canvas_height * num_images), "white")
-
-            # Вставляем изображения из памяти последовательно (вертикально)
-            for i in range(num_images):
-              combined_image.paste(self.memory[i], (0, i * self.canvas_height))
-
-            # Сохраняем итоговое изображение
-            combined_image.save(filename)
-            messagebox.showinfo("Сохранено", "Изображения из памяти успешно склеены и сохранены!")
-            self.clear_memory() # Очищаем память после обработки
-            self.clear_canvas() # Очищаем канву после сохранения
-            self.magnetic_override = False
-            self.update_magnetic_button_state()
-            self.save_state()
-          except Exception as e:
-            messagebox.showerror("Ошибка", f"Ошибка при склеивании и сохранении: {e}")
+          # Склеиваем изображения из памяти последовательно (вертикально), в фоне
+          frames = self.memory[:num_images]
+          options = dict(self.export_options)
+          self.exporter.submit(lambda progress: export_collage(frames, filename, options, progress),
+                               lambda written: self.on_collage_exported(frames, written),
+                               on_progress=lambda done, total: self.show_export_progress("Склейка", done, total),
+                               on_error=lambda e: self.on_export_error(f"Ошибка при склеивании и сохранении: {e}"))
+          self.clear_canvas() # Очищаем канву после сохранения
+          self.magnetic_override = False
+          self.update_magnetic_button_state()
+          self.save_state()
       else:
         messagebox.showinfo("Память", "Недостаточно изображений в памяти для склеивания.")
 
+    def on_collage_exported(self, frames, written):
+        # Только склеенные кадры, в память могли добавить новые
+        self.memory = [frame for frame in self.memory if frame not in frames]
+        self.update_memory_indicator()
+        self.save_state()
+        self.on_exported(written, "Изображения из памяти успешно склеены и сохранены!")
+
+    def toggle_watch(self):
+        if self.ingest is not None:
+            self.stop_watch()
+            return
+        directory = filedialog.askdirectory(title="Папка со скриншотами")
+        if not directory:
+            return
+        from watcher import CaptureIngest
+        # Новый скриншот встаёт на место текущего чата, поверх фона и закреплённых блоков
+        settings = {
+            "threshold": self.key_threshold,
+            "softness": self.key_softness,
+            "outline_radius": self.outline_radius,
+            "outline_color": self.outline_color,
+            "outline_softness": self.outline_softness,
+            "canvas": (self.canvas_width, self.canvas_height),
+            "chat_pos": (self.chat_x, self.chat_y),
+            "layers": [layer for layer in self.canvas_layers() if layer.key != "chat"],
+        }
+        self.ingest = CaptureIngest(self.master, directory, self.memory_spool, settings,
+                                    self.on_capture, self.on_capture_error, cache=self.chat_cache)
+        self.ingest.start()
+        self.watch_button.config(text="Остановить Слежение", relief=tk.SUNKEN)
+        self.export_status.config(text=f"Слежение: {os.path.basename(directory) or directory}")
+
+    def stop_watch(self):
+        if self.ingest is not None:
+            self.ingest.stop()
+            self.ingest = None
+        self.watch_button.config(text="Следить за Папкой", relief=tk.RAISED)
+        self.export_status.config(text="")
+
+    def on_capture(self, frame, path):
+        if self.ingest is None:
+            return  # Stopped while the frame was on its way
+        self.memory.append(frame)
+        self.update_memory_indicator()
+        self.export_status.config(text=f"Слежение: {os.path.basename(path)} в памяти ({self.memory_text()})")
+        self.save_state()
+        if self.memory_limit is not None and len(self.memory) >= self.memory_limit:
+            self.stop_watch()
+            messagebox.showinfo("Память", "Память заполнена, слежение остановлено. Обработайте изображения.")
+
+    def on_capture_error(self, path, error):
+        # Not a dialog per file: a folder can get a lot of screenshots without a chat
+        self.export_status.config(text=f"Слежение: {os.path.basename(path)} пропущен ({error})")
+
+    def session_state(self):
+        # Everything a session file keeps; the chat is copied like for an export
+        return {
+            "canvas": (self.canvas_width, self.canvas_height),
+            "bg_image": self.bg_image,
+            "bg_x": self.bg_x,
+            "bg_y": self.bg_y,
+            "bg_scale": self.bg_scale,
+            "chat_image": self.chat_image.copy() if self.chat_image else None,
+            "chat_x": self.chat_x,
+            "chat_y": self.chat_y,
+            "chat_cropped": self.chat_cropped,
+            "chat_outlined": self.chat_outlined,
+            "chat_opacity": self.chat_opacity,
+            "pinned": list(self.pinned),
+            "magnetic_override": self.magnetic_override,
+            "memory": list(self.memory),
+            "settings": {
+                "key_threshold": self.key_threshold,
+                "key_softness": self.key_softness,
+                "outline_radius": self.outline_radius,
+                "outline_color": self.outline_color,
+                "outline_softness": self.outline_softness,
+                "export": self.export_options,
+                "guides_x": self.user_guides_x,
+                "guides_y": self.user_guides_y,
+            },
+        }
+
+    def save_session(self):
+        import session
+        initialfile = os.path.basename(self.session_path) if self.session_path else None
+        filename = filedialog.asksaveasfilename(defaultextension=session.SUFFIX, initialfile=initialfile,
+                                                filetypes=(("Сессия SoSiska", "*" + session.SUFFIX), ("Все файлы", "*.*")))
+        if filename:
+            # Слои сжимаются в фоне, в очереди вместе с экспортом
+            state = self.session_state()
+            self.exporter.submit(lambda progress: session.save_session(filename, state, progress),
+                                 lambda written: self.on_session_saved(filename),
+                                 on_progress=lambda done, total: self.show_export_progress("Сессия", done, total),
+                                 on_error=lambda e: self.on_export_error(f"Не удалось сохранить сессию: {e}"))
+
+    def on_session_saved(self, filename):
+        self.session_path = filename
+        self.export_status.config(text=f"Сессия сохранена: {os.path.basename(filename)}")
+
+    def open_session(self):
+        import session
+        filename = filedialog.askopenfilename(initialdir=".", title="Выберите файл сессии",
+                                              filetypes=(("Сессия SoSiska", "*" + session.SUFFIX), ("Все файлы", "*.*")))
+        if filename:
+            # Фон и чат распаковываются в потоке загрузки, кадры памяти читаются из файла при склейке
+            self.loader.load("session", filename, lambda state: self.on_session_loaded(filename, state),
+                             on_error=lambda e: messagebox.showerror("Ошибка", f"Не удалось открыть сессию: {e}"),
+                             opener=session.open_session)
+
+    def on_session_loaded(self, filename, state):
+        self.session_path = filename
+        settings = state["settings"]
+        self.key_threshold = settings.get("key_threshold", self.key_threshold)
+        self.key_softness = settings.get("key_softness", self.key_softness)
+        self.outline_radius = settings.get("outline_radius", self.outline_radius)
+        self.outline_color = settings.get("outline_color", self.outline_color)
+        self.outline_softness = settings.get("outline_softness", self.outline_softness)
+        self.export_options = encoding.export_options(settings.get("export"))
+        self.user_guides_x = list(settings.get("guides_x", []))
+        self.user_guides_y = list(settings.get("guides_y", []))
+        self.canvas_width, self.canvas_height = state["canvas"]
+        self.canvas.config(width=self.canvas_width, height=self.canvas_height)
+        self.selection_coords = None
+        self.load_state(state)
+        self.save_state()  # Ctrl+Z возвращает то, что было до открытия
+
     def clear_canvas(self):
         #Очищаем холст и сбрасываем изображения
-        self.canvas.delete("all")
         self.bg_image = None
-        self.bg_image_tk = None
-        if self.bg_rect_id:
-            self.canvas.delete(self.bg_rect_id)
-            self.bg_rect_id = None
+        self.bg_view = None
+        self.bg_scaler = None
         self.chat_image = None
         self.chat_image_tk = None
-        if self.chat_rect_id:
-            self.canvas.delete(self.chat_rect_id)
-            self.chat_rect_id = None
+        self.chat_source = None
+        self.pinned = []
         self.selection_coords = None # Сбрасываем выделенную область
         self.chat_cropped = False # Resetting cropped flag
         self.chat_outlined = False # Resetting outlined flag
@@ -451,6 +839,21 @@ class ImageProcessor:
         self.update_memory_indicator()
         self.save_state()
 
+    def change_outline_settings(self):
+        dlg = OutlineDialog(self.master, self.outline_radius, self.outline_color, self.outline_softness)
+        self.master.wait_window(dlg.top)
+
+        if dlg.result:
+            self.outline_radius, self.outline_color, self.outline_softness = dlg.result
+
+    def change_export_settings(self):
+        dlg = ExportDialog(self.master, self.export_options)
+        self.master.wait_window(dlg.top)
+
+        if dlg.result:
+            self.export_options = dlg.result
+            self.update_memory_indicator()  # The preview merges repeated lines or not
+
     def change_canvas_size(self):
       # Функция для изменения размера холста
       dlg = CanvasSizeDialog(self.master, self.canvas_width, self.canvas_height)
@@ -474,31 +877,91 @@ class ImageProcessor:
           messagebox.showerror("Ошибка", "Ширина и высота должны быть положительными числами.")
         self.save_state()
 
+    @perf.timed("rescale_background")
     def rescale_background(self, value):
+        # While the slider moves show a fast preview, LANCZOS once it stops
         if self.bg_image:
-            scale_factor = float(value)
-            width, height = self.bg_image.size
-            new_width = int(width * scale_factor)
-            new_height = int(height * scale_factor)
-            self.bg_image_resized = self.bg_image.resize((new_width, new_height), Image.Resampling.LANCZOS)
-            self.bg_image_tk = ImageTk.PhotoImage(self.bg_image_resized)
-            self.draw_images() # Перерисовываем
-            self.save_state()
+            self.show_background(float(value), final=False)
+            if self.rescale_job:
+                self.master.after_cancel(self.rescale_job)
+            self.rescale_job = self.master.after(250, self.finish_rescale)
+
+    @perf.timed("finish_rescale")
+    def finish_rescale(self):
+        self.rescale_job = None
+        if self.bg_image:
+            scale = self.scale_var.get()
+            self.show_background(scale)
+            if scale != self.bg_scale:
+                self.bg_scale = scale
+                self.save_state()
+
+    def background_scaler(self):
+        if self.bg_scaler is None or self.bg_scaler.source is not self.bg_image:
+            self.bg_scaler = ScaledImageCache(self.bg_image)
+        return self.bg_scaler
+
+    def show_background(self, scale, final=True):
+        self.bg_view = (self.background_scaler(), scale, final)
+        self.draw_images() # Перерисовываем
 
     def apply_magnetic(self):
       if self.chat_image:
-          # Find text boundaries
-          bbox = self.chat_image.getbbox()
-          if bbox:
-              left, top, right, bottom = bbox
-
-              # Apply magnetic to text boundaries
-              if abs(self.chat_x + left - self.guide_line_offset) < 10:
-                  self.chat_x = self.guide_line_offset - left
-              if abs(self.chat_y + top - self.guide_line_offset) < 10:
-                  self.chat_y = self.guide_line_offset - top
-              if abs(self.chat_y + bottom - (self.canvas_height - self.guide_line_offset)) < 10:
-                  self.chat_y = (self.canvas_height - self.guide_line_offset) - bottom
+          # Text boundaries and baselines are cached per image revision
+          info = self.chat_content.get(self.chat_image, self.chat_revision, self.key_threshold)
+          if info.bbox:
+              left, top, right, bottom = info.bbox
+
+              # Apply magnetic to text boundaries and lines
+              self.chat_x += self.snap_index.snap_x((self.chat_x + left, self.chat_x + right), self.snap_distance)
+              edges = [self.chat_y + top, self.chat_y + bottom] + [self.chat_y + b for b in info.baselines]
+              self.chat_y += self.snap_index.snap_y(edges, self.snap_distance)
+
+    def guide_positions(self):
+        # Vertical (x) and horizontal (y) guides: the frame around the canvas and the user's ones
+        offset = self.guide_line_offset
+        xs = [offset, self.canvas_width - offset] + self.user_guides_x
+        ys = [offset, self.canvas_height - offset] + self.user_guides_y
+        return xs, ys
+
+    def build_snap_index(self):
+        xs, ys = self.guide_positions()
+        return SnapIndex(xs, ys + self.previous_baselines)
+
+    def add_vertical_guide(self, event):
+        self.user_guides_x.append(event.x)
+        self.draw_images()
+
+    def add_horizontal_guide(self, event):
+        self.user_guides_y.append(event.y)
+        self.draw_images()
+
+    def clear_user_guides(self, event=None):
+        self.user_guides_x = []
+        self.user_guides_y = []
+        self.previous_baselines = []
+        self.draw_images()
+
+    def toggle_perf_overlay(self, event=None):
+        if self.perf_overlay_job:
+            self.master.after_cancel(self.perf_overlay_job)
+            self.perf_overlay_job = None
+            self.scene.set_overlay(None)
+        else:
+            self.refresh_perf_overlay()
+
+    def refresh_perf_overlay(self):
+        # On a timer, so loads and exports finished in other threads show up as well
+        self.scene.set_overlay(f"{perf.overlay_text()}\nистория: {self.history.index}".strip())
+        self.perf_overlay_job = self.master.after(250, self.refresh_perf_overlay)
+
+    def save_perf_stats(self, event=None):
+        filename = filedialog.asksaveasfilename(defaultextension=".json", filetypes=(("JSON файлы", "*.json"), ("Все файлы", "*.*")))
+        if filename:
+            try:
+                perf.recorder.save_json(filename)
+            except OSError as e:
+                messagebox.showerror("Ошибка", f"Не удалось сохранить статистику: {e}")
 
     def toggle_guide_lines(self):
         self.guide_lines_visible = not self.guide_lines_visible
@@ -510,14 +973,53 @@ class ImageProcessor:
         self.update_magnetic_button_state()
         self.save_state()
 
-    def draw_guide_lines(self):
-        if self.guide_lines_visible:
-            self.canvas.create_line(self.guide_line_offset, 0, self.guide_line_offset, self.canvas_height, fill="red", dash=(4, 4))
-            self.canvas.create_line(0, self.guide_line_offset, self.canvas_width, self.guide_line_offset, fill="red", dash=(4, 4))
-            self.canvas.create_line(0, self.canvas_height - self.guide_line_offset, self.canvas_width, self.canvas_height - self.guide_line_offset, fill="red", dash=(4, 4))
+    def guide_lines(self):
+        if not self.guide_lines_visible:
+            return []
+        xs, ys = self.guide_positions()
+        return [(x, 0, x, self.canvas_height) for x in xs] + [(0, y, self.canvas_width, y) for y in ys]
+
+    def memory_text(self):
+        if self.memory_limit is None:
+            return f"В памяти: {len(self.memory)}"
+        return f"В памяти: {len(self.memory)}/{self.memory_limit}"
 
     def update_memory_indicator(self):
-        self.memory_indicator.config(text=f"В памяти: {len(self.memory)}/{self.memory_limit}")
+        self.memory_indicator.config(text=self.memory_text())
+        if self.memory_window:
+            self.memory_window.refresh(self.memory, self.export_options["merge_overlap"])
+
+    def show_memory(self):
+        if self.memory_window:
+            self.memory_window.raise_()
+            return
+        if self.thumbnails is None:
+            self.thumbnails = ThumbnailCache(self.master)
+        self.memory_window = MemoryWindow(self.master, self.thumbnails, self.on_memory_reordered,
+                                          on_close=self.on_memory_window_closed)
+        self.memory_window.refresh(self.memory, self.export_options["merge_overlap"])
+
+    def on_close(self):
+        # Worker threads are stopped before Tk goes away; queued loads and exports are
+        # dropped, an export already writing its file is finished first
+        self.stop_watch()
+        if self.thumbnails is not None:
+            self.thumbnails.shutdown()
+        self.loader.shutdown()
+        self.exporter.shutdown()
+        self.master.destroy()
+
+    def on_memory_window_closed(self):
+        # The thumbnail thread and photos are only needed while the window is open
+        self.memory_window = None
+        self.thumbnails.shutdown()
+        self.thumbnails = None
+
+    def on_memory_reordered(self, frames):
+        # Перестановка и удаление кадров отменяются через Ctrl+Z
+        self.memory = frames
+        self.update_memory_indicator()
+        self.save_state()
 
     def is_magnetic_enabled(self):
         return (self.chat_cropped and self.chat_outlined and not self.magnetic_override) or (self.magnetic_override and self.chat_cropped and self.chat_outlined)
@@ -563,8 +1065,8 @@ class ImageProcessor:
             self.canvas.delete(self.delete_rect_id)
             self.canvas.unbind("<B1-Motion>")
             self.canvas.unbind("<ButtonRelease-1>")
-            self.delete_selection()
-            self.save_state()
+            dirty_box = self.delete_selection()
+            self.save_state(dirty={"chat_image": ("patch", dirty_box)} if dirty_box else None)
 
     def delete_selection(self):
         if self.chat_image and self.delete_coords:
@@ -574,52 +1076,61 @@ class ImageProcessor:
             img_x2 = x2 - self.chat_x
             img_y2 = y2 - self.chat_y
 
+            # Changed region, clipped to the image (rectangle() includes the right/bottom edge)
+            width, height = self.chat_image.size
+            dirty_box = (max(0, img_x1), max(0, img_y1), min(width, img_x2 + 1), min(height, img_y2 + 1))
+            if dirty_box[2] <= dirty_box[0] or dirty_box[3] <= dirty_box[1]:
+                return None
+
+            # Copy-on-write: the image may still be referenced by undo history
+            if self.history.is_shared(self.chat_image):
+                self.chat_image = self.chat_image.copy()
+
+            from PIL import ImageDraw
             draw = ImageDraw.Draw(self.chat_image)
             draw.rectangle((img_x1, img_y1, img_x2, img_y2), fill=(0, 0, 0, 0))  # Make it transparent
+            self.chat_revision += 1
+            self.chat_source = None  # An erased chat isn't cached
 
-            self.draw_chat()
+            self.draw_chat(dirty_box)
+            return dirty_box
 
-    def save_state(self):
-        # Save current state to history
+    @perf.timed("save_state")
+    def save_state(self, dirty=None):
+        # Save current state to history. Images are stored by reference, `dirty`
+        # describes in-place edits so only the changed region is kept
         state = {
-            "bg_image": self.bg_image.copy() if self.bg_image else None,
-            "chat_image": self.chat_image.copy() if self.chat_image else None,
+            "bg_image": self.bg_image,
+            "chat_image": self.chat_image,
             "bg_x": self.bg_x,
             "bg_y": self.bg_y,
+            "bg_scale": self.bg_scale,
             "chat_x": self.chat_x,
             "chat_y": self.chat_y,
             "chat_cropped": self.chat_cropped,
             "chat_outlined": self.chat_outlined,
+            "chat_source": self.chat_source,
+            "chat_opacity": self.chat_opacity,
+            "pinned": tuple(self.pinned),
             "magnetic_override": self.magnetic_override,
-            "memory": [img.copy() for img in self.memory],
+            "memory": self.memory,
         }
-        # Trim history if we've undone
-        if self.history_index < len(self.history) - 1:
-            self.history = self.history[:self.history_index + 1]
-        self.history.append(state)
-        self.history_index += 1
-        print("Saved state to history, index:", self.history_index) # For debugging
-
-        # Limit history size
-        if len(self.history) > 10:
-          self.history = self.history[-10:]
-          self.history_index = len(self.history) - 1
+        self.history.push(state, dirty)
+        perf.count("history_push")
 
     def undo(self, event=None):
         # Undo to previous state
-        if self.history_index > 0:
-            self.history_index -= 1
-            state = self.history[self.history_index]
+        state = self.history.undo()
+        if state:
             self.load_state(state)
-            print("Undoing, current index:", self.history_index)  # For debugging
+            perf.count("history_undo")
 
     def redo(self, event=None):
         # Redo to next state
-        if self.history_index < len(self.history) - 1:
-            self.history_index += 1
-            state = self.history[self.history_index]
+        state = self.history.redo()
+        if state:
             self.load_state(state)
-            print("Redoing, current index:", self.history_index) # For debugging
+            perf.count("history_redo")
 
     def load_state(self, state):
         # Load state from history
@@ -627,21 +1138,33 @@ class ImageProcessor:
         self.chat_image = state["chat_image"]
         self.bg_x = state["bg_x"]
         self.bg_y = state["bg_y"]
+        self.bg_scale = state["bg_scale"]
         self.chat_x = state["chat_x"]
         self.chat_y = state["chat_y"]
         self.chat_cropped = state["chat_cropped"]
         self.chat_outlined = state["chat_outlined"]
+        self.chat_source = state.get("chat_source")  # Sessions don't keep it
+        self.chat_opacity = state.get("chat_opacity", 1.0)
+        self.pinned = list(state.get("pinned", ()))
         self.magnetic_override = state["magnetic_override"]
-        self.memory = [img.copy() for img in state["memory"]]
+        self.memory = state["memory"]
 
         # Update UI
+        if self.rescale_job:
+            self.master.after_cancel(self.rescale_job)
+            self.rescale_job = None
+        self.scale_var.set(self.bg_scale)
+        if self.opacity_job:
+            self.master.after_cancel(self.opacity_job)
+            self.opacity_job = None
+        self.opacity_var.set(self.chat_opacity)
         if self.bg_image:
-            self.bg_image_tk = ImageTk.PhotoImage(self.bg_image)
+            self.show_background(self.bg_scale)
         else:
-            self.bg_image_tk = None
+            self.bg_view = None
 
         if self.chat_image:
-            self.chat_image_tk = ImageTk.PhotoImage(self.chat_image)
+            self.chat_image_tk = ImageTk.PhotoImage(layers.fade(self.chat_image, self.chat_opacity))
         else:
             self.chat_image_tk = None
 
@@ -690,6 +1213,137 @@ class CanvasSizeDialog:
         self.result = None
         self.top.destroy()
 
-root = tk.Tk()
-processor = ImageProcessor(root)
-root.mainloop()
\ No newline at end of file
+class OutlineDialog:
+    def __init__(self, parent, radius, color, softness):
+        self.top = tk.Toplevel(parent)
+        self.top.transient(parent)
+        self.top.grab_set()
+
+        self.result = None
+        self.color = color
+
+        tk.Label(self.top, text="Толщина:").grid(row=0, column=0, padx=5, pady=5)
+        tk.Label(self.top, text="Мягкость:").grid(row=1, column=0, padx=5, pady=5)
+        tk.Label(self.top, text="Цвет:").grid(row=2, column=0, padx=5, pady=5)
+
+        self.radius_entry = tk.Spinbox(self.top, from_=1, to=8, width=5)
+        self.radius_entry.delete(0, tk.END)
+        self.radius_entry.insert(0, str(radius))
+        self.radius_entry.grid(row=0, column=1, padx=5, pady=5)
+
+        self.softness_entry = tk.Spinbox(self.top, from_=0, to=5, width=5)
+        self.softness_entry.delete(0, tk.END)
+        self.softness_entry.insert(0, str(softness))
+        self.softness_entry.grid(row=1, column=1, padx=5, pady=5)
+
+        self.color_button = tk.Button(self.top, text="    ", bg=color, command=self.choose_color)
+        self.color_button.grid(row=2, column=1, padx=5, pady=5)
+
+        ok_button = tk.Button(self.top, text="OK", command=self.ok)
+        ok_button.grid(row=3, column=0, padx=5, pady=5)
+
+        cancel_button = tk.Button(self.top, text="Отмена", command=self.cancel)
+        cancel_button.grid(row=3, column=1, padx=5, pady=5)
+
+        self.top.bind("<Return>", self.ok)
+        self.top.bind("<Escape>", self.cancel)
+
+    def choose_color(self):
+        _, color = colorchooser.askcolor(self.color, parent=self.top)
+        if color:
+            self.color = color
+            self.color_button.config(bg=color)
+
+    def ok(self, event=None):
+        try:
+            radius = int(self.radius_entry.get())
+            softness = int(self.softness_entry.get())
+        except ValueError:
+            messagebox.showerror("Ошибка", "Пожалуйста, введите целые числа для толщины и мягкости.")
+            return
+        if radius < 1 or softness < 0:
+            messagebox.showerror("Ошибка", "Толщина должна быть не меньше 1, мягкость - не меньше 0.")
+            return
+        self.result = (radius, self.color, softness)
+        self.top.destroy()
+
+    def cancel(self, event=None):
+        self.result = None
+        self.top.destroy()
+
+class ExportDialog:
+    def __init__(self, parent, options):
+        self.top = tk.Toplevel(parent)
+        self.top.transient(parent)
+        self.top.grab_set()
+
+        self.result = None
+        self.options = options
+
+        tk.Label(self.top, text="Качество JPEG:").grid(row=0, column=0, padx=5, pady=5, sticky=tk.W)
+        tk.Label(self.top, text="Качество WebP:").grid(row=2, column=0, padx=5, pady=5, sticky=tk.W)
+        tk.Label(self.top, text="Сжатие PNG (0-9):").grid(row=4, column=0, padx=5, pady=5, sticky=tk.W)
+
+        self.jpeg_quality_entry = self.spinbox(1, 100, options["jpeg_quality"], 0)
+        self.webp_quality_entry = self.spinbox(1, 100, options["webp_quality"], 2)
+        self.png_level_entry = self.spinbox(0, 9, options["png_compress_level"], 4)
+
+        self.progressive_var = tk.BooleanVar(value=options["jpeg_progressive"])
+        tk.Checkbutton(self.top, text="Прогрессивный JPEG", variable=self.progressive_var).grid(row=1, column=0, columnspan=2, padx=5, sticky=tk.W)
+
+        self.lossless_var = tk.BooleanVar(value=options["webp_lossless"])
+        tk.Checkbutton(self.top, text="WebP без потерь", variable=self.lossless_var).grid(row=3, column=0, columnspan=2, padx=5, sticky=tk.W)
+
+        self.transparent_var = tk.BooleanVar(value=options["transparent"])
+        tk.Checkbutton(self.top, text="Прозрачный фон (PNG, WebP)", variable=self.transparent_var).grid(row=5, column=0, columnspan=2, padx=5, sticky=tk.W)
+
+        self.merge_var = tk.BooleanVar(value=options["merge_overlap"])
+        tk.Checkbutton(self.top, text="Убирать повторы строк при склейке", variable=self.merge_var).grid(row=6, column=0, columnspan=2, padx=5, sticky=tk.W)
+
+        ok_button = tk.Button(self.top, text="OK", command=self.ok)
+        ok_button.grid(row=7, column=0, padx=5, pady=5)
+
+        cancel_button = tk.Button(self.top, text="Отмена", command=self.cancel)
+        cancel_button.grid(row=7, column=1, padx=5, pady=5)
+
+        self.top.bind("<Return>", self.ok)
+        self.top.bind("<Escape>", self.cancel)
+
+    def spinbox(self, low, high, value, row):
+        entry = tk.Spinbox(self.top, from_=low, to=high, width=5)
+        entry.delete(0, tk.END)
+        entry.insert(0, str(value))
+        entry.grid(row=row, column=1, padx=5, pady=5)
+        return entry
+
+    def ok(self, event=None):
+        try:
+            jpeg_quality = int(self.jpeg_quality_entry.get())
+            webp_quality = int(self.webp_quality_entry.get())
+            png_level = int(self.png_level_entry.get())
+        except ValueError:
+            messagebox.showerror("Ошибка", "Пожалуйста, введите целые числа.")
+            return
+        if not (1 <= jpeg_quality <= 100 and 1 <= webp_quality <= 100 and 0 <= png_level <= 9):
+            messagebox.showerror("Ошибка", "Качество должно быть от 1 до 100, сжатие PNG - от 0 до 9.")
+            return
+        self.result = dict(self.options, jpeg_quality=jpeg_quality, webp_quality=webp_quality,
+                           png_compress_level=png_level, jpeg_progressive=self.progressive_var.get(),
+                           webp_lossless=self.lossless_var.get(), transparent=self.transparent_var.get(),
+                           merge_overlap=self.merge_var.get())
+        self.top.destroy()
+
+    def cancel(self, event=None):
+        self.result = None
+        self.top.destroy()
+
+if __name__ == "__main__":
+    startup.mark("imports")
+    root = tk.Tk()
+    startup.mark("tk")
+    processor = ImageProcessor(root)
+    startup.mark("ui")
+    if startup.ENABLED:
+        # The canvas is exposed when the window maps, its redraw is the next idle task
+        processor.canvas.bind("<Expose>", lambda event: root.after_idle(startup.finish, root), add="+")
+    root.mainloop()
@@ -0,0 +1,108 @@
+from array import array
+
+from PIL import Image
+
+import keying
+
+# Automatic chat cropping from projection profiles.
+# The keyed alpha channel is turned into a 0/1 mask and averaged down to a
+# single column (per-row fill) and a single row (per-column fill) with a BOX
+# resize, all inside PIL. Runs of non-empty rows are text lines, lines close
+# to each other form blocks, and the block with the most lines is the chat.
+# Across the block's rows, the biggest run of non-empty columns gives its
+# width, so HUD pieces further to the right (money, clock) are left out.
+
+
+def content_mask(img, threshold=50):
+    # 1 where there is something visible. Keyed images use their alpha,
+    # raw screenshots are keyed on the fly
+    if "A" in img.getbands():
+        alpha = img.getchannel("A")
+    else:
+        alpha = keying.key_mask(img, threshold)
+    return alpha.point([0] + [1] * 255).convert("F")
+
+
+def profile(mask, axis):
+    # Number of lit pixels per row (axis=0) or per column (axis=1)
+    if axis == 0:
+        reduced = mask.resize((1, mask.height), Image.Resampling.BOX)
+        length = mask.width
+    else:
+        reduced = mask.resize((mask.width, 1), Image.Resampling.BOX)
+        length = mask.height
+    return [round(v * length) for v in array("f", reduced.tobytes())]
+
+
+def runs(values, min_value=1, merge_gap=0):
+    # [start, end) ranges where values >= min_value, gaps up to merge_gap are bridged
+    found = []
+    start = None
+    for i, v in enumerate(values):
+        if v >= min_value:
+            if start is None:
+                start = i
+            end = i + 1
+        elif start is not None and i - end >= merge_gap:
+            found.append((start, end))
+            start = None
+    if start is not None:
+        found.append((start, end))
+    return found
+
+
+def group_lines(lines, max_gap):
+    blocks = []
+    for line in lines:
+        if blocks and line[0] - blocks[-1][-1][1] <= max_gap:
+            blocks[-1].append(line)
+        else:
+            blocks.append([line])
+    return blocks
+
+
+def pick_block(lines):
+    heights = sorted(bottom - top for top, bottom in lines)
+    line_height = heights[len(heights) // 2]
+    blocks = group_lines(lines, max_gap=line_height)
+    return line_height, max(blocks, key=lambda b: (len(b), -b[0][0]))
+
+
+def find_lines(img, threshold=50, min_pixels=2, merge_gap=1):
+    mask = content_mask(img, threshold)
+    return runs(profile(mask, 0), min_pixels, merge_gap)
+
+
+def detect_chat(img, threshold=50, min_pixels=2, margin=2):
+    # {"block": (x1, y1, x2, y2), "lines": [(x1, y1, x2, y2), ...]} or None
+    mask = content_mask(img, threshold)
+    lines = runs(profile(mask, 0), min_pixels, merge_gap=1)
+    if not lines:
+        return None
+
+    line_height, block = pick_block(lines)
+    top, bottom = block[0][0], block[-1][1]
+
+    columns = profile(mask.crop((0, top, mask.width, bottom)), 1)
+    column_runs = runs(columns, 1, merge_gap=line_height * 3)
+    left, right = max(column_runs, key=lambda r: sum(columns[r[0]:r[1]]))
+
+    # Second pass over the chat columns only, so HUD elements on the same rows
+    # don't glue lines together
+    lines = runs(profile(mask.crop((left, 0, right, mask.height)), 0), min_pixels, merge_gap=1)
+    _, block = pick_block([line for line in lines if line[1] > top and line[0] < bottom] or lines)
+    top, bottom = block[0][0], block[-1][1]
+
+    def pad(box):
+        x1, y1, x2, y2 = box
+        return (max(0, x1 - margin), max(0, y1 - margin), min(img.width, x2 + margin), min(img.height, y2 + margin))
+
+    return {
+        "block": pad((left, top, right, bottom)),
+        "lines": [pad((left, line_top, right, line_bottom)) for line_top, line_bottom in block],
+    }
+
+
+def find_chat_block(img, threshold=50, margin=2):
+    found = detect_chat(img, threshold, margin=margin)
+    return found["block"] if found else None
@@ -0,0 +1,216 @@
+# Headless batch mode: the same pipeline as in the app, without Tk.
+# key out black background -> crop -> outline -> paste over the background.
+#
+#   python batch.py CHAT_DIR --background bg.jpg [--manifest m.json|m.csv] [--out DIR] [--workers N]
+#
+# Manifest (optional) gives per-screenshot crop rectangles and positions.
+# JSON:
+#   {"canvas": [650, 650], "scale": 1.0, "items": [
+#       {"chat": "sa-mp-001.png", "crop": [0, 0, 600, 200], "chat_pos": [10, 10], "bg_pos": [0, 0]},
+#       {"chat": "sa-mp-002.png", "crop": "auto"}]}
+# CSV (header required, empty cells use defaults, crop=auto finds the chat by itself):
+#   chat,crop,crop_x1,crop_y1,crop_x2,crop_y2,chat_x,chat_y,bg_x,bg_y,output
+# Screenshots without a manifest entry are processed with defaults
+# (no crop or auto crop with --auto-crop, position 0,0).
+# Encoder settings ("export": {"jpeg_quality": 95, ...}, see encoding.py) can be
+# given for the whole manifest or per item, --quality etc. override them.
+# Each worker loads the background once and writes its result itself, so only
+# about one frame per worker is in memory at any time. Processed chats are
+# kept in the same disk cache as the app's (diskcache.py): re-running a batch
+# over the same screenshots with the same settings skips keying and outlining.
+import argparse
+import csv
+import json
+import multiprocessing
+import os
+import sys
+
+from PIL import Image
+
+import diskcache
+import encoding
+import parallel
+from export import compose_frame, wants_transparency
+from render_core import cached_chat
+from scaling import ScaledImageCache
+
+_background = None
+_scale = 1.0
+_cache = None
+
+
+def load_manifest(path):
+    if path.lower().endswith(".csv"):
+        with open(path, newline="", encoding="utf-8") as f:
+            rows = list(csv.DictReader(f))
+        items = []
+        for row in rows:
+            item = {"chat": row["chat"]}
+            if row.get("crop") == "auto":
+                item["crop"] = "auto"
+            elif all(row.get(k) for k in ("crop_x1", "crop_y1", "crop_x2", "crop_y2")):
+                item["crop"] = [int(row[k]) for k in ("crop_x1", "crop_y1", "crop_x2", "crop_y2")]
+            if row.get("chat_x") and row.get("chat_y"):
+                item["chat_pos"] = [int(row["chat_x"]), int(row["chat_y"])]
+            if row.get("bg_x") and row.get("bg_y"):
+                item["bg_pos"] = [int(row["bg_x"]), int(row["bg_y"])]
+            if row.get("output"):
+                item["output"] = row["output"]
+            items.append(item)
+        return {"items": items}
+
+    with open(path, encoding="utf-8") as f:
+        manifest = json.load(f)
+    if isinstance(manifest, list):
+        manifest = {"items": manifest}
+    return manifest
+
+
+def build_jobs(chat_dir, manifest, out_dir, defaults):
+    entries = {item["chat"]: item for item in manifest.get("items", [])}
+    names = sorted(name for name in os.listdir(chat_dir) if name.lower().endswith(encoding.IMAGE_EXTENSIONS))
+    # Files listed in the manifest keep its order, the rest follow by name
+    ordered = [name for name in entries if name in names] + [name for name in names if name not in entries]
+
+    jobs = []
+    for name in ordered:
+        item = entries.get(name, {})
+        output = item.get("output") or os.path.splitext(name)[0] + "." + defaults["format"]
+        jobs.append({
+            "chat": os.path.join(chat_dir, name),
+            "output": os.path.join(out_dir, output),
+            "crop": item.get("crop", defaults["crop"]),
+            "chat_pos": tuple(item.get("chat_pos", defaults["chat_pos"])),
+            "bg_pos": tuple(item.get("bg_pos", defaults["bg_pos"])),
+            "canvas": tuple(defaults["canvas"]),
+            "threshold": item.get("threshold", defaults["threshold"]),
+            "softness": item.get("softness", defaults["softness"]),
+            "outline": item.get("outline", defaults["outline"]),
+            "outline_radius": item.get("outline_radius", defaults["outline_radius"]),
+            "outline_color": item.get("outline_color", defaults["outline_color"]),
+            "outline_softness": item.get("outline_softness", defaults["outline_softness"]),
+            "export": dict(defaults["export"], **item.get("export", {})),
+        })
+    return jobs
+
+
+def open_chat(path):
+    with Image.open(path) as chat:
+        chat.load()
+        return chat
+
+
+def load_chat(job):
+    # Through the disk cache under the same chain the app builds
+    source = diskcache.file_source(job["chat"]) if _cache else None
+    return cached_chat(_cache, source, lambda: open_chat(job["chat"]), job["crop"], job["threshold"], job["softness"],
+                       job["outline"], job["outline_radius"], job["outline_color"], job["outline_softness"])
+
+
+def _init_worker(background_path, scale, cache_dir=None, filter_workers=None):
+    global _background, _scale, _cache
+    _scale = scale
+    if filter_workers:
+        # Processes already use the cores, strip threads only get what is left
+        parallel.WORKERS = filter_workers
+    _cache = diskcache.DiskCache(cache_dir) if cache_dir else None
+    if background_path:
+        with Image.open(background_path) as img:
+            img.load()
+            _background = ScaledImageCache(img)
+
+
+def run_job(job):
+    try:
+        chat = load_chat(job)
+        options = encoding.export_options(job["export"])
+        transparent = wants_transparency(job["output"], options)
+        frame = compose_frame(job["canvas"], _background, job["bg_pos"], chat, job["chat_pos"], _scale, transparent)
+        encoding.save(frame, job["output"], options)
+        return job["chat"], job["output"], None
+    except Exception as e:
+        return job["chat"], job["output"], str(e)
+
+
+def parse_size(value):
+    width, height = (int(v) for v in value.lower().split("x"))
+    if width <= 0 or height <= 0:
+        raise argparse.ArgumentTypeError("ширина и высота должны быть положительными")
+    return width, height
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="SoSiska: пакетная обработка скриншотов чата без GUI")
+    parser.add_argument("chat_dir", help="папка со скриншотами чата")
+    parser.add_argument("--background", help="фоновое изображение")
+    parser.add_argument("--manifest", help="JSON или CSV с областями обрезки и позициями")
+    parser.add_argument("--out", default="out", help="папка для результатов")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--canvas", type=parse_size, help="размер холста, например 650x650")
+    parser.add_argument("--scale", type=float, help="масштаб фона")
+    parser.add_argument("--threshold", type=int, default=50)
+    parser.add_argument("--softness", type=int, default=0)
+    parser.add_argument("--no-outline", action="store_true")
+    parser.add_argument("--outline-radius", type=int, help="толщина обводки, px")
+    parser.add_argument("--outline-color", help="цвет обводки (black, #202020, ...)")
+    parser.add_argument("--outline-softness", type=int, help="размытие края обводки, px")
+    parser.add_argument("--auto-crop", action="store_true", help="искать и обрезать чат автоматически")
+    parser.add_argument("--format", default="jpg", help="формат по умолчанию (jpg, png, webp, ...)")
+    parser.add_argument("--quality", type=int, help="качество JPEG/WebP, 1-100")
+    parser.add_argument("--png-compress-level", type=int, choices=range(10), metavar="0-9", help="сжатие PNG")
+    parser.add_argument("--lossless", action="store_true", help="WebP без потерь")
+    parser.add_argument("--transparent", action="store_true", help="прозрачный фон там, где нет фона (PNG, WebP)")
+    parser.add_argument("--cache-dir", help="папка кэша обработанных чатов")
+    parser.add_argument("--no-cache", action="store_true", help="не использовать кэш")
+    args = parser.parse_args(argv)
+
+    manifest = load_manifest(args.manifest) if args.manifest else {}
+    defaults = {
+        "canvas": args.canvas or manifest.get("canvas", (650, 650)),
+        "chat_pos": manifest.get("chat_pos", (0, 0)),
+        "bg_pos": manifest.get("bg_pos", (0, 0)),
+        "crop": "auto" if args.auto_crop else manifest.get("crop"),
+        "threshold": args.threshold,
+        "softness": args.softness,
+        "outline": not args.no_outline and manifest.get("outline", True),
+        "outline_radius": args.outline_radius or manifest.get("outline_radius", 1),
+        "outline_color": args.outline_color or manifest.get("outline_color", "black"),
+        "outline_softness": args.outline_softness if args.outline_softness is not None else manifest.get("outline_softness", 0),
+        "format": args.format.lstrip("."),
+        "export": dict(manifest.get("export", {})),
+    }
+    if args.quality is not None:
+        defaults["export"].update(jpeg_quality=args.quality, webp_quality=args.quality)
+    if args.png_compress_level is not None:
+        defaults["export"]["png_compress_level"] = args.png_compress_level
+    if args.lossless:
+        defaults["export"]["webp_lossless"] = True
+    if args.transparent:
+        defaults["export"]["transparent"] = True
+    background = args.background or manifest.get("background")
+    scale = args.scale if args.scale is not None else manifest.get("scale", 1.0)
+    cache_dir = None if args.no_cache else args.cache_dir or diskcache.default_directory()
+
+    os.makedirs(args.out, exist_ok=True)
+    jobs = build_jobs(args.chat_dir, manifest, args.out, defaults)
+    if not jobs:
+        print("Нет скриншотов для обработки")
+        return 1
+
+    failed = 0
+    workers = max(1, min(args.workers, len(jobs)))
+    filter_workers = max(1, (os.cpu_count() or 1) // workers)
+    with multiprocessing.Pool(workers, initializer=_init_worker,
+                              initargs=(background, scale, cache_dir, filter_workers)) as pool:
+        for done, (chat, output, error) in enumerate(pool.imap_unordered(run_job, jobs), 1):
+            if error:
+                failed += 1
+                print(f"[{done}/{len(jobs)}] {chat}: ошибка: {error}", file=sys.stderr)
+            else:
+                print(f"[{done}/{len(jobs)}] {output}")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    multiprocessing.freeze_support()
+    sys.exit(main())
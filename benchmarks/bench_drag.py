@@ -0,0 +1,98 @@
+# Drag benchmark: replays a scripted background/chat drag and measures frame time.
+# Compares the retained scene (coalesced redraw) with the old "delete all and
+# recreate everything" redraw on every motion event. Needs a display.
+# Run from the repo root:  python -m benchmarks.bench_drag [--frames N] [--events-per-frame K]
+import argparse
+import statistics
+import time
+import tkinter as tk
+
+from PIL import Image, ImageTk
+
+from SoSiska import ImageProcessor
+from benchmarks.synthetic import make_screenshot
+import keying
+
+
+class FakeEvent:
+    def __init__(self, x, y):
+        self.x = x
+        self.y = y
+
+
+def legacy_draw_images(app, bg_photo):
+    # The old draw_images: full canvas rebuild with one PhotoImage for the whole background
+    canvas = app.canvas
+    canvas.delete("all")
+    canvas.create_rectangle(0, 0, app.canvas_width, app.canvas_height, outline="black")
+    if bg_photo:
+        canvas.create_image(app.bg_x, app.bg_y, anchor=tk.NW, image=bg_photo)
+        width, height = app.bg_image.size
+        canvas.create_rectangle(app.bg_x, app.bg_y, app.bg_x + width, app.bg_y + height, outline="blue")
+    if app.chat_image_tk:
+        canvas.create_image(app.chat_x, app.chat_y, anchor=tk.NW, image=app.chat_image_tk)
+        width, height = app.chat_image.size
+        canvas.create_rectangle(app.chat_x, app.chat_y, app.chat_x + width, app.chat_y + height, outline="green")
+    for line in app.guide_lines():
+        canvas.create_line(*line, fill="red", dash=(4, 4))
+
+
+def drag_path(frames, events_per_frame):
+    # Back-and-forth diagonal drag, several motion events per frame
+    points = []
+    for i in range(frames * events_per_frame):
+        t = i % 200
+        step = t if t < 100 else 200 - t
+        points.append((100 + step * 2, 100 + step))
+    return [points[i:i + events_per_frame] for i in range(0, len(points), events_per_frame)]
+
+
+def replay(app, root, frames, start, move, stop, legacy=None):
+    # legacy: background PhotoImage for the old full redraw, None for the app's own path
+    start(FakeEvent(100, 100))
+    times = []
+    for events in frames:
+        begin = time.perf_counter()
+        for x, y in events:
+            if legacy:
+                app.bg_x, app.bg_y = x, y
+                legacy_draw_images(app, legacy)
+            else:
+                move(FakeEvent(x, y))
+        root.update()
+        times.append((time.perf_counter() - begin) * 1000)
+    stop(FakeEvent(0, 0))
+    return times
+
+
+def report(name, times):
+    times = sorted(times)
+    p95 = times[int(len(times) * 0.95) - 1]
+    print(f"{name:>18}: mean {statistics.mean(times):7.3f} ms  median {statistics.median(times):7.3f} ms  p95 {p95:7.3f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Drag benchmark")
+    parser.add_argument("--frames", type=int, default=300)
+    parser.add_argument("--events-per-frame", type=int, default=4)
+    args = parser.parse_args()
+
+    root = tk.Tk()
+    app = ImageProcessor(root)
+    app.bg_image = Image.new("RGB", (1920, 1080), (40, 80, 120))
+    app.show_background(1.0)
+    app.chat_image = keying.remove_black_background(make_screenshot((800, 300)))
+    app.draw_chat()
+    root.update()
+
+    frames = drag_path(args.frames, args.events_per_frame)
+    report("retained bg drag", replay(app, root, frames, app.start_move_bg, app.move_bg, app.stop_move_bg))
+    report("retained chat drag", replay(app, root, frames, app.start_move_chat, app.move_chat, app.stop_move_chat))
+    # Last: the legacy redraw deletes the scene's canvas items
+    legacy_photo = ImageTk.PhotoImage(app.bg_image)
+    report("legacy bg drag", replay(app, root, frames, app.start_move_bg, app.move_bg, app.stop_move_bg, legacy_photo))
+    root.destroy()
+
+
+if __name__ == "__main__":
+    main()
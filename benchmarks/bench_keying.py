@@ -0,0 +1,55 @@
+# Keying benchmark: band-based keying.remove_black_background vs the old per-pixel loop.
+# Run from the repo root:  python -m benchmarks.bench_keying [--skip-legacy] [--repeat N]
+import argparse
+import time
+
+import keying
+from benchmarks.synthetic import RESOLUTIONS, make_screenshot
+
+
+def legacy_remove_black_background(img, threshold=50):
+    # Copy of the original ImageProcessor.remove_black_background loop
+    img = img.convert("RGBA")
+    data = img.getdata()
+    new_data = []
+    for item in data:
+        if item[0] < threshold and item[1] < threshold and item[2] < threshold:
+            new_data.append((0, 0, 0, 0))
+        else:
+            new_data.append(item)
+    img.putdata(new_data)
+    return img.copy()
+
+
+def timeit(func, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Keying benchmark")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--skip-legacy", action="store_true", help="не гонять старый цикл (долго на 4K)")
+    args = parser.parse_args()
+
+    print(f"{'size':>6} {'legacy, s':>10} {'hard, s':>10} {'soft, s':>10} {'speedup':>8}")
+    for name, size in RESOLUTIONS.items():
+        img = make_screenshot(size)
+        hard = timeit(lambda: keying.remove_black_background(img, 50), args.repeat)
+        soft = timeit(lambda: keying.remove_black_background(img, 50, softness=32), args.repeat)
+        if args.skip_legacy:
+            print(f"{name:>6} {'-':>10} {hard:>10.4f} {soft:>10.4f} {'-':>8}")
+            continue
+        legacy = timeit(lambda: legacy_remove_black_background(img, 50), 1)
+        if legacy_remove_black_background(img, 50).tobytes() != keying.remove_black_background(img, 50).tobytes():
+            print(f"{name:>6} результат не совпадает со старым циклом!")
+        print(f"{name:>6} {legacy:>10.4f} {hard:>10.4f} {soft:>10.4f} {legacy / hard:>7.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,243 @@
+# Pipeline benchmark: times every processing stage headlessly, without Tk.
+# Screenshots come from benchmarks.synthetic (seeded, same pixels everywhere)
+# at several resolutions and chat line counts. Every stage runs `repeat`
+# times, best and median go into a JSON report; with --baseline the report is
+# compared against a stored one and the exit code is 1 if a stage got slower
+# than the threshold allows.
+# Run from the repo root:
+#   python -m benchmarks.bench_pipeline [--quick] [--out report.json]
+#   python -m benchmarks.bench_pipeline --save-baseline baseline.json
+#   python -m benchmarks.bench_pipeline --baseline baseline.json [--threshold 0.1]
+import argparse
+import datetime
+import json
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import time
+
+import PIL
+
+import autocrop
+import encoding
+import keying
+import outline
+import overlap
+import perf
+import snapping
+from benchmarks import synthetic
+from export import compose_frame
+from history import History
+from layers import Layer, LayerStack
+from scaling import ScaledImageCache
+from spool import FrameSpool
+from stitch import stitch_vertical
+
+LINE_COUNTS = (10, 40)
+COLLAGE_FRAMES = 6
+THRESHOLD = 0.10
+MIN_DELTA_MS = 0.5  # Smaller differences are timer noise
+
+
+def measure(func, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append((time.perf_counter() - start) * 1000)
+    return {"best_ms": round(min(times), 3), "median_ms": round(statistics.median(times), 3), "runs": repeat}
+
+
+def prepare_chat(shot):
+    # What the app does to a freshly loaded screenshot: key, crop, outline
+    keyed = keying.remove_black_background(shot, 50)
+    return outline.add_outline(keyed.crop(autocrop.find_chat_block(shot)), 1)
+
+
+def history_edits(chat, repeat):
+    # A push per edit the app records: a new image, an erase (patch) and a crop,
+    # then walking back and forth through them
+    history = History()
+    box = (0, 0, chat.width // 2, chat.height // 2)
+    for _ in range(repeat):
+        history.push({"chat_image": chat, "bg_image": None, "memory": []})
+        erased = chat.copy()
+        erased.paste((0, 0, 0, 0), box)
+        history.push({"chat_image": erased, "bg_image": None, "memory": []}, {"chat_image": ("patch", box)})
+        cropped = erased.crop(box)
+        history.push({"chat_image": cropped, "bg_image": None, "memory": []}, {"chat_image": ("crop", box)})
+        history.undo()
+        history.undo()
+        history.redo()
+        history.redo()
+
+
+def spool_collage(spool, size, lines, background):
+    # Frames of a scrolling chat the way save_to_memory stores them
+    frames = []
+    for i in range(COLLAGE_FRAMES):
+        shot = synthetic.make_screenshot(size, lines, seed=1, offset=i * max(1, lines // 2))
+        chat = prepare_chat(shot)
+        frame = compose_frame(size, background, (0, 0), chat, (0, 0))
+        frames.append(spool.append(frame, overlap.text_lines(chat, (0, 0), size[1])))
+    return frames
+
+
+def run_case(size, lines, repeat, directory):
+    results = {}
+    shot = synthetic.make_screenshot(size, lines)
+    background = ScaledImageCache(synthetic.make_background(size))
+
+    keyed = keying.remove_black_background(shot, 50)
+    results["keying"] = measure(lambda: keying.remove_black_background(shot, 50), repeat)
+    results["keying_soft"] = measure(lambda: keying.remove_black_background(shot, 50, softness=32), repeat)
+
+    box = autocrop.find_chat_block(shot)
+    results["crop"] = measure(lambda: keyed.crop(autocrop.find_chat_block(shot)), repeat)
+
+    chat = keyed.crop(box)
+    outlined = outline.add_outline(chat, 1)
+    results["outline"] = measure(lambda: outline.add_outline(chat, 1), repeat)
+    results["outline_soft"] = measure(lambda: outline.add_outline(chat, 2, softness=2), repeat)
+
+    results["snapping"] = measure(lambda: snapping.ContentInfo(outlined), repeat)
+
+    results["compositing"] = measure(lambda: compose_frame(size, background, (0, 0), outlined, (20, 20)), repeat)
+    results["compositing_alpha"] = measure(
+        lambda: compose_frame(size, background, (0, 0), outlined, (20, 20), transparent=True), repeat)
+
+    # The app's cached composite: one of three chat blocks moves between saves
+    stack = LayerStack(size)
+    moves = iter(range(10 ** 6))
+
+    def move_block():
+        x = 20 + next(moves) % 40
+        stack.composite([Layer(background, key="bg", background=True), Layer(outlined, 20, 20, key="a"),
+                         Layer(outlined, size[0] // 2, 20, opacity=0.7, key="b"), Layer(outlined, x, size[1] // 2, key="c")])
+    move_block()
+    results["compositing_move"] = measure(move_block, repeat)
+
+    results["history"] = measure(lambda: history_edits(outlined, 1), repeat)
+
+    frame = compose_frame(size, background, (0, 0), outlined, (20, 20))
+    for ext in ("png", "jpg", "webp"):
+        path = os.path.join(directory, f"frame.{ext}")
+        results[f"encode_{ext}"] = measure(lambda: encoding.save(frame, path), repeat)
+
+    spool = FrameSpool(os.path.join(directory, "spool"))
+    os.makedirs(spool.directory, exist_ok=True)
+    try:
+        frames = spool_collage(spool, size, lines, background)
+        for ext in ("png", "jpg"):
+            path = os.path.join(directory, f"collage.{ext}")
+            results[f"stitch_{ext}"] = measure(lambda: stitch_vertical(frames, path), repeat)
+    finally:
+        spool.close()
+    return results
+
+
+def run(resolutions, line_counts, repeat, progress=print):
+    report = {
+        "meta": {
+            "date": datetime.datetime.now().isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "pillow": PIL.__version__,
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "repeat": repeat,
+            "perf_enabled": perf.ENABLED,  # Instrumentation adds its own overhead
+        },
+        "results": {},
+    }
+    with tempfile.TemporaryDirectory(prefix="sosiska-bench-") as directory:
+        for name in resolutions:
+            for lines in line_counts:
+                case = f"{name}/{lines}"
+                progress(f"{case}...")
+                for stage, result in run_case(synthetic.RESOLUTIONS[name], lines, repeat, directory).items():
+                    report["results"][f"{case}/{stage}"] = result
+    return report
+
+
+def compare(report, baseline, threshold=THRESHOLD):
+    # [(key, baseline ms, current ms, ratio, status)] for the keys both have
+    rows = []
+    for key, result in report["results"].items():
+        old = baseline["results"].get(key)
+        if old is None:
+            continue
+        before, after = old["best_ms"], result["best_ms"]
+        ratio = after / before if before else 1.0
+        status = ""
+        if abs(after - before) >= MIN_DELTA_MS:
+            if ratio > 1 + threshold:
+                status = "медленнее"
+            elif ratio < 1 - threshold:
+                status = "быстрее"
+        rows.append((key, before, after, ratio, status))
+    return rows
+
+
+def print_report(report):
+    print(f"{'stage':<28} {'best, ms':>10} {'median, ms':>11}")
+    for key, result in report["results"].items():
+        print(f"{key:<28} {result['best_ms']:>10.2f} {result['median_ms']:>11.2f}")
+
+
+def print_comparison(rows):
+    print(f"{'stage':<28} {'base, ms':>10} {'now, ms':>10} {'ratio':>7}")
+    for key, before, after, ratio, status in rows:
+        print(f"{key:<28} {before:>10.2f} {after:>10.2f} {ratio:>6.2f}x {status}")
+
+
+def load_report(path):
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)
+
+
+def save_report(report, path):
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Pipeline benchmark")
+    parser.add_argument("--resolutions", default=",".join(synthetic.RESOLUTIONS),
+                        help="через запятую: " + ", ".join(synthetic.RESOLUTIONS))
+    parser.add_argument("--lines", default=",".join(map(str, LINE_COUNTS)), help="число строк чата, через запятую")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--quick", action="store_true", help="только 720p, 10 строк, 3 прогона")
+    parser.add_argument("--out", help="сохранить отчёт в JSON")
+    parser.add_argument("--save-baseline", metavar="PATH", help="сохранить отчёт как эталон")
+    parser.add_argument("--baseline", metavar="PATH", help="сравнить с эталоном")
+    parser.add_argument("--threshold", type=float, default=THRESHOLD, help="допустимое замедление, доля (0.1 = 10%%)")
+    args = parser.parse_args()
+
+    if args.quick:
+        resolutions, line_counts, repeat = ["720p"], [10], 3
+    else:
+        resolutions = [name.strip() for name in args.resolutions.split(",") if name.strip()]
+        line_counts = [int(n) for n in args.lines.split(",") if n.strip()]
+        repeat = args.repeat
+    unknown = [name for name in resolutions if name not in synthetic.RESOLUTIONS]
+    if unknown:
+        parser.error(f"неизвестное разрешение: {', '.join(unknown)}")
+
+    report = run(resolutions, line_counts, repeat)
+    print_report(report)
+    for path in (args.out, args.save_baseline):
+        if path:
+            save_report(report, path)
+
+    if args.baseline:
+        rows = compare(report, load_report(args.baseline), args.threshold)
+        print()
+        print_comparison(rows)
+        if any(status == "медленнее" for *_, status in rows):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,105 @@
+# Startup benchmark: time to first paint of the app, in fresh processes.
+# Every run starts `python SoSiska.py` with SOSISKA_STARTUP pointing at a temp
+# JSON file and SOSISKA_STARTUP_QUIT=1, so the app reports its marks (imports,
+# tk, ui, first_paint) and closes itself (see startup.py). Without a display
+# only the imports are measured, in a process that imports the app module.
+# Best and median of every mark go into the same report format as
+# bench_pipeline, --baseline compares and exits with 1 on a regression.
+# Run from the repo root:
+#   python -m benchmarks.bench_startup [--repeat 10] [--out report.json]
+#   python -m benchmarks.bench_startup --baseline baseline.json [--threshold 0.1]
+import argparse
+import datetime
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+
+from benchmarks.bench_pipeline import THRESHOLD, compare, load_report, print_comparison, print_report, save_report
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+IMPORT_ONLY = "import SoSiska, startup; startup.mark('imports'); startup.write_report()"
+TIMEOUT = 60
+
+
+def run_once(args, path):
+    # The startup report of one run, None if the app couldn't start (no display)
+    env = dict(os.environ, SOSISKA_STARTUP=path, SOSISKA_STARTUP_QUIT="1")
+    try:
+        subprocess.run([sys.executable] + args, cwd=ROOT, env=env, timeout=TIMEOUT,
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        with open(path, encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError, subprocess.TimeoutExpired):
+        return None
+    finally:
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def summarize(values):
+    return {"best_ms": round(min(values), 3), "median_ms": round(statistics.median(values), 3), "runs": len(values)}
+
+
+def run(repeat, window=True, progress=print):
+    report = {
+        "meta": {
+            "date": datetime.datetime.now().isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "repeat": repeat,
+        },
+        "results": {},
+    }
+    with tempfile.TemporaryDirectory(prefix="sosiska-startup-") as directory:
+        path = os.path.join(directory, "startup.json")
+        cases = [("import", ["-c", IMPORT_ONLY])]
+        if window:
+            cases.insert(0, ("window", ["SoSiska.py"]))
+        for case, args in cases:
+            progress(f"{case}...")
+            runs = [run_once(args, path) for _ in range(repeat)]
+            runs = [data for data in runs if data]
+            if not runs:
+                progress(f"{case}: не запустилось (нет дисплея?)")
+                continue
+            for mark in runs[0]["marks_ms"]:
+                report["results"][f"{case}/{mark}"] = summarize([data["marks_ms"][mark] for data in runs])
+            if all(data["process_ms"] is not None for data in runs):
+                # Interpreter start (and unpacking when frozen): shown, not compared, the clock ticks are 10 ms
+                report.setdefault("process_ms", {})[case] = summarize([data["process_ms"] for data in runs])
+            report["imports_ms"] = runs[0]["imports_ms"]
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Startup benchmark")
+    parser.add_argument("--repeat", type=int, default=10)
+    parser.add_argument("--no-window", action="store_true", help="только импорт, без окна")
+    parser.add_argument("--out", help="сохранить отчёт в JSON")
+    parser.add_argument("--save-baseline", metavar="PATH", help="сохранить отчёт как эталон")
+    parser.add_argument("--baseline", metavar="PATH", help="сравнить с эталоном")
+    parser.add_argument("--threshold", type=float, default=THRESHOLD, help="допустимое замедление, доля (0.1 = 10%%)")
+    args = parser.parse_args()
+
+    report = run(args.repeat, not args.no_window)
+    print_report(report)
+    for case, result in report.get("process_ms", {}).items():
+        print(f"{case}: процесс до первого импорта {result['median_ms']:.0f} мс")
+    for path in (args.out, args.save_baseline):
+        if path:
+            save_report(report, path)
+
+    if args.baseline:
+        rows = compare(report, load_report(args.baseline), args.threshold)
+        print()
+        print_comparison(rows)
+        if any(status == "медленнее" for *_, status in rows):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
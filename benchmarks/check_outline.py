@@ -0,0 +1,60 @@
+# Outline check: outline.dilate and add_outline against Pillow's MaxFilter.
+# The log-step dilation must give exactly MaxFilter(2*radius+1), also for
+# content that touches the image edges and across the parallel bands of a big
+# image. Exits with 1 on a mismatch.
+# Run from the repo root:  python -m benchmarks.check_outline
+import random
+import sys
+
+from PIL import Image, ImageChops, ImageFilter
+
+import outline
+
+RADII = (1, 2, 3, 4, 5, 8)
+SIZES = ((1, 1), (7, 3), (41, 29), (256, 64), (1920, 1200))
+
+
+def make_mask(size, seed):
+    # Random dots, with the four corners and the middle of every edge set
+    rng = random.Random(seed)
+    mask = Image.new("L", size, 0)
+    w, h = size
+    points = [(0, 0), (w - 1, 0), (0, h - 1), (w - 1, h - 1),
+              (w // 2, 0), (w // 2, h - 1), (0, h // 2), (w - 1, h // 2)]
+    points += [(rng.randrange(w), rng.randrange(h)) for _ in range(max(4, w * h // 2000))]
+    for point in points:
+        mask.putpixel(point, rng.randrange(1, 256))
+    return mask
+
+
+def reference_outline(img, radius):
+    mask = img.getchannel("A").filter(ImageFilter.MaxFilter(2 * radius + 1))
+    result = Image.new("RGBA", img.size, (0, 0, 0, 0))
+    result.putalpha(mask)
+    return Image.alpha_composite(result, img)
+
+
+def same(a, b):
+    return ImageChops.difference(a, b).getbbox() is None
+
+
+def main():
+    failed = []
+    for size in SIZES:
+        mask = make_mask(size, seed=size[0] * size[1])
+        img = Image.new("RGBA", size, (255, 255, 255, 0))
+        img.putalpha(mask)
+        for radius in RADII:
+            if not same(outline.dilate(mask, radius), mask.filter(ImageFilter.MaxFilter(2 * radius + 1))):
+                failed.append(f"dilate {size[0]}x{size[1]} r={radius}")
+            if not same(outline.add_outline(img, radius), reference_outline(img, radius)):
+                failed.append(f"add_outline {size[0]}x{size[1]} r={radius}")
+    for case in failed:
+        print(f"не совпадает: {case}")
+    print("ok" if not failed else f"ошибок: {len(failed)}")
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
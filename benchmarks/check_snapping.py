@@ -0,0 +1,35 @@
+# Snapping check: text baselines of outlined chats.
+# A synthetic chat is keyed and outlined with growing radii, ContentInfo must
+# find every line of it each time - thick outlines used to glue the lines
+# together in the alpha. Exits with 1 on a mismatch.
+# Run from the repo root:  python -m benchmarks.check_snapping
+import sys
+
+import keying
+import outline
+from benchmarks.synthetic import make_screenshot
+from snapping import ContentInfo
+
+LINES = 15
+RADII = (0, 1, 2, 3, 4, 5)
+
+
+def main():
+    chat = keying.remove_black_background(make_screenshot((800, 400), lines=LINES))
+    expected = ContentInfo(chat).baselines
+    failed = []
+    if len(expected) != LINES:
+        failed.append(f"без обводки найдено строк: {len(expected)} из {LINES}")
+    for radius in RADII:
+        found = ContentInfo(outline.add_outline(chat, radius) if radius else chat).baselines
+        if found != expected:
+            failed.append(f"радиус {radius}: найдено строк {len(found)} из {len(expected)}")
+    for case in failed:
+        print(f"не совпадает: {case}")
+    print("ok" if not failed else f"ошибок: {len(failed)}")
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
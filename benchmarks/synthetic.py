@@ -0,0 +1,68 @@
+# Synthetic test images for the benchmarks.
+# Everything is generated from a seed, so the same arguments give the same
+# pixels on every machine: a chat log of colored lines, screenshots of it on
+# a black background (anti-aliased text in Pillow's bundled FreeType font,
+# not a system one) and a photo-like background to composite the chat on.
+import random
+
+from PIL import Image, ImageDraw, ImageFont
+
+RESOLUTIONS = {
+    "720p": (1280, 720),
+    "1080p": (1920, 1080),
+    "4K": (3840, 2160),
+}
+COLORS = [(255, 255, 255), (255, 255, 0), (170, 170, 255), (255, 99, 71), (51, 204, 51)]
+FONT_SIZE = 14
+LINE_SPACING = 2
+MARGIN = 10
+
+_fonts = {}
+
+
+def font(size=FONT_SIZE):
+    if size not in _fonts:
+        _fonts[size] = ImageFont.load_default(size)
+    return _fonts[size]
+
+
+def chat_log(count, seed=0):
+    # [(color, text)] lines, names and words repeat like in a real chat
+    rnd = random.Random(seed)
+    names = ["".join(rnd.choice("abcdefghijklmnopqrstuvwxyz") for _ in range(rnd.randint(4, 10))).title() + "_"
+             + "".join(rnd.choice("abcdefghijklmnopqrstuvwxyz") for _ in range(rnd.randint(4, 10))).title()
+             for _ in range(12)]
+    words = ["".join(rnd.choice("abcdefghijklmnopqrstuvwxyz") for _ in range(rnd.randint(2, 9))) for _ in range(200)]
+    log = []
+    for _ in range(count):
+        text = f"{rnd.choice(names)} говорит: " + " ".join(rnd.choice(words) for _ in range(rnd.randint(3, 14)))
+        log.append((rnd.choice(COLORS), text))
+    return log
+
+
+def line_height(size=FONT_SIZE):
+    ascent, descent = font(size).getmetrics()
+    return ascent + descent + LINE_SPACING
+
+
+def max_lines(size, font_size=FONT_SIZE):
+    return (size[1] - 2 * MARGIN) // line_height(font_size)
+
+
+def make_screenshot(size, lines=30, seed=0, offset=0, font_size=FONT_SIZE):
+    # Black frame with `lines` lines of the chat log from `offset` in the top-left corner.
+    # Frames with growing offsets look like screenshots of a scrolling chat
+    lines = min(lines, max_lines(size, font_size))
+    img = Image.new("RGB", size, "black")
+    draw = ImageDraw.Draw(img)
+    step = line_height(font_size)
+    for i, (color, text) in enumerate(chat_log(offset + lines, seed)[offset:]):
+        draw.text((MARGIN, MARGIN + i * step), text, fill=color, font=font(font_size))
+    return img
+
+
+def make_background(size, seed=0):
+    # Smooth colored noise, compresses about as badly as a game screenshot
+    rnd = random.Random(seed)
+    small = (max(1, size[0] // 16), max(1, size[1] // 16))
+    return Image.frombytes("RGB", small, rnd.randbytes(small[0] * small[1] * 3)).resize(size, Image.Resampling.BICUBIC)
@@ -4,9 +4,9 @@ block_cipher = None
 a = Analysis(
     ['SoSiska.py'],
     binaries=[],
-    datas=[
-        ('C:/Python39/Lib/site-packages/PIL/', 'PIL')  #   Pillow
-    ],
+    # Pillow   PyInstaller:   ,     PIL
+    # ( one-file        )
+    datas=[],
     hiddenimports=[
         'PIL._tkinter_finder',
         'tkinter',
@@ -15,7 +15,7 @@ a = Analysis(
     ],
     hookspath=[],
     runtime_hooks=[],
-    excludes=[],
+    excludes=['numpy', 'PIL.ImageQt', 'PyQt5', 'PyQt6', 'PySide2', 'PySide6'],
     win_no_prefer_redirects=False,
     win_private_assemblies=False,
     cipher=block_cipher,
@@ -34,7 +34,7 @@ exe = EXE(
     debug=False,
     bootloader_ignore_signals=False,
     strip=False,
-    upx=True,
+    upx=False,  #  UPX   
     upx_exclude=[],
     runtime_tmpdir=None,
     console=False,  #  
@@ -0,0 +1,206 @@
+import re
+import threading
+from collections import OrderedDict
+
+from PIL import Image, ImageColor, ImageDraw, ImageFilter, ImageFont
+
+import outline
+import perf
+
+# Chat rendered straight from SA-MP's chatlog.txt.
+# Instead of a screenshot with the black background keyed out, the lines of
+# the log ("[12:34:56] {FF0000}text {FFFFFF}more") are drawn with their color
+# codes. Every character is rendered by FreeType once into a glyph atlas
+# (its mask and its dilated outline mask). Words are put together from the
+# atlas glyphs into outlined sprites in their color and kept in an LRU, since
+# chat logs repeat names, tags and phrases all the time, so a line costs one
+# paste per word instead of two per glyph - in Pillow the per-call overhead
+# of a paste outweighs the few pixels a glyph has. The result is transparent
+# between the letters and already outlined, like a keyed and outlined
+# screenshot.
+
+FONT_NAMES = ("arialbd.ttf", "Arial Bold.ttf", "Arial_Bold.ttf", "DejaVuSans-Bold.ttf", "LiberationSans-Bold.ttf")
+FONT_SIZE = 16
+LINE_SPACING = 2
+PADDING = 2
+DEFAULT_COLOR = "#FFFFFF"
+WORD_CACHE_SIZE = 20000
+ENCODINGS = ("utf-8-sig", "cp1251")  # Russian servers write the log in cp1251
+
+COLOR_CODE = re.compile(r"\{([0-9A-Fa-f]{6})\}")
+TIMESTAMP = re.compile(r"^\[\d{1,2}:\d{2}:\d{2}\]\s?")
+
+_atlases = {}
+_atlas_lock = threading.Lock()  # The loader has more than one thread
+
+
+def load_font(size=FONT_SIZE):
+    # Bold Arial like the game's chat, whatever bold sans is installed otherwise
+    for name in FONT_NAMES:
+        try:
+            return ImageFont.truetype(name, size)
+        except OSError:
+            pass
+    return ImageFont.load_default(size)
+
+
+def read_chatlog(path, last=None, timestamps=False):
+    with open(path, "rb") as f:
+        data = f.read()
+    for name in ENCODINGS:
+        try:
+            text = data.decode(name)
+            break
+        except UnicodeDecodeError:
+            pass
+    else:
+        text = data.decode("cp1251", errors="replace")
+
+    lines = [line for line in text.splitlines() if line.strip()]
+    if last:
+        lines = lines[-last:]
+    if not timestamps:
+        lines = [TIMESTAMP.sub("", line) for line in lines]
+    return lines
+
+
+def parse_line(line, color):
+    # [(rgb, text)] runs; a {RRGGBB} code changes the color until the next one
+    segments = []
+    position = 0
+    for match in COLOR_CODE.finditer(line):
+        if match.start() > position:
+            segments.append((color, line[position:match.start()]))
+        color = tuple(bytes.fromhex(match.group(1)))
+        position = match.end()
+    if position < len(line):
+        segments.append((color, line[position:]))
+    return segments
+
+
+class GlyphAtlas:
+    def __init__(self, font, outline_radius=1, outline_softness=0, max_words=WORD_CACHE_SIZE):
+        self.font = font
+        self.outline_radius = outline_radius
+        self.outline_softness = outline_softness
+        self.margin = outline_radius + outline_softness * 3
+        ascent, descent = font.getmetrics()
+        self.height = ascent + descent
+        self.max_words = max_words
+        self.glyphs = {}
+        self.words = OrderedDict()
+
+    def glyph(self, char):
+        # (advance, x offset, mask, outline mask); masks are None for blank characters.
+        # Masks have the margin for the outline on every side
+        glyph = self.glyphs.get(char)
+        if glyph is None:
+            advance = self.font.getlength(char)
+            left, _, right, _ = self.font.getbbox(char)
+            if right <= left:
+                glyph = (advance, 0, None, None)
+            else:
+                m = self.margin
+                left = min(0, left)
+                mask = Image.new("L", (right - left + 2 * m, self.height + 2 * m), 0)
+                ImageDraw.Draw(mask).text((m - left, m), char, font=self.font, fill=255)
+                halo = outline.dilate(mask, self.outline_radius)
+                if self.outline_softness > 0:
+                    halo = halo.filter(ImageFilter.GaussianBlur(self.outline_softness))
+                glyph = (advance, left - m, mask, halo)
+            self.glyphs[char] = glyph
+        return glyph
+
+    def word(self, text, rgb, outline_fill):
+        # (advance, x offset, sprite) of an outlined word in one color, put together from glyphs
+        key = (text, rgb, outline_fill)
+        word = self.words.get(key)
+        if word is not None:
+            self.words.move_to_end(key)
+            return word
+
+        placed = []
+        x = 0
+        for char in text:
+            advance, dx, mask, halo = self.glyph(char)
+            if mask is not None:
+                placed.append((round(x) + dx, mask, halo))
+            x += advance
+        if not placed:
+            return x, 0, None
+        left = min(px for px, _, _ in placed)
+        right = max(px + mask.width for px, mask, _ in placed)
+
+        size = (right - left, self.height + 2 * self.margin)
+        mask = Image.new("L", size, 0)
+        halo = Image.new("L", size, 0)
+        for px, glyph_mask, glyph_halo in placed:
+            mask.paste(glyph_mask, (px - left, 0), glyph_mask)
+            halo.paste(glyph_halo, (px - left, 0), glyph_halo)
+        sprite = Image.new("RGBA", size, outline_fill)
+        sprite.putalpha(halo)
+        sprite.paste(rgb + (255,), (0, 0) + size, mask)
+
+        word = (x, left, sprite)
+        self.words[key] = word
+        if len(self.words) > self.max_words:
+            self.words.popitem(last=False)
+        return word
+
+    def space(self):
+        return self.glyph(" ")[0]
+
+
+def get_atlas(font_size=FONT_SIZE, outline_radius=1, outline_softness=0):
+    key = (font_size, outline_radius, outline_softness)
+    if key not in _atlases:
+        _atlases[key] = GlyphAtlas(load_font(font_size), outline_radius, outline_softness)
+    return _atlases[key]
+
+
+def layout(parsed, atlas, outline_fill):
+    # [(x, line index, sprite)] and the widest line
+    placed = []
+    width = 0
+    space = atlas.space()
+    for i, segments in enumerate(parsed):
+        x = 0
+        for rgb, text in segments:
+            for n, word in enumerate(text.split(" ")):
+                if n:
+                    x += space
+                if word:
+                    advance, dx, sprite = atlas.word(word, rgb, outline_fill)
+                    if sprite is not None:
+                        placed.append((round(x) + dx, i, sprite))
+                    x += advance
+        width = max(width, x)
+    return placed, width
+
+
+def render_lines(lines, atlas, color=DEFAULT_COLOR, outline_color="black"):
+    default = ImageColor.getcolor(color, "RGB") if isinstance(color, str) else tuple(color)
+    outline_fill = ImageColor.getcolor(outline_color, "RGB") if isinstance(outline_color, str) else tuple(outline_color[:3])
+    placed, width = layout([parse_line(line, default) for line in lines], atlas, outline_fill)
+
+    offset = PADDING + atlas.margin
+    line_height = atlas.height + LINE_SPACING
+    size = (int(width) + 1 + 2 * offset, len(lines) * line_height - LINE_SPACING + 2 * offset)
+    image = Image.new("RGBA", size, (0, 0, 0, 0))
+    composite = image.alpha_composite
+    for x, i, sprite in placed:
+        # "Over" compositing: edge alpha stays as drawn (a paste with the sprite as its own mask
+        # would square it), and overlapping sprites blend instead of cutting into each other
+        composite(sprite, (offset + x, PADDING + i * line_height))
+    return image
+
+
+@perf.timed("render_chatlog")
+def render_chatlog(path, last=None, font_size=FONT_SIZE, outline_radius=1, outline_color="black",
+                   outline_softness=0, timestamps=False):
+    lines = read_chatlog(path, last, timestamps)
+    if not lines:
+        raise ValueError("в чатлоге нет строк")
+    with _atlas_lock:
+        atlas = get_atlas(font_size, outline_radius, outline_softness)
+        return render_lines(lines, atlas, outline_color=outline_color)
@@ -0,0 +1,188 @@
+import hashlib
+import json
+import os
+import struct
+import threading
+import zlib
+
+from PIL import Image, ImageColor
+
+# Processed chat images cached on disk between runs.
+# A processed image is described by its "source": the hash of the screenshot
+# file followed by the operations applied to it, in order, with their
+# parameters - (("file", digest), ("key", 50, 0), ("crop", 0, 0, 600, 200),
+# ("outline", 1, "#000000", 0)). The cache key is a hash of that chain, so
+# reopening or re-batching the same screenshot with the same settings gets
+# the result back without decoding, keying or outlining anything; a changed
+# file gets a new digest and never hits an old entry. Edits that can't be
+# described (erasing) end the chain (None) and such images aren't cached.
+# Operations are written one way whoever adds them: a crop is the box that was
+# actually cut out (clamped, "auto" resolved), a colour is "#rrggbb" - so the
+# app, batch, the watcher and the server find each other's entries.
+# Entries are raw pixels deflated at level 1, least recently used ones are
+# deleted once the directory grows over max_bytes. A hit touches the file's
+# mtime, which the eviction sorts by. Cache errors are never fatal, the
+# caller just does the work.
+
+FORMAT = 1  # Part of every key: bump when keying/cropping/outlining change their output
+MAX_BYTES = 512 * 1024 * 1024
+MAGIC = b"SSC1"
+HEADER = struct.Struct(">4s4sII")  # magic, mode, width, height
+SUFFIX = ".ssc"
+COMPRESS_LEVEL = 1
+
+_digests = {}  # (path, size, mtime) -> digest, a file isn't hashed twice while unchanged
+_digests_lock = threading.Lock()
+
+
+def default_directory():
+    root = os.environ.get("LOCALAPPDATA") or os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(root, "SoSiska", "cache")
+
+
+def file_digest(path):
+    stat = os.stat(path)
+    memo = (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+    with _digests_lock:
+        if memo in _digests:
+            return _digests[memo]
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+    with _digests_lock:
+        _digests[memo] = digest.hexdigest()
+    return _digests[memo]
+
+
+def file_source(path):
+    return (("file", file_digest(path)),)
+
+
+def derive(source, *op):
+    # The source of `source` with one more operation; None stays None
+    return source + (op,) if source is not None else None
+
+
+def crop_source(source, box):
+    # box: the (x1, y1, x2, y2) actually cut out of the image
+    return derive(source, "crop", *(int(v) for v in box))
+
+
+def color_key(color):
+    # "black", "#000" and (0, 0, 0) are the same outline
+    rgb = ImageColor.getrgb(color) if isinstance(color, str) else tuple(color)
+    if len(rgb) == 4 and rgb[3] == 255:
+        rgb = rgb[:3]
+    return "#" + "".join(f"{v:02x}" for v in rgb)
+
+
+def outline_source(source, radius, color, softness):
+    return derive(source, "outline", radius, color_key(color), softness)
+
+
+def source_key(source):
+    return hashlib.blake2b(json.dumps([FORMAT] + [list(op) for op in source]).encode(), digest_size=20).hexdigest()
+
+
+class DiskCache:
+    def __init__(self, directory=None, max_bytes=MAX_BYTES):
+        self.directory = directory or default_directory()
+        self.max_bytes = max_bytes
+        self.total = None  # Bytes in the directory, counted on the first put
+        self.lock = threading.Lock()  # Loader threads and the Tk thread share the app's cache
+
+    def path(self, source):
+        return os.path.join(self.directory, source_key(source) + SUFFIX)
+
+    def get(self, source):
+        if source is None:
+            return None
+        path = self.path(source)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+            magic, mode, width, height = HEADER.unpack_from(data)
+            if magic != MAGIC:
+                return None
+            image = Image.frombytes(mode.decode().strip(), (width, height), zlib.decompress(data[HEADER.size:]))
+            os.utime(path)
+            return image
+        except (OSError, ValueError, struct.error, zlib.error):
+            return None
+
+    def put(self, source, image):
+        if source is None or image.mode not in ("L", "LA", "RGB", "RGBA"):
+            return
+        path = self.path(source)
+        data = HEADER.pack(MAGIC, image.mode.ljust(4).encode(), image.width, image.height) + \
+            zlib.compress(image.tobytes(), COMPRESS_LEVEL)
+        temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            with open(temp_path, "wb") as f:
+                f.write(data)
+            os.replace(temp_path, path)
+        except OSError:
+            try:
+                os.remove(temp_path)
+            except OSError:
+                pass
+            return
+        with self.lock:
+            if self.total is None:
+                self.total = self.usage()
+            else:
+                self.total += len(data)
+            if self.total > self.max_bytes:
+                self.evict()
+
+    def cached(self, source, compute):
+        # compute() when there is no entry, the result is stored
+        image = self.get(source)
+        if image is None:
+            image = compute()
+            self.put(source, image)
+        return image
+
+    def entries(self):
+        # [(mtime, size, path)] of the cache files
+        found = []
+        try:
+            names = os.listdir(self.directory)
+        except OSError:
+            return found
+        for name in names:
+            if name.endswith(SUFFIX):
+                path = os.path.join(self.directory, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue  # Evicted by another process meanwhile
+                found.append((stat.st_mtime, stat.st_size, path))
+        return found
+
+    def usage(self):
+        return sum(size for _, size, _ in self.entries())
+
+    def evict(self):
+        # Oldest first down to 90% of the limit, so not every put has to evict
+        entries = sorted(self.entries())
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if total <= self.max_bytes * 0.9:
+                break
+            try:
+                os.remove(path)
+                total -= size
+            except OSError:
+                pass
+        self.total = total
+
+    def clear(self):
+        for _, _, path in self.entries():
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        self.total = 0
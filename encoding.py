@@ -0,0 +1,76 @@
+import os
+
+from PIL import Image
+
+# Output formats and encoder settings.
+# One options dict (see DEFAULT_OPTIONS) is used for single frames, collages
+# and batch mode, save_kwargs() picks what the chosen format understands.
+# Formats without alpha (and any export that doesn't ask for transparency)
+# get the image flattened onto white by alpha compositing, never by dropping
+# the alpha channel.
+
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg", ".bmp")  # Screenshots picked up by batch mode and the watcher
+FORMATS = {".png": "PNG", ".jpg": "JPEG", ".jpeg": "JPEG", ".webp": "WEBP", ".bmp": "BMP"}
+ALPHA_FORMATS = ("PNG", "WEBP")
+MAX_SIDE = {"JPEG": 65500, "WEBP": 16383}
+
+DEFAULT_OPTIONS = {
+    "png_compress_level": 6,
+    "jpeg_quality": 90,
+    "jpeg_progressive": True,
+    "jpeg_optimize": True,
+    "jpeg_subsampling": 0,  # 4:4:4, colored chat text smears with 4:2:0
+    "webp_quality": 90,
+    "webp_lossless": False,
+    "transparent": False,  # Keep alpha where there is no background (PNG, WebP)
+    "merge_overlap": True,  # Collages: leave out chat lines repeated from the previous frame
+}
+
+
+def image_format(path):
+    ext = os.path.splitext(path)[1].lower()
+    if ext not in FORMATS:
+        raise ValueError(f"неизвестный формат файла: {ext or path}")
+    return FORMATS[ext]
+
+
+def export_options(options=None):
+    merged = dict(DEFAULT_OPTIONS)
+    if options:
+        merged.update(options)
+    return merged
+
+
+def save_kwargs(fmt, options=None):
+    options = export_options(options)
+    if fmt == "PNG":
+        return {"compress_level": options["png_compress_level"]}
+    if fmt == "JPEG":
+        return {"quality": options["jpeg_quality"], "progressive": options["jpeg_progressive"],
+                "optimize": options["jpeg_optimize"], "subsampling": options["jpeg_subsampling"]}
+    if fmt == "WEBP":
+        return {"quality": options["webp_quality"], "lossless": options["webp_lossless"]}
+    return {}
+
+
+def flatten(image, color="white"):
+    if image.mode == "RGB":
+        return image
+    if "A" not in image.getbands() and "transparency" not in image.info:
+        return image.convert("RGB")
+    rgba = image.convert("RGBA")
+    flat = Image.new("RGB", image.size, color)
+    flat.paste(rgba, (0, 0), rgba)
+    return flat
+
+
+def prepare(image, fmt, options=None):
+    if export_options(options)["transparent"] and fmt in ALPHA_FORMATS and image.mode == "RGBA":
+        return image
+    return flatten(image)
+
+
+def save(image, path, options=None):
+    fmt = image_format(path)
+    prepare(image, fmt, options).save(path, fmt, **save_kwargs(fmt, options))
+    return path
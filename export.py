@@ -0,0 +1,110 @@
+import os
+import queue
+from concurrent.futures import ThreadPoolExecutor
+
+import encoding
+import perf
+from layers import LayerStack, canvas_layers
+from stitch import stitch_vertical
+
+# Export off the Tk thread.
+# The app hands the Exporter a task with what has to be saved - the canvas
+# layers (layers.py), composited on the export thread in a LayerStack of its
+# own, or spooled memory frames. Tasks run one after another on a single
+# export thread, so files are written in the order they were requested; a task may use more
+# threads for encoding (PNG bands, collage parts). Progress and results come
+# back through a queue polled with after(), callbacks run on the Tk thread.
+
+POLL_MS = 50
+ENCODE_WORKERS = max(1, min(4, os.cpu_count() or 1))
+
+
+def compose_frame(canvas, background, bg_pos, chat, chat_pos, scale=1.0, transparent=False):
+    # One-off frame: white canvas, background, chat over it with its alpha.
+    # transparent=True starts from a transparent canvas and alpha-composites
+    # the layers instead (PNG/WebP without background)
+    layers = canvas_layers(background, bg_pos, scale, chat=chat, chat_pos=chat_pos)
+    return LayerStack(canvas).composite(layers, transparent, copy=False)
+
+
+def wants_transparency(path, options=None):
+    return encoding.export_options(options)["transparent"] and encoding.image_format(path) in encoding.ALPHA_FORMATS
+
+
+@perf.timed("export_frame")
+def export_frame(frame, path, options=None, progress=None):
+    # frame: composited already, see wants_transparency()
+    if progress:
+        progress(0, 1)
+    encoding.save(frame, path, options)
+    if progress:
+        progress(1, 1)
+    return [path]
+
+
+def export_layers(stack, size, layers, path, options=None, progress=None):
+    # Export thread: `layers` flattened in `stack` (only used by exports) and saved
+    stack.resize(size)
+    frame = stack.composite(layers, wants_transparency(path, options), copy=False)
+    return export_frame(frame, path, options, progress)
+
+
+@perf.timed("export_collage")
+def export_collage(frames, path, options=None, progress=None, workers=ENCODE_WORKERS):
+    encoding.image_format(path)
+    return stitch_vertical(frames, path, progress=progress, options=options, workers=workers)
+
+
+class Exporter:
+    def __init__(self, master):
+        self.master = master
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sosiska-export")
+        self.results = queue.Queue()
+        self.pending = 0
+        self.polling = False
+
+    def submit(self, task, on_done, on_progress=None, on_error=None):
+        # task(progress) runs on the export thread and returns the result for on_done(result);
+        # on_progress(done, total) gets the latest progress at most once per poll
+        self.pending += 1
+        self.executor.submit(self._work, task, on_done, on_progress, on_error)
+        if not self.polling:
+            self.polling = True
+            self.master.after(POLL_MS, self._poll)
+
+    def _work(self, task, on_done, on_progress, on_error):
+        def progress(done, total):
+            self.results.put((on_progress, (done, total), False))
+        try:
+            self.results.put((on_done, (task(progress),), True))
+        except Exception as e:
+            self.results.put((on_error, (e,), True))
+
+    def busy(self):
+        return self.pending > 0
+
+    def _poll(self):
+        latest = None  # Only the newest progress is shown, and never after its task is done
+        while True:
+            try:
+                callback, args, final = self.results.get_nowait()
+            except queue.Empty:
+                break
+            if not final:
+                latest = (callback, args)
+                continue
+            latest = None
+            self.pending -= 1
+            if callback:
+                callback(*args)
+        if latest and latest[0]:
+            latest[0](*latest[1])
+
+        if self.pending:
+            self.master.after(POLL_MS, self._poll)
+        else:
+            self.polling = False
+
+    def shutdown(self, wait=True):
+        # Started exports are finished (a half-written file is worse than a slow exit), queued ones dropped
+        self.executor.shutdown(wait=wait, cancel_futures=True)
@@ -0,0 +1,184 @@
+# Undo/redo history.
+# Images are never copied on save: an entry keeps a reference to the image if it
+# is a new object (keyframe), a "same as before" marker if nothing changed,
+# only the changed tile for in-place edits (erase) and only the box for crops.
+# Images referenced by history must not be changed in place - check is_shared()
+# and copy first. Old entries are dropped once the history grows past `budget` bytes.
+
+DEFAULT_BUDGET = 256 * 1024 * 1024
+IMAGE_FIELDS = ("bg_image", "chat_image")
+LIST_FIELDS = ("memory",)
+
+
+class _Full:
+    def __init__(self, image):
+        self.image = image
+
+
+class _Same:
+    pass
+
+
+class _Patch:
+    # previous image with `tile` pasted at `box`
+    def __init__(self, box, tile):
+        self.box = box
+        self.tile = tile
+
+
+class _Crop:
+    # previous image cropped to `box`
+    def __init__(self, box):
+        self.box = box
+
+
+SAME = _Same()
+
+
+def image_nbytes(img):
+    # Spooled memory frames (spool.py) live on disk and don't count
+    if not hasattr(img, "getbands"):
+        return 0
+    return img.width * img.height * len(img.getbands())
+
+
+class History:
+    def __init__(self, budget=DEFAULT_BUDGET):
+        self.budget = budget
+        self.entries = []
+        self.index = -1
+        self._last = {}  # field -> image object the current entry resolves to
+
+    def __len__(self):
+        return len(self.entries)
+
+    def can_undo(self):
+        return self.index > 0
+
+    def can_redo(self):
+        return self.index < len(self.entries) - 1
+
+    def push(self, state, dirty=None):
+        # dirty: {field: ("patch", box) | ("crop", box)} for edits made relative to the previous image
+        dirty = dirty or {}
+        if self.index < len(self.entries) - 1:
+            self.entries = self.entries[:self.index + 1]
+        has_prev = bool(self.entries)
+
+        entry = {}
+        for key, value in state.items():
+            if key in IMAGE_FIELDS:
+                entry[key] = self._record(key, value, dirty.get(key) if has_prev else None)
+                self._last[key] = value
+            elif key in LIST_FIELDS:
+                entry[key] = tuple(value)
+            else:
+                entry[key] = value
+
+        self.entries.append(entry)
+        self.index = len(self.entries) - 1
+        self._evict()
+        return self.index
+
+    def _record(self, key, image, change):
+        if image is None:
+            return None
+        if change:
+            kind, box = change
+            if kind == "patch":
+                return _Patch(box, image.crop(box))
+            if kind == "crop":
+                return _Crop(box)
+        if self.entries and image is self._last.get(key):
+            return SAME
+        return _Full(image)
+
+    def undo(self):
+        if not self.can_undo():
+            return None
+        self.index -= 1
+        return self.state(self.index)
+
+    def redo(self):
+        if not self.can_redo():
+            return None
+        self.index += 1
+        return self.state(self.index)
+
+    def state(self, index):
+        state = {}
+        for key, value in self.entries[index].items():
+            if key in IMAGE_FIELDS:
+                state[key] = self._materialize(index, key)
+                self._last[key] = state[key]
+            elif key in LIST_FIELDS:
+                state[key] = list(value)
+            else:
+                state[key] = value
+        return state
+
+    def _materialize(self, index, key):
+        ops = []
+        while True:
+            record = self.entries[index][key]
+            if record is None or isinstance(record, _Full):
+                break
+            if not isinstance(record, _Same):
+                ops.append(record)
+            index -= 1
+        if record is None:
+            return None
+
+        image = record.image
+        owned = False
+        for op in reversed(ops):
+            if isinstance(op, _Crop):
+                image = image.crop(op.box)
+                owned = True
+            else:
+                if not owned:
+                    image = image.copy()
+                    owned = True
+                image.paste(op.tile, op.box[:2])
+        return image
+
+    def is_shared(self, image):
+        if image is None:
+            return False
+        for entry in self.entries:
+            for key in IMAGE_FIELDS:
+                record = entry.get(key)
+                if isinstance(record, _Full) and record.image is image:
+                    return True
+            for key in LIST_FIELDS:
+                if any(img is image for img in entry.get(key, ())):
+                    return True
+        return False
+
+    def nbytes(self):
+        seen = set()
+        total = 0
+        for entry in self.entries:
+            for key in IMAGE_FIELDS:
+                record = entry.get(key)
+                if isinstance(record, _Full) and id(record.image) not in seen:
+                    seen.add(id(record.image))
+                    total += image_nbytes(record.image)
+                elif isinstance(record, _Patch):
+                    total += image_nbytes(record.tile)
+            for key in LIST_FIELDS:
+                for img in entry.get(key, ()):
+                    if id(img) not in seen:
+                        seen.add(id(img))
+                        total += image_nbytes(img)
+        return total
+
+    def _evict(self):
+        # Never drop the current entry; the new oldest entry becomes a keyframe
+        while self.index > 0 and self.nbytes() > self.budget:
+            for key in IMAGE_FIELDS:
+                if key in self.entries[1] and not isinstance(self.entries[1][key], _Full):
+                    image = self._materialize(1, key)
+                    self.entries[1][key] = _Full(image) if image is not None else None
+            del self.entries[0]
+            self.index -= 1
@@ -0,0 +1,49 @@
+from PIL import Image, ImageChops
+
+import parallel
+import perf
+
+# Black background keying for chat screenshots.
+# A pixel whose R, G and B are all below `threshold` becomes fully transparent,
+# exactly like the old per-pixel loop. With softness > 0 the alpha ramps up
+# over the next `softness` brightness levels instead of jumping straight to
+# opaque, so anti-aliased text edges don't get a hard black fringe.
+# Everything here works on whole bands, no Python loop over pixels; big
+# images are keyed in horizontal strips on several threads (parallel.py).
+
+
+def brightest_band(img):
+    # Per-pixel max(R, G, B) as an "L" image
+    r, g, b = img.convert("RGB").split()
+    return ImageChops.lighter(ImageChops.lighter(r, g), b)
+
+
+def key_lut(threshold=50, softness=0):
+    if softness > 0:
+        return [0 if v < threshold else min(255, (v - threshold + 1) * 255 // softness) for v in range(256)]
+    return [0 if v < threshold else 255 for v in range(256)]
+
+
+def key_mask(img, threshold=50, softness=0):
+    # 0 where the pixel is keyed out, 255 where it is kept (ramp in between in soft mode)
+    return brightest_band(img).point(key_lut(threshold, softness))
+
+
+@perf.timed("remove_black_background")
+def remove_black_background(img, threshold=50, softness=0):
+    # Every pixel is keyed on its own, the strips need no halo
+    return parallel.map_bands(img, lambda band: key_image(band, threshold, softness))
+
+
+def key_image(img, threshold=50, softness=0):
+    img = img.convert("RGBA")
+    keep = key_mask(img, threshold, softness)
+    transparent = Image.new("RGBA", img.size, (0, 0, 0, 0))
+
+    if softness <= 0:
+        return Image.composite(img, transparent, keep)
+
+    hard = keep.point([0] + [255] * 255)
+    result = Image.composite(img, transparent, hard)
+    result.putalpha(ImageChops.multiply(result.getchannel("A"), keep))
+    return result
@@ -0,0 +1,183 @@
+import threading
+
+from PIL import Image
+
+import perf
+from scaling import scale_key
+
+# Layer compositing for the canvas.
+# A frame is a stack of layers, bottom to top: the background (a
+# ScaledImageCache drawn at its scale), chat blocks pinned to the canvas and
+# the chat being edited, each with its own position and opacity. LayerStack
+# keeps the flattened frame and, when it is asked for one again, compares the
+# layers with the ones it drew last: only the rectangles a changed, moved,
+# added or removed layer covered before or covers now are drawn again. Moving
+# one chat block redraws its old and new place, not the whole canvas with
+# every block and the background rescaled. Layers are compared by source
+# object, revision (bumped on in-place edits), position, scale and opacity.
+# A scaled background is rendered once for the whole canvas and kept; redrawn
+# rects crop from it (LANCZOS of a fractional box isn't pixel-equal to the
+# same part of a bigger render, the seams would show).
+# Save, save to memory and batch all composite through here.
+
+MAX_DIRTY_RECTS = 16  # More than that, or more than half the canvas, and it is redrawn whole
+
+
+class Layer:
+    def __init__(self, source, x=0, y=0, opacity=1.0, scale=1.0, revision=0, key=None, background=False):
+        # source: PIL image, or ScaledImageCache drawn at `scale`. A background
+        # covers what is under it, its alpha is ignored on a white canvas
+        self.source = source
+        self.x = x
+        self.y = y
+        self.opacity = opacity
+        self.scale = scale
+        self.revision = revision
+        self.key = key if key is not None else id(source)
+        self.background = background
+
+    @property
+    def size(self):
+        if hasattr(self.source, "scaled_size"):
+            return self.source.scaled_size(self.scale)
+        return self.source.size
+
+    def bounds(self):
+        width, height = self.size
+        return self.x, self.y, self.x + width, self.y + height
+
+    def signature(self):
+        return id(self.source), self.revision, self.x, self.y, scale_key(self.scale), self.opacity
+
+
+def intersect(a, b):
+    return max(a[0], b[0]), max(a[1], b[1]), min(a[2], b[2]), min(a[3], b[3])
+
+
+def area(box):
+    return max(0, box[2] - box[0]) * max(0, box[3] - box[1])
+
+
+def fade(image, opacity):
+    # The image with its alpha scaled by opacity (0-1)
+    if opacity >= 1:
+        return image
+    image = image.convert("RGBA")
+    image.putalpha(image.getchannel("A").point([round(v * opacity) for v in range(256)]))
+    return image
+
+
+def canvas_layers(background=None, bg_pos=(0, 0), scale=1.0, pinned=(), chat=None, chat_pos=(0, 0),
+                  opacity=1.0, revision=0):
+    # Bottom to top: background (ScaledImageCache or image), pinned chats, the chat
+    stack = []
+    if background is not None:
+        stack.append(Layer(background, *bg_pos, scale=scale, key="bg", background=True))
+    stack += pinned
+    if chat is not None:
+        stack.append(Layer(chat, *chat_pos, opacity, revision=revision, key="chat"))
+    return stack
+
+
+class LayerStack:
+    def __init__(self, size):
+        self.size = size
+        self.layers = []
+        self.signatures = {}  # key -> (signature, bounds) as last drawn
+        self.frames = {}  # transparent -> cached frame
+        self.dirty = {}  # transparent -> [rects] to redraw in that frame
+        self.rendered = {}  # key -> (signature, image, position) of scaled backgrounds on the canvas
+        self.lock = threading.Lock()  # Exports composite on their own thread
+
+    def canvas_box(self):
+        return 0, 0, self.size[0], self.size[1]
+
+    def resize(self, size):
+        with self.lock:
+            if size != self.size:
+                self.size = size
+                self.frames.clear()
+                self.dirty.clear()
+                self.rendered.clear()
+
+    def invalidate(self, box=None):
+        box = intersect(box or self.canvas_box(), self.canvas_box())
+        if not area(box):
+            return
+        for mode, rects in self.dirty.items():
+            rects.append(box)
+            if len(rects) > MAX_DIRTY_RECTS or sum(map(area, rects)) > area(self.canvas_box()) // 2:
+                self.dirty[mode] = [self.canvas_box()]
+
+    def sync(self, layers):
+        # Dirty rects for everything that differs from the layers drawn last
+        keys = [layer.key for layer in layers]
+        if [key for key in keys if key in self.signatures] != [layer.key for layer in self.layers if layer.key in keys]:
+            self.invalidate()  # Reordered
+        signatures = {layer.key: (layer.signature(), layer.bounds()) for layer in layers}
+        for key, (signature, bounds) in self.signatures.items():
+            if key not in signatures or signatures[key][0] != signature:
+                self.invalidate(bounds)
+        for key, (signature, bounds) in signatures.items():
+            if key not in self.signatures or self.signatures[key][0] != signature:
+                self.invalidate(bounds)
+        self.layers = list(layers)
+        self.signatures = signatures
+        self.rendered = {key: value for key, value in self.rendered.items() if key in signatures}
+
+    def layer_image(self, layer):
+        # (image, position) of the layer's pixels that can land on the canvas
+        if not hasattr(layer.source, "region"):
+            return layer.source, (layer.x, layer.y)
+        signature = (id(layer.source), scale_key(layer.scale), layer.x, layer.y, self.size)
+        cached = self.rendered.get(layer.key)
+        if cached is None or cached[0] != signature:
+            image, position = layer.source.region(layer.scale, (layer.x, layer.y), self.size)
+            cached = self.rendered[layer.key] = (signature, image, position)
+        return cached[1:]
+
+    def part(self, layer, box):
+        # (image, position) of the layer inside a canvas box, or None
+        image, (x, y) = self.layer_image(layer)
+        if image is None:
+            return None
+        x1, y1, x2, y2 = intersect((x, y, x + image.width, y + image.height), box)
+        if x2 <= x1 or y2 <= y1:
+            return None
+        if (x1, y1, x2, y2) != (x, y, x + image.width, y + image.height):
+            image = image.crop((x1 - x, y1 - y, x2 - x, y2 - y))
+        return fade(image, layer.opacity), (x1, y1)
+
+    def render(self, frame, box, transparent):
+        # Draws box of the frame from scratch
+        frame.paste((0, 0, 0, 0) if transparent else (255, 255, 255), box)
+        for layer in self.layers:
+            part = self.part(layer, box)
+            if part is None:
+                continue
+            image, position = part
+            if transparent:
+                frame.alpha_composite(image.convert("RGBA"), position)
+            elif layer.background and layer.opacity >= 1:
+                frame.paste(image, position)
+            else:
+                frame.paste(image, position, image if "A" in image.getbands() else None)
+
+    @perf.timed("composite")
+    def composite(self, layers, transparent=False, copy=True):
+        # The frame with `layers`; copy=False hands out the cached frame itself,
+        # which the next call draws into
+        with self.lock:
+            self.sync(layers)
+            frame = self.frames.get(transparent)
+            if frame is None:
+                frame = Image.new("RGBA", self.size, (0, 0, 0, 0)) if transparent else Image.new("RGB", self.size, "white")
+                rects = [self.canvas_box()]
+            else:
+                rects = self.dirty[transparent]
+            for box in rects:
+                self.render(frame, box, transparent)
+            perf.count("composite_rects", len(rects))
+            self.frames[transparent] = frame
+            self.dirty[transparent] = []
+            return frame.copy() if copy else frame
@@ -0,0 +1,91 @@
+import queue
+from concurrent.futures import ThreadPoolExecutor
+
+from PIL import Image
+
+import perf
+
+# Image loading off the Tk thread.
+# Decoding (and any extra processing, e.g. keying) runs on a worker thread,
+# results come back through a queue that the Tk thread polls with after(),
+# so callbacks are always called on the Tk thread. JPEG files first get a
+# quick reduced-size preview through draft(), then the full decode follows.
+# Each slot ("bg", "chat", "outline") only delivers results of its latest request.
+
+POLL_MS = 30
+PREVIEW_SIDE = 1024
+JPEG_FORMATS = ("JPEG", "MPO")
+
+
+def open_preview(path, side=PREVIEW_SIDE):
+    # Reduced JPEG decode (DCT scaling), None for other formats
+    with Image.open(path) as img:
+        if img.format not in JPEG_FORMATS:
+            return None, img.size
+        full_size = img.size
+        img.draft("RGB", (min(side, img.width), min(side, img.height)))
+        img.load()
+        return img.copy(), full_size
+
+
+def open_full(path):
+    with Image.open(path) as img:
+        img.load()
+        return img
+
+
+class ImageLoader:
+    def __init__(self, master, workers=2):
+        self.master = master
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="sosiska-loader")
+        self.results = queue.Queue()
+        self.tickets = {}
+        self.pending = 0
+        self.polling = False
+
+    def load(self, slot, path, on_done, on_preview=None, on_error=None, process=None, opener=open_full):
+        # on_preview(image, full_size), on_done(result), on_error(exception); opener(path) and
+        # process(image) run in the worker
+        ticket = self.tickets.get(slot, 0) + 1
+        self.tickets[slot] = ticket
+        self.pending += 1
+        self.executor.submit(self._work, slot, ticket, path, on_done, on_preview, on_error, process, opener)
+        if not self.polling:
+            self.polling = True
+            self.master.after(POLL_MS, self._poll)
+
+    def _work(self, slot, ticket, path, on_done, on_preview, on_error, process, opener):
+        # Last message of every request is final=True
+        try:
+            with perf.span(f"load_{slot}"):
+                if on_preview:
+                    preview, full_size = open_preview(path)
+                    if preview is not None:
+                        self.results.put((slot, ticket, on_preview, (preview, full_size), False))
+                image = opener(path)
+                result = process(image) if process else image
+            self.results.put((slot, ticket, on_done, (result,), True))
+        except Exception as e:
+            self.results.put((slot, ticket, on_error, (e,), True))
+
+    def busy(self):
+        return self.pending > 0
+
+    def _poll(self):
+        while True:
+            try:
+                slot, ticket, callback, args, final = self.results.get_nowait()
+            except queue.Empty:
+                break
+            if final:
+                self.pending -= 1
+            if callback and ticket == self.tickets.get(slot):
+                callback(*args)
+
+        if self.pending:
+            self.master.after(POLL_MS, self._poll)
+        else:
+            self.polling = False
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,122 @@
+import threading
+from collections import OrderedDict
+
+from PIL import Image, ImageChops, ImageColor, ImageFilter
+
+import parallel
+import perf
+
+# Text outline.
+# The alpha of the text is dilated by `radius` pixels (a square max filter of
+# size 2*radius+1, like the old MaxFilter(3) for radius 1). The filter is done
+# as two 1-D passes, and each pass takes max of the mask with shifted copies
+# of itself at doubling distances, so the cost grows with log(radius) and not
+# radius^2. Only the content bbox plus a margin is processed.
+# `softness` blurs the outline edge, `color` is anything ImageColor understands.
+# Big areas are outlined in horizontal strips on several threads (parallel.py),
+# each strip with enough rows of halo for the dilation and the blur.
+
+OUTLINE_CACHE_SIZE = 8
+
+
+def shift(mask, dx, dy):
+    # Move without wrapping, uncovered area is 0
+    moved = Image.new(mask.mode, mask.size, 0)
+    moved.paste(mask, (dx, dy))
+    return moved
+
+
+def dilate_axis(mask, radius, horizontal):
+    # Running max over a window of 2*radius+1 pixels along one axis
+    window = 2 * radius + 1
+    span = 1
+    result = mask
+    while span < window:
+        step = min(span, window - span)
+        result = ImageChops.lighter(result, shift(result, step, 0) if horizontal else shift(result, 0, step))
+        span += step
+    # The window ends at the pixel itself, center it
+    return shift(result, -radius, 0) if horizontal else shift(result, 0, -radius)
+
+
+def dilate(mask, radius):
+    if radius <= 0:
+        return mask
+    # Centering moves the window back by `radius`, which would zero the last
+    # `radius` columns and rows; give them room and crop it off after
+    padded = Image.new(mask.mode, (mask.width + radius, mask.height + radius), 0)
+    padded.paste(mask, (0, 0))
+    padded = dilate_axis(dilate_axis(padded, radius, True), radius, False)
+    return padded.crop((0, 0, mask.width, mask.height))
+
+
+def outline_area(img, radius=1, softness=0):
+    # The part of the image add_outline() can change: content plus room for
+    # the outline and its blur. None if there is no content
+    if img.mode != "RGBA":
+        img = img.convert("RGBA")
+    bbox = img.getchannel("A").getbbox()
+    if not bbox:
+        return None
+    margin = radius + softness * 3
+    x1, y1, x2, y2 = bbox
+    return max(0, x1 - margin), max(0, y1 - margin), min(img.width, x2 + margin), min(img.height, y2 + margin)
+
+
+@perf.timed("add_outline")
+def add_outline(img, radius=1, color="black", softness=0):
+    img = img.convert("RGBA")
+    area = outline_area(img, radius, softness)
+    if not area:
+        return img
+    rgba = ImageColor.getcolor(color, "RGBA") if isinstance(color, str) else tuple(color)
+    if len(rgba) == 3:
+        rgba = rgba + (255,)
+    outlined = parallel.map_bands(img.crop(area), lambda band: outline_region(band, radius, rgba, softness),
+                                  halo=outline_halo(radius, softness))
+
+    result = img.copy()
+    result.paste(outlined, area[:2])
+    return result
+
+
+def outline_halo(radius, softness):
+    # Rows a strip needs around it: the dilation reaches `radius` rows, Pillow's
+    # blur (three extended box passes) a little over 3 * softness
+    return radius + (softness * 4 + 3 if softness > 0 else 0)
+
+
+def outline_region(region, radius, rgba, softness):
+    mask = dilate(region.getchannel("A"), radius)
+    if softness > 0:
+        mask = mask.filter(ImageFilter.GaussianBlur(softness))
+
+    outline = Image.new("RGBA", region.size, rgba[:3] + (0,))
+    if rgba[3] < 255:
+        mask = mask.point(lambda v: v * rgba[3] // 255)
+    outline.putalpha(mask)
+    return Image.alpha_composite(outline, region)
+
+
+class OutlineCache:
+    # Outlined results per (source image, revision, radius, color, softness).
+    # The app calls it from its loader threads
+    def __init__(self, size=OUTLINE_CACHE_SIZE):
+        self.size = size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, img, revision=0, radius=1, color="black", softness=0):
+        key = (id(img), revision, radius, str(color), softness)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] is img:
+                self.entries.move_to_end(key)
+                return entry[1]
+
+        result = add_outline(img, radius, color, softness)
+        with self.lock:
+            self.entries[key] = (img, result)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+        return result
@@ -0,0 +1,85 @@
+import hashlib
+
+import autocrop
+import keying
+
+# Overlap search for collage stitching.
+# Consecutive chat screenshots usually repeat lines: the bottom of one frame
+# shows the same text as the top of the next. Each frame is turned into a
+# sequence of keys - one per text line if the app recorded them when the frame
+# was saved to memory (hash of the line's text mask, cropped to the text, so
+# a shifted crop still matches), otherwise one per pixel row - and the longest
+# suffix of one sequence that is a prefix of the next is found with the KMP
+# failure function, in time linear in the number of keys.
+
+MIN_OVERLAP_LINES = 2  # One equal line may just be a repeated message
+MIN_OVERLAP_ROWS = 8
+
+
+def line_key(mask, top, bottom):
+    # mask: 0/255 text mask (keying.key_mask). Thresholded pixels survive JPEG
+    # noise and outline color changes better than the raw ones
+    line = mask.crop((0, top, mask.width, bottom))
+    bbox = line.getbbox()
+    if bbox:
+        line = line.crop((bbox[0], 0, bbox[2], line.height))
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(f"{line.size}".encode())
+    digest.update(line.tobytes())
+    return digest.digest()
+
+
+def text_lines(chat, position, frame_height, threshold=50):
+    # (top, bottom, key) in frame rows for the chat's lines that are fully inside the frame.
+    # Lines are found by brightness, not alpha: a dark outline would glue them together
+    x, y = position
+    rgb = chat.convert("RGB")
+    mask = keying.key_mask(rgb, threshold)
+    return [(y + top, y + bottom, line_key(mask, top, bottom))
+            for top, bottom in autocrop.find_lines(rgb, threshold)
+            if y + top >= 0 and y + bottom <= frame_height]
+
+
+def row_keys(data, stride):
+    return [hash(data[i:i + stride]) for i in range(0, len(data), stride)]
+
+
+def first_textured_row(data, stride, offset=0):
+    # Index of the first row that is not a single flat color, None if all are.
+    # Matching only flat rows (white padding, sky) says nothing about overlap
+    for i in range(0, len(data), stride):
+        row = data[i:i + stride]
+        if row != row[:3] * (stride // 3):
+            return offset + i // stride
+    return None
+
+
+def failure(keys):
+    fail = [0] * len(keys)
+    k = 0
+    for i in range(1, len(keys)):
+        while k and keys[i] != keys[k]:
+            k = fail[k - 1]
+        if keys[i] == keys[k]:
+            k += 1
+        fail[i] = k
+    return fail
+
+
+def longest_overlap(a, b, valid=None):
+    # Largest k with a[-k:] == b[:k] (and valid(k)), 0 if there is none
+    if not a or not b:
+        return 0
+    fail = failure(b)
+    k = 0
+    # A match can't be longer than b, so only the tail of a matters
+    for key in a[-len(b):]:
+        if k == len(b):
+            k = fail[k - 1]
+        while k and key != b[k]:
+            k = fail[k - 1]
+        if key == b[k]:
+            k += 1
+    while k and valid and not valid(k):
+        k = fail[k - 1]
+    return k
@@ -0,0 +1,61 @@
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from PIL import Image
+
+# Band-parallel execution of the pixel filters.
+# A big image is cut into horizontal bands, one per worker, each with `halo`
+# extra rows above and below so a filter that looks at neighbours (the
+# outline dilation and blur) sees the same pixels it would in the whole
+# image. The filter runs on every band on a shared thread pool - Pillow
+# releases the GIL inside its C operations - the halos are cut off again and
+# the bands pasted together, so the result is the same as in one piece.
+# Bands never need a halo to the side: they span the full width. Small images
+# aren't worth the crops and pastes and are filtered in one go.
+
+WORKERS = max(1, min(8, os.cpu_count() or 1))
+MIN_PIXELS = 2_000_000  # About 1080p
+MIN_BAND_ROWS = 64
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ThreadPoolExecutor(max_workers=WORKERS, thread_name_prefix="sosiska-filter")
+        return _pool
+
+
+def split(height, count, halo=0):
+    # [(top, bottom, top with halo, bottom with halo)], halos clipped to the image
+    rows = max(MIN_BAND_ROWS, -(-height // count))
+    return [(top, min(height, top + rows), max(0, top - halo), min(height, top + rows + halo))
+            for top in range(0, height, rows)]
+
+
+def map_bands(img, func, halo=0, workers=None, min_pixels=MIN_PIXELS):
+    # func(image) -> image of the same size; called per band when that pays off.
+    # func must not call map_bands itself, the pool would wait on itself
+    workers = WORKERS if workers is None else workers
+    if workers <= 1 or img.width * img.height < min_pixels:
+        return func(img)
+    parts = split(img.height, workers, halo)
+    if len(parts) == 1:
+        return func(img)
+
+    img.load()  # Lazy files would be decoded by several threads at once
+
+    def run(part):
+        top, bottom, outer_top, outer_bottom = part
+        band = func(img.crop((0, outer_top, img.width, outer_bottom)))
+        return band.crop((0, top - outer_top, img.width, bottom - outer_top))
+
+    bands = list(get_pool().map(run, parts))
+    result = Image.new(bands[0].mode, img.size)
+    for (top, _, _, _), band in zip(parts, bands):
+        result.paste(band, (0, top))
+    return result
@@ -0,0 +1,154 @@
+import functools
+import json
+import os
+import threading
+import time
+from contextlib import nullcontext
+
+# Timing instrumentation for the hot paths.
+# Off by default and then free: timed() hands back the undecorated function
+# and span() a shared no-op context, so nothing is measured or even called.
+# Turned on with the SOSISKA_PERF=1 environment variable, it has to be known
+# before the modules are imported. Every operation keeps a count, total, min/max and a
+# histogram over fixed millisecond buckets; counters count events. The app
+# can show the latest numbers on the canvas and save everything as JSON.
+
+ENABLED = os.environ.get("SOSISKA_PERF") == "1"
+BUCKETS_MS = (0.1, 0.25, 0.5, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000)
+
+_noop = nullcontext()
+
+
+class Stat:
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+        self.last = None
+        self.seq = 0  # When it last finished, to find the latest operation
+        self.buckets = [0] * (len(BUCKETS_MS) + 1)  # The last one is "more than the biggest bucket"
+
+    def add(self, ms):
+        self.count += 1
+        self.total += ms
+        self.min = ms if self.min is None else min(self.min, ms)
+        self.max = ms if self.max is None else max(self.max, ms)
+        self.last = ms
+        for i, limit in enumerate(BUCKETS_MS):
+            if ms <= limit:
+                self.buckets[i] += 1
+                break
+        else:
+            self.buckets[-1] += 1
+
+    def mean(self):
+        return self.total / self.count if self.count else 0.0
+
+    def to_dict(self):
+        histogram = {f"<={limit}": n for limit, n in zip(BUCKETS_MS, self.buckets)}
+        histogram[f">{BUCKETS_MS[-1]}"] = self.buckets[-1]
+        return {"count": self.count, "total_ms": round(self.total, 3), "mean_ms": round(self.mean(), 3),
+                "min_ms": round(self.min or 0, 3), "max_ms": round(self.max or 0, 3), "histogram_ms": histogram}
+
+
+class Recorder:
+    def __init__(self):
+        self.lock = threading.Lock()  # Exports are timed on their own thread
+        self.stats = {}
+        self.counters = {}
+        self.seq = 0
+
+    def record(self, name, ms):
+        with self.lock:
+            stat = self.stats.get(name)
+            if stat is None:
+                stat = self.stats[name] = Stat()
+            stat.add(ms)
+            self.seq += 1
+            stat.seq = self.seq
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def stat(self, name):
+        return self.stats.get(name)
+
+    def latest(self, exclude=()):
+        # (name, Stat) of the operation that finished last
+        with self.lock:
+            found = [(stat.seq, name, stat) for name, stat in self.stats.items() if name not in exclude]
+        if not found:
+            return None
+        _, name, stat = max(found)
+        return name, stat
+
+    def snapshot(self):
+        with self.lock:
+            return {"operations": {name: stat.to_dict() for name, stat in sorted(self.stats.items())},
+                    "counters": dict(sorted(self.counters.items()))}
+
+    def save_json(self, path):
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(self.snapshot(), f, ensure_ascii=False, indent=2)
+
+    def reset(self):
+        with self.lock:
+            self.stats.clear()
+            self.counters.clear()
+
+
+recorder = Recorder()
+
+
+class Span:
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        recorder.record(self.name, (time.perf_counter() - self.start) * 1000)
+
+
+def span(name):
+    # with perf.span("export.collage"): ...
+    return Span(name) if ENABLED else _noop
+
+
+def timed(name):
+    # Decorator; without instrumentation the function is returned as is
+    def decorate(func):
+        if not ENABLED:
+            return func
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                recorder.record(name, (time.perf_counter() - start) * 1000)
+        return wrapper
+    return decorate
+
+
+def count(name, n=1):
+    if ENABLED:
+        recorder.count(name, n)
+
+
+def overlay_text(frame_op="draw_images"):
+    # Two lines for the canvas overlay: frame time and the latest operation
+    lines = []
+    frame = recorder.stat(frame_op)
+    if frame:
+        lines.append(f"кадр: {frame.last:.1f} мс (ср. {frame.mean():.1f}, макс. {frame.max:.1f})")
+    latest = recorder.latest(exclude=(frame_op,))
+    if latest:
+        name, stat = latest
+        lines.append(f"последнее: {name} {stat.last:.1f} мс")
+    return "\n".join(lines)
@@ -0,0 +1,87 @@
+import autocrop
+import diskcache
+import keying
+import outline
+import overlap
+from layers import Layer
+
+# Headless rendering core: what the app does to a screenshot, without Tk.
+# key out black background -> crop -> outline -> put on the canvas over the
+# background and pinned chats (layers.canvas_layers) -> (collage) stitch. The app, batch mode, the
+# folder watcher and the render server all go through these functions, so a
+# frame rendered anywhere is the frame the app would save. Nothing here keeps
+# state, callers bring their own LayerStack and disk cache. cached_chat() goes
+# through the disk cache step by step under the same sources the app builds
+# while editing, so a chat processed anywhere is found everywhere.
+
+
+def process_chat(chat, crop=None, threshold=50, softness=0, add_outline=True,
+                 outline_radius=1, outline_color="black", outline_softness=0):
+    # crop: None, "auto" or (x1, y1, x2, y2) in screenshot pixels
+    chat = keying.remove_black_background(chat, threshold, softness)
+    box = resolve_crop(chat, crop, threshold)
+    return finish_chat(chat, box, add_outline, outline_radius, outline_color, outline_softness)
+
+
+def resolve_crop(chat, crop, threshold=50):
+    # The box process_chat cuts out of the keyed `chat`: clamped, "auto" found. None for no crop
+    if crop == "auto":
+        crop = autocrop.find_chat_block(chat, threshold)
+        if crop is None:
+            raise ValueError("не удалось найти чат на изображении")
+    if not crop:
+        return None
+    x1, y1, x2, y2 = crop
+    x1, y1 = max(0, x1), max(0, y1)
+    x2, y2 = min(chat.width, x2), min(chat.height, y2)
+    if x2 - x1 <= 0 or y2 - y1 <= 0:
+        raise ValueError(f"область обрезки {crop} вне изображения")
+    return x1, y1, x2, y2
+
+
+def finish_chat(chat, box=None, add_outline=True, outline_radius=1, outline_color="black", outline_softness=0):
+    # Crop and outline of a keyed chat
+    if box:
+        chat = chat.crop(box)
+    if add_outline:
+        chat = outline.add_outline(chat, outline_radius, outline_color, outline_softness)
+    return chat
+
+
+def chat_source(source, box=None, threshold=50, softness=0, add_outline=True,
+                outline_radius=1, outline_color="black", outline_softness=0):
+    # The disk cache source of process_chat(<screenshot with `source`>, ...), box from resolve_crop()
+    source = diskcache.derive(source, "key", threshold, softness)
+    if box:
+        source = diskcache.crop_source(source, box)
+    if add_outline:
+        source = diskcache.outline_source(source, outline_radius, outline_color, outline_softness)
+    return source
+
+
+def cached_chat(cache, source, open_chat, crop=None, threshold=50, softness=0, add_outline=True,
+                outline_radius=1, outline_color="black", outline_softness=0):
+    # process_chat(open_chat(), ...) through `cache` (None: no cache). A crop has to be
+    # resolved on the keyed chat before the result's source is known, so the keyed
+    # chat is looked up (or made and stored) first in that case
+    steps = (add_outline, outline_radius, outline_color, outline_softness)
+    if cache is None:
+        return process_chat(open_chat(), crop, threshold, softness, *steps)
+    if not crop:
+        return cache.cached(chat_source(source, None, threshold, softness, *steps),
+                            lambda: process_chat(open_chat(), None, threshold, softness, *steps))
+    keyed = cache.cached(diskcache.derive(source, "key", threshold, softness),
+                         lambda: keying.remove_black_background(open_chat(), threshold, softness))
+    box = resolve_crop(keyed, crop, threshold)
+    return cache.cached(chat_source(source, box, threshold, softness, *steps),
+                        lambda: finish_chat(keyed, box, *steps))
+
+
+def render_frame(stack, layers, chat=None, chat_pos=(0, 0), threshold=50, transparent=False):
+    # (frame, chat lines) - the frame is the stack's own, copy or spool it before the next call.
+    # layers: everything under the chat, see layers.canvas_layers()
+    if chat is not None:
+        layers = layers + [Layer(chat, *chat_pos, key="chat")]
+    frame = stack.composite(layers, transparent, copy=False)
+    lines = overlap.text_lines(chat, chat_pos, frame.height, threshold) if chat is not None else None
+    return frame, lines
@@ -0,0 +1,77 @@
+from PIL import Image
+
+# Background scaling.
+# The scaled background is never built as a whole: render_box() produces any
+# rectangle of it (in scaled coordinates) with resize(box=...) straight from
+# the source, so a 4K wallpaper at scale 5.0 costs only the visible part.
+# Final quality is LANCZOS from the original. The quick preview used while the
+# slider moves reads from the closest level of a precomputed mip pyramid (each
+# level is half the previous one) with BILINEAR.
+# base_size lets a reduced image (JPEG draft preview) stand in for the full one.
+
+MIN_PYRAMID_SIDE = 64
+
+
+def scale_key(scale):
+    return round(float(scale), 3)
+
+
+def scaled_size(size, scale):
+    return max(1, int(size[0] * scale)), max(1, int(size[1] * scale))
+
+
+def build_pyramid(image):
+    levels = [image]
+    while min(levels[-1].size) // 2 >= MIN_PYRAMID_SIDE:
+        levels.append(levels[-1].reduce(2))
+    return levels
+
+
+class ScaledImageCache:
+    def __init__(self, image, base_size=None):
+        self.source = image
+        if image.mode not in ("RGB", "RGBA"):
+            image = image.convert("RGBA" if "A" in image.getbands() or "transparency" in image.info else "RGB")
+        self.image = image
+        self.base_size = base_size or image.size
+        self._pyramid = None
+
+    @property
+    def pyramid(self):
+        # Built on first preview, a plain load at one scale doesn't need it
+        if self._pyramid is None:
+            self._pyramid = build_pyramid(self.image)
+        return self._pyramid
+
+    def scaled_size(self, scale):
+        return scaled_size(self.base_size, scale)
+
+    def preview_source(self, size):
+        # Smallest pyramid level that is still at least as big as the target
+        source = self.pyramid[0]
+        for level in self.pyramid:
+            if level.width < size[0] or level.height < size[1]:
+                break
+            source = level
+        return source
+
+    def render_box(self, scale, box, final=True):
+        # Part of the background scaled by `scale`; box is in scaled coordinates
+        size = self.scaled_size(scale)
+        source = self.image if final else self.preview_source(size)
+        fx = source.width / size[0]
+        fy = source.height / size[1]
+        x1, y1, x2, y2 = box
+        source_box = (x1 * fx, y1 * fy, x2 * fx, y2 * fy)
+        resample = Image.Resampling.LANCZOS if final else Image.Resampling.BILINEAR
+        return source.resize((x2 - x1, y2 - y1), resample, box=source_box)
+
+    def region(self, scale, position, viewport):
+        # (image, paste position) of the part of the scaled background that
+        # falls inside a viewport of the given size, or (None, None)
+        width, height = self.scaled_size(scale)
+        x, y = position
+        box = (max(0, -x), max(0, -y), min(width, viewport[0] - x), min(height, viewport[1] - y))
+        if box[2] <= box[0] or box[3] <= box[1]:
+            return None, None
+        return self.render_box(scale, box), (x + box[0], y + box[1])
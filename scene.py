@@ -0,0 +1,149 @@
+import tkinter as tk
+from PIL import ImageTk
+
+from tiles import TileLayer
+
+# Retained canvas scene.
+# Canvas items (border, background, chat, their frames, guide lines) are created
+# once and then only moved/reconfigured, instead of canvas.delete("all") and
+# recreating everything on every mouse move. Layer order, bottom to top:
+# border, background tiles, background frame, pinned chats with their frames,
+# chat, chat frame, guides.
+# The background is a TileLayer (tiles.py), only the visible part of it is in Tk.
+
+
+class ImageLayer:
+    def __init__(self, canvas, frame_color):
+        self.canvas = canvas
+        self.frame_color = frame_color
+        self.image_id = None
+        self.frame_id = None
+        self.photo = None
+        self.x = None
+        self.y = None
+        self.size = None
+
+    def update(self, photo, x, y, size, above):
+        if photo is None:
+            self.remove()
+            return above
+
+        if self.image_id is None:
+            self.image_id = self.canvas.create_image(x, y, anchor=tk.NW, image=photo)
+            self.frame_id = self.canvas.create_rectangle(x, y, x + size[0], y + size[1], outline=self.frame_color)
+            self.canvas.tag_raise(self.image_id, above)
+            self.canvas.tag_raise(self.frame_id, self.image_id)
+        else:
+            if photo is not self.photo:
+                self.canvas.itemconfigure(self.image_id, image=photo)
+            if (x, y) != (self.x, self.y):
+                self.canvas.coords(self.image_id, x, y)
+            if (x, y, size) != (self.x, self.y, self.size):
+                self.canvas.coords(self.frame_id, x, y, x + size[0], y + size[1])
+
+        self.photo = photo
+        self.x, self.y, self.size = x, y, size
+        return self.frame_id
+
+    def patch(self, image, box):
+        # Update only `box` of the shown PhotoImage from the same-sized PIL image.
+        # Tk's photo copy with the "set" rule also takes over transparent pixels
+        patch = ImageTk.PhotoImage(image.crop(box))
+        self.canvas.tk.call(str(self.photo), "copy", str(patch), "-to", box[0], box[1], "-compositingrule", "set")
+
+    def remove(self):
+        if self.image_id is not None:
+            self.canvas.delete(self.image_id, self.frame_id)
+        self.image_id = None
+        self.frame_id = None
+        self.photo = None
+        self.x = self.y = self.size = None
+
+
+class CanvasScene:
+    def __init__(self, canvas, width, height):
+        self.canvas = canvas
+        self.width = width
+        self.height = height
+        self.border_id = canvas.create_rectangle(0, 0, width, height, outline="black")
+        self.bg = TileLayer(canvas, "blue")
+        self.pinned = []  # ImageLayers of the chats pinned under the edited one
+        self.chat = ImageLayer(canvas, "green")
+        self.guide_ids = []
+        self.guides = []
+        self.redraw_pending = None
+        self.redraw_callback = None
+        self.overlay_ids = None
+
+    def resize(self, width, height):
+        if (width, height) != (self.width, self.height):
+            self.width = width
+            self.height = height
+            self.canvas.coords(self.border_id, 0, 0, width, height)
+
+    def update(self, bg, chat, guides, pinned=()):
+        # bg: (view, x, y) - see TileLayer; chat: (photo, x, y, (width, height));
+        # either can be None; guides: list of (x1, y1, x2, y2); pinned: list of chat tuples
+        bg_view, bg_x, bg_y = bg or (None, 0, 0)
+        above = self.bg.update(bg_view, bg_x, bg_y, (self.width, self.height), above=self.border_id)
+        pinned = list(pinned)
+        while len(self.pinned) > len(pinned):
+            self.pinned.pop().remove()
+        while len(self.pinned) < len(pinned):
+            self.pinned.append(ImageLayer(self.canvas, "dark green"))
+        for layer, view in zip(self.pinned, pinned):
+            above = layer.update(*view, above=above)
+        self.chat.update(*(chat or (None, 0, 0, None)), above=above)
+        self.set_guides(guides)
+
+    def set_guides(self, guides):
+        guides = list(guides)
+        if guides == self.guides:
+            return
+        while len(self.guide_ids) > len(guides):
+            self.canvas.delete(self.guide_ids.pop())
+        for i, line in enumerate(guides):
+            if i < len(self.guide_ids):
+                self.canvas.coords(self.guide_ids[i], *line)
+            else:
+                self.guide_ids.append(self.canvas.create_line(*line, fill="red", dash=(4, 4)))
+        for item in self.guide_ids:
+            self.canvas.tag_raise(item)
+        self.guides = guides
+
+    def set_overlay(self, text):
+        # Timing overlay in the top left corner, on top of everything; None removes it
+        if not text:
+            if self.overlay_ids:
+                self.canvas.delete(*self.overlay_ids)
+                self.overlay_ids = None
+            return
+        if self.overlay_ids is None:
+            box = self.canvas.create_rectangle(0, 0, 0, 0, fill="white", outline="")
+            label = self.canvas.create_text(6, 6, anchor=tk.NW, fill="black", font=("courier", 9))
+            self.overlay_ids = (box, label)
+        box, label = self.overlay_ids
+        self.canvas.itemconfigure(label, text=text)
+        x1, y1, x2, y2 = self.canvas.bbox(label)
+        self.canvas.coords(box, x1 - 2, y1 - 2, x2 + 2, y2 + 2)
+        self.canvas.tag_raise(box)
+        self.canvas.tag_raise(label)
+
+    def schedule(self, callback):
+        # Coalesce redraw requests: however many motion events arrive,
+        # callback runs once when Tk gets idle
+        self.redraw_callback = callback
+        if self.redraw_pending is None:
+            self.redraw_pending = self.canvas.after_idle(self._flush)
+
+    def _flush(self):
+        self.redraw_pending = None
+        callback, self.redraw_callback = self.redraw_callback, None
+        if callback:
+            callback()
+
+    def cancel(self):
+        if self.redraw_pending is not None:
+            self.canvas.after_cancel(self.redraw_pending)
+            self.redraw_pending = None
+        self.redraw_callback = None
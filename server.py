@@ -0,0 +1,538 @@
+# Local render service: the app's pipeline over HTTP, for bots and scripts on the same machine.
+#
+#   python server.py [--host 127.0.0.1] [--port 8765] [--workers N] [--max-queue 16]
+#
+#   POST /render  multipart/form-data:
+#     job         JSON, optional: {"canvas": [650, 650], "scale": 1.0, "bg_pos": [0, 0],
+#                 "chat_pos": [0, 0], "crop": "auto" | [x1, y1, x2, y2] | null, "threshold": 50,
+#                 "softness": 0, "outline": true, "outline_radius": 1, "outline_color": "black",
+#                 "outline_softness": 0, "format": "png", "export": {...see encoding.py}}
+#     background  image, optional
+#     chat        image; several chat parts are rendered one frame each and stitched into a collage
+#   -> the encoded image (Content-Type image/png, image/jpeg, ...), JSON {"error": ...} on errors
+#   GET /metrics  request counts and latency (queue wait and render time separately), JSON
+#   GET /health   "ok"
+#
+# Rendering runs in a pool of worker processes started (and warmed up with a
+# tiny job) when the server starts, so a request doesn't pay for process start
+# and imports. Every worker keeps the disk cache of processed chats and the last
+# few backgrounds, a bot that sends the same background every time has it
+# decoded once. At most `workers` jobs render at a time and at most
+# `max_queue` more are admitted - being uploaded, parsed or waiting for a
+# worker. The check is made on the headers, before the body is read, so past
+# that a request gets 503 (and the connection is closed) without its upload
+# ever reaching memory: at most workers + max_queue uploads are held at once.
+# The multipart body is parsed off the event loop. The result is written to a
+# temp file by the worker and streamed to the client from it in chunks.
+# The canvas is limited to MAX_CANVAS a side so one job can't take all memory;
+# if a worker dies anyway (killed for memory), its request gets 500 and the
+# pool is replaced, the server keeps going.
+# Errors are JSON: 400 for a bad request or job, 422 when the images can't be
+# rendered, 500 for anything unexpected.
+import argparse
+import asyncio
+import email.errors
+import email.parser
+import email.policy
+import hashlib
+import io
+import json
+import math
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+import time
+import traceback
+import uuid
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from PIL import Image, ImageColor
+
+import diskcache
+import encoding
+import parallel
+import perf
+from layers import LayerStack, canvas_layers
+from render_core import cached_chat, process_chat, render_frame
+from scaling import ScaledImageCache
+from spool import FrameSpool
+from stitch import stitch_vertical
+
+MAX_UPLOAD = 64 * 1024 * 1024
+MAX_HEADER = 64 * 1024
+CHUNK = 256 * 1024
+IDLE_TIMEOUT = 30  # Seconds a keep-alive connection may wait for its next request
+LATENCY_WINDOW = 1000  # Requests the percentiles are computed over
+BACKGROUNDS = 4  # Decoded backgrounds kept per worker
+MAX_SCALE = 5.0  # The app's scale slider goes up to this
+MAX_CANVAS = 8192  # Pixels a side, an RGBA canvas this big is 256 MB
+CLOSED = 499  # Counted when the client went away before the response (no status was sent)
+
+CONTENT_TYPES = {"PNG": "image/png", "JPEG": "image/jpeg", "WEBP": "image/webp", "BMP": "image/bmp"}
+REASONS = {200: "OK", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed", 411: "Length Required",
+           413: "Payload Too Large", 422: "Unprocessable Entity", 500: "Internal Server Error",
+           503: "Service Unavailable"}
+
+JOB_DEFAULTS = {
+    "canvas": (650, 650),
+    "scale": 1.0,
+    "bg_pos": (0, 0),
+    "chat_pos": (0, 0),
+    "crop": None,
+    "threshold": 50,
+    "softness": 0,
+    "outline": True,
+    "outline_radius": 1,
+    "outline_color": "black",
+    "outline_softness": 0,
+    "format": "png",
+    "export": {},
+}
+
+_cache = None
+_backgrounds = OrderedDict()  # digest -> ScaledImageCache
+
+
+class HttpError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+# Worker processes
+
+def _init_worker(cache_dir=None, filter_workers=None):
+    global _cache
+    if filter_workers:
+        parallel.WORKERS = filter_workers
+    _cache = diskcache.DiskCache(cache_dir) if cache_dir else None
+
+
+def warm_up():
+    # Imports are done and the filters' code paths run once before the first request
+    chat = Image.new("RGB", (64, 32), "black")
+    chat.paste((255, 255, 255), (8, 8, 40, 20))
+    render_frame(LayerStack((64, 64)), [], process_chat(chat), (0, 0))
+    return os.getpid()
+
+
+def decode(data):
+    with Image.open(io.BytesIO(data)) as img:
+        img.load()
+        return img
+
+
+def background_for(data):
+    digest = hashlib.blake2b(data, digest_size=16).hexdigest()
+    if digest in _backgrounds:
+        _backgrounds.move_to_end(digest)
+    else:
+        _backgrounds[digest] = ScaledImageCache(decode(data))
+        if len(_backgrounds) > BACKGROUNDS:
+            _backgrounds.popitem(last=False)
+    return _backgrounds[digest]
+
+
+def load_chat(data, job):
+    steps = (job["crop"], job["threshold"], job["softness"], job["outline"],
+             job["outline_radius"], job["outline_color"], job["outline_softness"])
+    source = (("file", hashlib.blake2b(data, digest_size=16).hexdigest()),) if _cache else None
+    return cached_chat(_cache, source, lambda: decode(data), *steps)
+
+
+def render_job(job, background, chats, path):
+    # Worker process: writes the result to `path`, returns (seconds spent, pid)
+    start = time.perf_counter()
+    options = encoding.export_options(job["export"])
+    fmt = encoding.image_format(path)
+    transparent = options["transparent"] and fmt in encoding.ALPHA_FORMATS
+    layers = canvas_layers(background_for(background) if background else None, job["bg_pos"], job["scale"])
+    stack = LayerStack(job["canvas"])
+
+    if len(chats) == 1:
+        frame, _ = render_frame(stack, layers, load_chat(chats[0], job), job["chat_pos"], job["threshold"], transparent)
+        encoding.save(frame, path, options)
+    else:
+        # Frames go to disk like the app's memory, the collage is stitched in bands
+        spool = FrameSpool()
+        frames = [spool.append(*render_frame(stack, layers, load_chat(data, job), job["chat_pos"], job["threshold"]))
+                  for data in chats]
+        written = stitch_vertical(frames, path, options=options)
+        if len(written) > 1:
+            for part in written:
+                os.remove(part)
+            raise ValueError(f"склейка выше предела формата {fmt}, используйте png")
+    return time.perf_counter() - start, os.getpid()
+
+
+# Requests
+
+def integer(value, name, minimum=0):
+    # JSON numbers only, 1.5 or true aren't quietly turned into 1
+    if isinstance(value, bool) or not isinstance(value, (int, float)) or value != int(value):
+        raise ValueError(f"{name}: ожидается целое число")
+    if int(value) < minimum:
+        raise ValueError(f"{name}: должно быть не меньше {minimum}")
+    return int(value)
+
+
+def parse_job(text):
+    try:
+        given = json.loads(text) if text else {}
+    except ValueError as e:
+        raise HttpError(400, f"job: неверный JSON: {e}")
+    if not isinstance(given, dict):
+        raise HttpError(400, "job: ожидается JSON-объект")
+    unknown = set(given) - set(JOB_DEFAULTS)
+    if unknown:
+        raise HttpError(400, f"job: неизвестные поля: {', '.join(sorted(unknown))}")
+    job = dict(JOB_DEFAULTS, **given)
+    try:
+        job["canvas"] = tuple(int(v) for v in job["canvas"])
+        job["bg_pos"] = tuple(int(v) for v in job["bg_pos"])
+        job["chat_pos"] = tuple(int(v) for v in job["chat_pos"])
+        if len(job["canvas"]) != 2 or min(job["canvas"]) <= 0:
+            raise ValueError("canvas: ширина и высота должны быть положительными")
+        if max(job["canvas"]) > MAX_CANVAS:
+            raise ValueError(f"canvas: ширина и высота не больше {MAX_CANVAS}")
+        if job["crop"] not in (None, "auto"):
+            job["crop"] = [int(v) for v in job["crop"]]
+            if len(job["crop"]) != 4:
+                raise ValueError("crop: нужно [x1, y1, x2, y2]")
+        if isinstance(job["scale"], bool) or not isinstance(job["scale"], (int, float)):
+            raise ValueError("scale: ожидается число")
+        job["scale"] = float(job["scale"])
+        if not (math.isfinite(job["scale"]) and 0 < job["scale"] <= MAX_SCALE):
+            raise ValueError(f"scale: ожидается число больше 0 и не больше {MAX_SCALE}")
+        job["threshold"] = integer(job["threshold"], "threshold")
+        if job["threshold"] > 255:
+            raise ValueError("threshold: должно быть от 0 до 255")
+        job["softness"] = integer(job["softness"], "softness")
+        if not isinstance(job["outline"], bool):
+            raise ValueError("outline: ожидается true или false")
+        job["outline_radius"] = integer(job["outline_radius"], "outline_radius")
+        job["outline_softness"] = integer(job["outline_softness"], "outline_softness")
+        if not isinstance(job["outline_color"], str):
+            raise ValueError("outline_color: ожидается строка цвета")
+        ImageColor.getrgb(job["outline_color"])
+        job["format"] = str(job["format"]).lstrip(".").lower()
+        encoding.image_format("result." + job["format"])
+        job["export"] = encoding.export_options(job["export"])
+    except (TypeError, ValueError) as e:
+        raise HttpError(400, f"job: {e}")
+    return job
+
+
+def parse_form(content_type, body):
+    # {name: [bytes, ...]} of a multipart/form-data body. CPU work on the whole
+    # upload, the server runs it on a thread
+    if not content_type.startswith("multipart/form-data"):
+        raise HttpError(400, "ожидается multipart/form-data")
+    try:
+        message = email.parser.BytesParser(policy=email.policy.HTTP).parsebytes(
+            b"Content-Type: " + content_type.encode("latin-1") + b"\r\n\r\n" + body)
+        if not message.is_multipart():
+            raise HttpError(400, "неверное тело multipart/form-data")
+        fields = {}
+        for part in message.iter_parts():
+            name = part.get_param("name", header="content-disposition")
+            if name:
+                fields.setdefault(name, []).append(part.get_payload(decode=True) or b"")
+    except (ValueError, TypeError, LookupError, email.errors.MessageError) as e:
+        raise HttpError(400, f"неверное тело multipart/form-data: {e}")
+    return fields
+
+
+class Latency:
+    # perf.Stat plus percentiles over the latest requests
+    def __init__(self):
+        self.stat = perf.Stat()
+        self.recent = deque(maxlen=LATENCY_WINDOW)
+
+    def add(self, ms):
+        self.stat.add(ms)
+        self.recent.append(ms)
+
+    def to_dict(self):
+        result = self.stat.to_dict()
+        ordered = sorted(self.recent)
+        for name, q in (("p50_ms", 0.5), ("p90_ms", 0.9), ("p99_ms", 0.99)):
+            result[name] = round(ordered[min(len(ordered) - 1, int(q * len(ordered)))], 3) if ordered else 0
+        return result
+
+
+class RenderServer:
+    def __init__(self, workers, max_queue=16, max_upload=MAX_UPLOAD, cache_dir=None):
+        self.workers = workers
+        self.max_queue = max_queue
+        self.max_upload = max_upload
+        self.cache_dir = cache_dir
+        self.pool = self.make_pool()
+        self.slots = None  # asyncio.Semaphore, made on the server's loop
+        self.uploading = 0  # Admitted, body being read or parsed
+        self.waiting = 0
+        self.rendering = 0
+        self.rejected = 0
+        self.restarts = 0
+        self.started = time.monotonic()
+        self.latency = {}  # route -> Latency
+        self.statuses = {}
+        self.directory = tempfile.mkdtemp(prefix="sosiska-server-")
+
+    def make_pool(self):
+        filter_workers = max(1, (os.cpu_count() or 1) // self.workers)
+        return ProcessPoolExecutor(self.workers, initializer=_init_worker, initargs=(self.cache_dir, filter_workers))
+
+    def replace_pool(self, broken):
+        # A worker died; every job on the pool fails, the first one to see it makes a new one
+        if self.pool is broken:
+            broken.shutdown(wait=False, cancel_futures=True)
+            self.pool = self.make_pool()
+            self.restarts += 1
+
+    def record(self, name, ms):
+        if name not in self.latency:
+            self.latency[name] = Latency()
+        self.latency[name].add(ms)
+
+    async def start(self, host, port):
+        self.slots = asyncio.Semaphore(self.workers)
+        loop = asyncio.get_running_loop()
+        pids = await asyncio.gather(*(loop.run_in_executor(self.pool, warm_up) for _ in range(self.workers)))
+        self.server = await asyncio.start_server(self.handle, host, port, limit=MAX_HEADER)
+        return sorted(set(pids))
+
+    def close(self):
+        self.server.close()
+        self.pool.shutdown(wait=False, cancel_futures=True)
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    async def handle(self, reader, writer):
+        try:
+            while True:
+                try:
+                    head = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), IDLE_TIMEOUT)
+                except (asyncio.IncompleteReadError, asyncio.TimeoutError, ConnectionError):
+                    break
+                except asyncio.LimitOverrunError:
+                    await self.respond_error(writer, HttpError(413, "слишком большие заголовки"), False)
+                    break
+                if not await self.serve(head, reader, writer):
+                    break
+        finally:
+            writer.close()
+
+    async def serve(self, head, reader, writer):
+        # One request; False when the connection should be closed
+        start = time.perf_counter()
+        lines = head.decode("latin-1").split("\r\n")
+        try:
+            method, target, version = lines[0].split(" ", 2)
+        except ValueError:
+            await self.respond_error(writer, HttpError(400, "неверная строка запроса"), False)
+            return False
+        headers = {}
+        for line in lines[1:]:
+            if ":" in line:
+                name, value = line.split(":", 1)
+                headers[name.strip().lower()] = value.strip()
+        keep_alive = version == "HTTP/1.1" and headers.get("connection", "").lower() != "close"
+        route = target.split("?", 1)[0]
+
+        status = CLOSED
+        # Only /render reads a body, and only once it's admitted
+        body_read = headers.get("content-length", "0") == "0" and "transfer-encoding" not in headers
+        try:
+            if route == "/render":
+                if method != "POST":
+                    raise HttpError(405, "нужен POST")
+                self.admit()
+                self.uploading += 1
+                try:
+                    data = await self.read_body(headers, reader)
+                    body_read = True
+                    job, chats, background = await self.parse_render(headers, data)
+                finally:
+                    self.uploading -= 1
+                del data
+                await self.render(job, chats, background, writer, keep_alive)
+            elif route == "/metrics" and method == "GET":
+                await self.respond(writer, 200, "application/json", json.dumps(self.metrics(), indent=1).encode(), keep_alive)
+            elif route == "/health" and method == "GET":
+                await self.respond(writer, 200, "text/plain; charset=utf-8", b"ok", keep_alive)
+            else:
+                raise HttpError(404, f"нет такого адреса: {route}")
+            status = 200
+        except HttpError as e:
+            status = e.status
+            keep_alive = keep_alive and body_read  # An unread body is still in the stream
+            await self.respond_error(writer, e, keep_alive)
+        except ConnectionError:
+            return False
+        except Exception as e:
+            status = 500
+            traceback.print_exc()
+            await self.respond_error(writer, HttpError(500, f"{type(e).__name__}: {e}"), False)
+            return False
+        finally:
+            self.statuses[status] = self.statuses.get(status, 0) + 1
+            self.record(route if route in ("/render", "/metrics", "/health") else "other",
+                        (time.perf_counter() - start) * 1000)
+        return keep_alive
+
+    async def read_body(self, headers, reader):
+        if "chunked" in headers.get("transfer-encoding", "").lower():
+            raise HttpError(411, "нужен Content-Length")
+        try:
+            length = int(headers.get("content-length", ""))
+        except ValueError:
+            raise HttpError(411, "нужен Content-Length")
+        if length < 0:
+            raise HttpError(400, "неверный Content-Length")
+        if length > self.max_upload:
+            raise HttpError(413, f"загрузка больше {self.max_upload // (1024 * 1024)} МБ")
+        try:
+            return await reader.readexactly(length)
+        except asyncio.IncompleteReadError:
+            raise ConnectionError("клиент закрыл соединение")
+
+    def admit(self):
+        # Decided on the headers alone, a rejected upload is never read
+        if self.uploading + self.waiting >= self.max_queue:
+            self.rejected += 1
+            raise HttpError(503, "сервер занят, повторите позже")
+
+    async def parse_render(self, headers, data):
+        # (job, chat images, background or None) of a /render body
+        loop = asyncio.get_running_loop()
+        fields = await loop.run_in_executor(None, parse_form, headers.get("content-type", ""), data)
+        try:
+            text = fields.get("job", [b""])[0].decode("utf-8")
+        except UnicodeDecodeError:
+            raise HttpError(400, "job: ожидается текст в UTF-8")
+        chats = fields.get("chat")
+        if not chats:
+            raise HttpError(400, "нет изображения chat")
+        return parse_job(text), chats, fields.get("background", [None])[0]
+
+    async def render(self, job, chats, background, writer, keep_alive):
+        loop = asyncio.get_running_loop()
+        path = os.path.join(self.directory, f"{uuid.uuid4().hex}.{job['format']}")
+        queued = time.perf_counter()
+        self.waiting += 1
+        try:
+            await self.slots.acquire()
+        finally:
+            self.waiting -= 1  # Also when the client went away while waiting
+        self.record("render.queue", (time.perf_counter() - queued) * 1000)
+        self.rendering += 1
+        pool = self.pool
+        try:
+            seconds, _ = await loop.run_in_executor(pool, render_job, job, background, chats, path)
+            self.record("render.work", seconds * 1000)
+        except (ValueError, OSError, Image.DecompressionBombError) as e:
+            raise HttpError(422, str(e))
+        except BrokenProcessPool:
+            self.replace_pool(pool)
+            raise HttpError(500, "процесс рендеринга завершился аварийно")
+        except Exception as e:
+            raise HttpError(500, f"{type(e).__name__}: {e}")
+        finally:
+            self.rendering -= 1
+            self.slots.release()
+        try:
+            fmt = encoding.image_format(path)
+            await self.stream_file(writer, path, CONTENT_TYPES.get(fmt, "application/octet-stream"), keep_alive)
+        finally:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    async def stream_file(self, writer, path, content_type, keep_alive):
+        loop = asyncio.get_running_loop()
+        with open(path, "rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            writer.write(self.head(200, content_type, size, keep_alive))
+            while True:
+                chunk = await loop.run_in_executor(None, f.read, CHUNK)
+                if not chunk:
+                    break
+                writer.write(chunk)
+                await writer.drain()
+
+    def head(self, status, content_type, length, keep_alive):
+        return (f"HTTP/1.1 {status} {REASONS.get(status, '')}\r\n"
+                f"Content-Type: {content_type}\r\nContent-Length: {length}\r\n"
+                f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n"
+                + ("Retry-After: 1\r\n" if status == 503 else "") + "\r\n").encode("latin-1")
+
+    async def respond(self, writer, status, content_type, data, keep_alive):
+        writer.write(self.head(status, content_type, len(data), keep_alive) + data)
+        await writer.drain()
+
+    async def respond_error(self, writer, error, keep_alive):
+        data = json.dumps({"error": str(error)}, ensure_ascii=False).encode("utf-8")
+        try:
+            await self.respond(writer, error.status, "application/json; charset=utf-8", data, keep_alive)
+        except ConnectionError:
+            pass
+
+    def metrics(self):
+        return {
+            "uptime_s": round(time.monotonic() - self.started, 1),
+            "workers": self.workers,
+            "rendering": self.rendering,
+            "uploading": self.uploading,
+            "queued": self.waiting,
+            "max_queue": self.max_queue,
+            "rejected": self.rejected,
+            "pool_restarts": self.restarts,
+            "statuses": {str(status): n for status, n in sorted(self.statuses.items())},
+            "latency": {name: latency.to_dict() for name, latency in sorted(self.latency.items())},
+        }
+
+
+async def serve_forever(args):
+    cache_dir = None if args.no_cache else args.cache_dir or diskcache.default_directory()
+    server = RenderServer(args.workers, args.max_queue, args.max_upload_mb * 1024 * 1024, cache_dir)
+    pids = await server.start(args.host, args.port)
+    print(f"SoSiska: http://{args.host}:{args.port}/render, процессов: {len(pids)}", flush=True)
+    try:
+        await server.server.serve_forever()
+    finally:
+        server.close()
+
+
+def positive(value):
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError("нужно целое число не меньше 1")
+    return number
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="SoSiska: локальный HTTP-сервер рендеринга")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--workers", type=positive, default=max(1, min(4, os.cpu_count() or 1)),
+                        help="процессов рендеринга (и одновременных задач)")
+    parser.add_argument("--max-queue", type=positive, default=16, help="сколько задач может загружаться и ждать, остальным 503")
+    parser.add_argument("--max-upload-mb", type=positive, default=MAX_UPLOAD // (1024 * 1024))
+    parser.add_argument("--cache-dir", help="папка кэша обработанных чатов")
+    parser.add_argument("--no-cache", action="store_true", help="не использовать кэш")
+    args = parser.parse_args(argv)
+    try:
+        asyncio.run(serve_forever(args))
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == "__main__":
+    multiprocessing.freeze_support()
+    sys.exit(main())
@@ -0,0 +1,275 @@
+import hashlib
+import json
+import os
+import struct
+import threading
+import zipfile
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+from PIL import Image
+
+from layers import Layer
+
+# Session files (.sosiska).
+# A session is a ZIP archive with its entries stored as is: manifest.json
+# (canvas, positions, scale, opacity, flags, settings, pinned chats and the
+# order of the memory frames) and one blob per layer under blobs/, named by the hash of its
+# pixels - a layer used twice is stored once, and resaving copies unchanged
+# blobs without decoding them. A blob is the layer's raw rows deflated in
+# independent bands, so any band can be read on its own.
+# Opening a session decodes only the background and the chat, memory frames
+# become SessionFrame handles that read their bands from the file when the
+# collage needs them: a session with a hundred frames opens at once.
+
+FORMAT = 1
+SUFFIX = ".sosiska"
+MANIFEST = "manifest.json"
+MAGIC = b"SSB1"
+BAND_ROWS = 256
+COMPRESS_LEVEL = 1  # Flat chat screenshots shrink well even at 1, and it is several times faster than 6
+MODES = ("L", "RGB", "RGBA")
+WORKERS = max(1, min(4, os.cpu_count() or 1))
+
+BLOB_HEADER = struct.Struct(">4s4sIIII")  # magic, mode, width, height, band rows, band count
+ZIP_LOCAL_HEADER = struct.Struct("<4s22xHH")  # signature, ..., name length, extra length
+
+_archives = {}
+_archives_lock = threading.Lock()
+
+
+class SessionArchive:
+    # Where every blob's bytes are in a session file. Files are opened per
+    # read, nothing stays open (a session can be saved over itself)
+    def __init__(self, path):
+        self.path = path
+        self.reindex()
+
+    def reindex(self):
+        index = {}
+        with zipfile.ZipFile(self.path) as archive, open(self.path, "rb") as f:
+            for info in archive.infolist():
+                if info.compress_type != zipfile.ZIP_STORED:
+                    raise ValueError(f"сжатая запись в файле сессии: {info.filename}")
+                f.seek(info.header_offset)
+                signature, name_length, extra_length = ZIP_LOCAL_HEADER.unpack(f.read(ZIP_LOCAL_HEADER.size))
+                if signature != b"PK\x03\x04":
+                    raise ValueError("файл сессии повреждён")
+                index[info.filename] = (info.header_offset + ZIP_LOCAL_HEADER.size + name_length + extra_length,
+                                        info.file_size)
+        self.index = index
+
+    def __contains__(self, name):
+        return name in self.index
+
+    def read(self, name, start=0, length=None):
+        offset, size = self.index[name]
+        if length is None:
+            length = size - start
+        with open(self.path, "rb") as f:
+            f.seek(offset + start)
+            return f.read(length)
+
+
+def get_archive(path):
+    key = os.path.normcase(os.path.abspath(path))
+    with _archives_lock:
+        if key not in _archives:
+            _archives[key] = SessionArchive(path)
+        return _archives[key]
+
+
+def parse_blob_header(data):
+    # (mode, size, band rows, [band offsets from the blob start], end)
+    magic, mode, width, height, band_rows, count = BLOB_HEADER.unpack_from(data)
+    if magic != MAGIC:
+        raise ValueError("файл сессии повреждён")
+    lengths = struct.unpack_from(f">{count}I", data, BLOB_HEADER.size)
+    offsets = [BLOB_HEADER.size + 4 * count]
+    for length in lengths:
+        offsets.append(offsets[-1] + length)
+    return mode.decode().strip(), (width, height), band_rows, offsets
+
+
+class SessionFrame:
+    # A memory frame stored in a session file, reads like a SpooledFrame
+    def __init__(self, archive, blob, size, mode="RGB", lines=None):
+        self.archive = archive
+        self.blob = blob
+        self.size = size
+        self.mode = mode
+        self.lines = lines
+        self._layout = None
+        self._band = None  # (index, rows) of the last decompressed band
+
+    @property
+    def width(self):
+        return self.size[0]
+
+    @property
+    def height(self):
+        return self.size[1]
+
+    @property
+    def row_bytes(self):
+        return self.width * len(self.mode)
+
+    def layout(self):
+        if self._layout is None:
+            count = BLOB_HEADER.unpack(self.archive.read(self.blob, 0, BLOB_HEADER.size))[5]
+            head = self.archive.read(self.blob, 0, BLOB_HEADER.size + 4 * count)
+            self._layout = parse_blob_header(head)[2:]
+        return self._layout
+
+    def band(self, i):
+        cached = self._band
+        if cached is None or cached[0] != i:
+            _, offsets = self.layout()
+            rows = zlib.decompress(self.archive.read(self.blob, offsets[i], offsets[i + 1] - offsets[i]))
+            cached = self._band = (i, rows)
+        return cached[1]
+
+    def read_rows(self, top, bottom):
+        top = max(0, top)
+        bottom = min(self.height, bottom)
+        band_rows, _ = self.layout()
+        parts = []
+        for i in range(top // band_rows, (bottom - 1) // band_rows + 1 if bottom > top else 0):
+            first = i * band_rows
+            rows = self.band(i)
+            parts.append(rows[(max(top, first) - first) * self.row_bytes:(min(bottom, first + band_rows) - first) * self.row_bytes])
+        return b"".join(parts)
+
+    def load(self):
+        return Image.frombytes(self.mode, self.size, self.read_rows(0, self.height))
+
+    def crop_rows(self, top, bottom):
+        top = max(0, top)
+        bottom = min(self.height, bottom)
+        return Image.frombytes(self.mode, (self.width, bottom - top), self.read_rows(top, bottom))
+
+    def blob_bytes(self):
+        return self.archive.read(self.blob)
+
+
+def layer_mode(image):
+    if image.mode in MODES:
+        return image
+    return image.convert("RGBA" if "A" in image.getbands() or "transparency" in image.info else "RGB")
+
+
+def raw_bands(source):
+    # Raw rows of a PIL image or a spooled frame, BAND_ROWS at a time
+    for top in range(0, source.height, BAND_ROWS):
+        bottom = min(source.height, top + BAND_ROWS)
+        if hasattr(source, "read_rows"):
+            yield source.read_rows(top, bottom)
+        else:
+            yield source.crop((0, top, source.width, bottom)).tobytes()
+
+
+def encode_blob(source, mode, pool):
+    # (name, blob bytes); bands are deflated on the pool (zlib releases the GIL)
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(f"{mode} {source.width}x{source.height}".encode())
+    futures = []
+    for raw in raw_bands(source):
+        digest.update(raw)
+        futures.append(pool.submit(zlib.compress, raw, COMPRESS_LEVEL))
+    bands = [future.result() for future in futures]
+    header = BLOB_HEADER.pack(MAGIC, mode.ljust(4).encode(), source.width, source.height, BAND_ROWS, len(bands))
+    data = header + struct.pack(f">{len(bands)}I", *map(len, bands)) + b"".join(bands)
+    return f"blobs/{digest.hexdigest()}", data
+
+
+def decode_blob(data):
+    mode, size, _, offsets = parse_blob_header(data)
+    raw = b"".join(zlib.decompress(data[start:end]) for start, end in zip(offsets, offsets[1:]))
+    return Image.frombytes(mode, size, raw)
+
+
+def save_session(path, state, progress=None):
+    # state: the app's history state plus "canvas" (width, height) and "settings" (anything JSON)
+    pinned = state.get("pinned", [])
+    images = [image for image in (state["bg_image"], state["chat_image"]) if image is not None]
+    total = len(images) + len(pinned) + len(state["memory"])
+    written = set()
+    temp_path = path + ".tmp"
+
+    with ThreadPoolExecutor(max_workers=WORKERS, thread_name_prefix="sosiska-session") as pool, \
+            zipfile.ZipFile(temp_path, "w", zipfile.ZIP_STORED) as archive:
+        def store(source):
+            if isinstance(source, SessionFrame):
+                # Same pixels, same name: the blob is copied as is
+                name, mode, data = source.blob, source.mode, None if source.blob in written else source.blob_bytes()
+            else:
+                if not hasattr(source, "read_rows"):
+                    source = layer_mode(source)
+                mode = source.mode
+                name, data = encode_blob(source, mode, pool)
+            if name not in written:
+                archive.writestr(name, data)
+                written.add(name)
+            if progress:
+                progress(len(written), total)
+            return {"blob": name, "mode": mode, "size": list(source.size)}
+
+        manifest = {"format": FORMAT, "canvas": list(state["canvas"]), "background": None, "chat": None,
+                    "magnetic_override": state["magnetic_override"], "settings": state.get("settings", {})}
+        if state["bg_image"] is not None:
+            manifest["background"] = dict(store(state["bg_image"]), x=state["bg_x"], y=state["bg_y"],
+                                          scale=state["bg_scale"])
+        if state["chat_image"] is not None:
+            manifest["chat"] = dict(store(state["chat_image"]), x=state["chat_x"], y=state["chat_y"],
+                                    cropped=state["chat_cropped"], outlined=state["chat_outlined"],
+                                    opacity=state.get("chat_opacity", 1.0))
+        manifest["pinned"] = [dict(store(layer.source), x=layer.x, y=layer.y, opacity=layer.opacity) for layer in pinned]
+        manifest["memory"] = []
+        for frame in state["memory"]:
+            lines = [[top, bottom, key.hex()] for top, bottom, key in frame.lines] if frame.lines else None
+            manifest["memory"].append(dict(store(frame), lines=lines))
+        archive.writestr(MANIFEST, json.dumps(manifest, ensure_ascii=False, indent=1))
+
+    os.replace(temp_path, path)
+    # Frames opened from this file find their blobs under the same names in the new one
+    key = os.path.normcase(os.path.abspath(path))
+    with _archives_lock:
+        if key in _archives:
+            _archives[key].reindex()
+    return [path]
+
+
+def open_session(path):
+    # The state save_session() was given; memory frames are SessionFrames
+    archive = get_archive(path)
+    archive.reindex()
+    if MANIFEST not in archive:
+        raise ValueError("это не файл сессии")
+    manifest = json.loads(archive.read(MANIFEST).decode("utf-8"))
+    if manifest.get("format", 0) > FORMAT:
+        raise ValueError("сессия сохранена более новой версией программы")
+
+    background = manifest["background"]
+    chat = manifest["chat"]
+    state = {
+        "canvas": tuple(manifest["canvas"]),
+        "settings": manifest.get("settings", {}),
+        "bg_image": decode_blob(archive.read(background["blob"])) if background else None,
+        "bg_x": background["x"] if background else 0,
+        "bg_y": background["y"] if background else 0,
+        "bg_scale": background["scale"] if background else 1.0,
+        "chat_image": decode_blob(archive.read(chat["blob"])) if chat else None,
+        "chat_x": chat["x"] if chat else 0,
+        "chat_y": chat["y"] if chat else 0,
+        "chat_cropped": chat["cropped"] if chat else False,
+        "chat_outlined": chat["outlined"] if chat else False,
+        "chat_opacity": chat.get("opacity", 1.0) if chat else 1.0,
+        "pinned": [Layer(decode_blob(archive.read(layer["blob"])), layer["x"], layer["y"], layer["opacity"])
+                   for layer in manifest.get("pinned", [])],
+        "magnetic_override": manifest.get("magnetic_override", False),
+        "memory": [],
+    }
+    for frame in manifest["memory"]:
+        lines = [(top, bottom, bytes.fromhex(key)) for top, bottom, key in frame["lines"]] if frame["lines"] else None
+        state["memory"].append(SessionFrame(archive, frame["blob"], tuple(frame["size"]), frame["mode"], lines))
+    return state
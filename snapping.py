@@ -0,0 +1,64 @@
+import bisect
+
+import autocrop
+
+# Magnetic snapping.
+# ContentCache keeps the chat's content bbox and text line baselines per image
+# revision, so they are computed once after an edit instead of on every mouse
+# move. Lines are found by brightness like overlap.text_lines: in the alpha
+# the outline halos of neighbouring lines touch from radius 3 on and the whole
+# chat would be one line. SnapIndex holds sorted guide positions per axis and finds the nearest
+# one with a binary search.
+
+
+class ContentInfo:
+    def __init__(self, image, threshold=50):
+        self.bbox = image.getbbox()
+        lines = autocrop.find_lines(image.convert("RGB"), threshold) if self.bbox else []
+        self.baselines = [bottom for top, bottom in lines]
+
+
+class ContentCache:
+    # revision must change whenever the image is edited in place
+    def __init__(self):
+        self.image = None
+        self.revision = None
+        self.threshold = None
+        self.info = None
+
+    def get(self, image, revision, threshold=50):
+        if image is not self.image or revision != self.revision or threshold != self.threshold:
+            self.info = ContentInfo(image, threshold)
+            self.image = image
+            self.revision = revision
+            self.threshold = threshold
+        return self.info
+
+
+class SnapIndex:
+    def __init__(self, vertical=(), horizontal=()):
+        self.vertical = sorted(set(vertical))
+        self.horizontal = sorted(set(horizontal))
+
+    def nearest(self, value, guides, tolerance):
+        i = bisect.bisect_left(guides, value)
+        best = None
+        for guide in guides[max(0, i - 1):i + 1]:
+            if abs(guide - value) < tolerance and (best is None or abs(guide - value) < abs(best - value)):
+                best = guide
+        return best
+
+    def snap(self, edges, guides, tolerance):
+        # Smallest shift that puts one of the edges on a guide, 0 if none is close enough
+        shift = None
+        for edge in edges:
+            guide = self.nearest(edge, guides, tolerance)
+            if guide is not None and (shift is None or abs(guide - edge) < abs(shift)):
+                shift = guide - edge
+        return shift or 0
+
+    def snap_x(self, edges, tolerance):
+        return self.snap(edges, self.vertical, tolerance)
+
+    def snap_y(self, edges, tolerance):
+        return self.snap(edges, self.horizontal, tolerance)
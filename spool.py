@@ -0,0 +1,77 @@
+import os
+import shutil
+import tempfile
+import threading
+import weakref
+
+from PIL import Image
+
+# Collage memory on disk.
+# Each frame saved to memory is written once as raw RGB rows into a temp
+# directory, RAM only holds a small SpooledFrame handle. Rows can be read back
+# in bands, so stitching never needs a whole frame (let alone all of them)
+# in memory. A frame's file is removed when nothing (memory list, undo history)
+# references the handle any more; the directory is removed on exit.
+
+
+class SpooledFrame:
+    def __init__(self, path, size, mode="RGB", lines=None):
+        self.path = path
+        self.size = size
+        self.mode = mode
+        self.lines = lines  # [(top, bottom, key)] of the chat lines, for overlap-aware stitching
+        self._finalizer = weakref.finalize(self, _remove, path)
+
+    @property
+    def width(self):
+        return self.size[0]
+
+    @property
+    def height(self):
+        return self.size[1]
+
+    @property
+    def row_bytes(self):
+        return self.width * len(self.mode)
+
+    def read_rows(self, top, bottom):
+        top = max(0, top)
+        bottom = min(self.height, bottom)
+        with open(self.path, "rb") as f:
+            f.seek(top * self.row_bytes)
+            return f.read((bottom - top) * self.row_bytes)
+
+    def load(self):
+        return Image.frombytes(self.mode, self.size, self.read_rows(0, self.height))
+
+    def crop_rows(self, top, bottom):
+        top = max(0, top)
+        bottom = min(self.height, bottom)
+        return Image.frombytes(self.mode, (self.width, bottom - top), self.read_rows(top, bottom))
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+class FrameSpool:
+    def __init__(self, directory=None):
+        self.directory = directory or tempfile.mkdtemp(prefix="sosiska-memory-")
+        self.counter = 0
+        self.lock = threading.Lock()  # The folder watcher spools from its own thread
+        self._finalizer = weakref.finalize(self, shutil.rmtree, self.directory, True)
+
+    def append(self, image, lines=None):
+        image = image.convert("RGB")
+        with self.lock:
+            self.counter += 1
+            path = os.path.join(self.directory, f"frame-{self.counter:06d}.raw")
+        with open(path, "wb") as f:
+            f.write(image.tobytes())
+        return SpooledFrame(path, image.size, image.mode, lines)
+
+    def close(self):
+        self._finalizer()
@@ -0,0 +1,128 @@
+import builtins
+import json
+import os
+import sys
+import time
+
+# Startup profiler.
+# Imported first thing by SoSiska.py; with SOSISKA_STARTUP set it times every
+# import that actually loads a module (inclusive, so a package shows what it
+# pulls in) and the marks the app sets on its way to the window - imports
+# done, Tk up, widgets built, first paint. SOSISKA_STARTUP=1 prints the
+# report to stderr when the window has painted, any other value is a path for
+# a JSON report (the windowed .exe has no console). SOSISKA_STARTUP_QUIT=1
+# closes the app right after, benchmarks/bench_startup.py runs it that way.
+# Without the variable nothing is wrapped or recorded.
+# "process" is how long the process existed before this module ran: the
+# interpreter start, and unpacking in a frozen one-file build.
+
+TARGET = os.environ.get("SOSISKA_STARTUP")
+ENABLED = bool(TARGET)
+QUIT = os.environ.get("SOSISKA_STARTUP_QUIT") == "1"
+TOP_IMPORTS = 25
+
+START = time.perf_counter()
+marks = []  # (name, ms since START)
+imports = []  # (ms, depth, module) of imports that loaded something
+_depth = 0
+_original_import = builtins.__import__
+reported = False
+
+
+def process_age():
+    # Seconds between process creation and now, None where it can't be told
+    try:
+        if sys.platform.startswith("linux"):
+            with open("/proc/self/stat") as f:
+                ticks = int(f.read().rsplit(")", 1)[1].split()[19])
+            with open("/proc/uptime") as f:
+                uptime = float(f.read().split()[0])
+            return uptime - ticks / os.sysconf("SC_CLK_TCK")
+        if sys.platform == "win32":
+            import ctypes
+            from ctypes import wintypes
+            created, exited, kernel, user = (wintypes.FILETIME() for _ in range(4))
+            kernel32 = ctypes.windll.kernel32
+            kernel32.GetProcessTimes(kernel32.GetCurrentProcess(), ctypes.byref(created), ctypes.byref(exited),
+                                     ctypes.byref(kernel), ctypes.byref(user))
+            now = wintypes.FILETIME()
+            kernel32.GetSystemTimeAsFileTime(ctypes.byref(now))
+
+            def ticks(filetime):
+                return (filetime.dwHighDateTime << 32) | filetime.dwLowDateTime
+            return (ticks(now) - ticks(created)) / 10_000_000
+    except (OSError, ValueError, IndexError, AttributeError):
+        pass
+    return None
+
+
+_before = process_age() if ENABLED else None
+
+
+def _timed_import(name, globals=None, locals=None, fromlist=(), level=0):
+    global _depth
+    # `from PIL import ImageDraw` loads PIL.ImageDraw even with PIL loaded already
+    loads = [f"{name}.{item}" for item in fromlist or () if f"{name}.{item}" not in sys.modules and item != "*"]
+    if level or (name in sys.modules and not loads):
+        return _original_import(name, globals, locals, fromlist, level)
+    label = f"{name} ({', '.join(fromlist)})" if name in sys.modules else name
+    _depth += 1
+    start = time.perf_counter()
+    try:
+        return _original_import(name, globals, locals, fromlist, level)
+    finally:
+        _depth -= 1
+        imports.append(((time.perf_counter() - start) * 1000, _depth, label))
+
+
+if ENABLED:
+    builtins.__import__ = _timed_import
+
+
+def mark(name):
+    if ENABLED:
+        marks.append((name, (time.perf_counter() - START) * 1000))
+
+
+def report():
+    return {
+        "process_ms": round(_before * 1000, 1) if _before is not None else None,
+        "marks_ms": {name: round(ms, 1) for name, ms in marks},
+        "imports_ms": [{"module": name, "ms": round(ms, 2), "depth": depth}
+                       for ms, depth, name in sorted(imports, reverse=True)[:TOP_IMPORTS]],
+        "frozen": bool(getattr(sys, "frozen", False)),
+    }
+
+
+def format_report(data):
+    lines = []
+    if data["process_ms"] is not None:
+        lines.append(f"{'process':<24} {data['process_ms']:>8.1f} ms before the first import")
+    for name, ms in data["marks_ms"].items():
+        lines.append(f"{name:<24} {ms:>8.1f} ms")
+    lines.append("slowest imports (inclusive):")
+    for entry in data["imports_ms"]:
+        lines.append(f"  {'  ' * entry['depth']}{entry['module']:<30} {entry['ms']:>8.2f} ms")
+    return "\n".join(lines)
+
+
+def write_report():
+    data = report()
+    if TARGET == "1":
+        print(format_report(data), file=sys.stderr)
+    else:
+        with open(TARGET, "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False, indent=2)
+
+
+def finish(master):
+    # First paint happened: report once, and quit when asked to
+    global reported
+    if not ENABLED or reported:
+        return
+    reported = True
+    builtins.__import__ = _original_import
+    mark("first_paint")
+    write_report()
+    if QUIT:
+        master.after_idle(master.destroy)
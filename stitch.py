@@ -0,0 +1,277 @@
+import os
+import struct
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from PIL import Image
+
+import encoding
+import overlap
+
+# Vertical collage stitching with bounded memory.
+# PNG output is streamed: rows are read from the frames in bands, compressed
+# and written as IDAT chunks right away, so peak RAM is one band no matter
+# how many frames there are. With workers > 1 the bands are deflated on a
+# thread pool (zlib releases the GIL): every band becomes a sync-flushed raw
+# deflate block, the blocks are concatenated in order and the writer adds the
+# zlib header and the adler32 of all rows itself.
+# PIL can't write JPEG and friends incrementally - for those the collage is
+# assembled in memory, split into numbered parts if it is taller than the
+# format allows, and the parts are encoded in parallel.
+# With merge_overlap the rows a frame repeats from the previous one (see
+# overlap.py) are cut off first, so the collage reads as one continuous log.
+
+BAND_ROWS = 256
+WHITE = 255
+ZLIB_HEADER = b"\x78\x9c"
+
+
+class PngStreamWriter:
+    def __init__(self, path, width, height, mode="RGB", compress_level=6):
+        if mode not in ("RGB", "RGBA", "L"):
+            raise ValueError(f"unsupported PNG mode: {mode}")
+        self.path = path
+        self.width = width
+        self.height = height
+        self.channels = len(mode)
+        self.rows_written = 0
+        self.compress_level = compress_level
+        self.compressor = zlib.compressobj(compress_level, zlib.DEFLATED, -zlib.MAX_WBITS)
+        self.adler = 1
+        self.started = False
+        self.file = open(path, "wb")
+        color_type = {"L": 0, "RGB": 2, "RGBA": 6}[mode]
+        self.file.write(b"\x89PNG\r\n\x1a\n")
+        self._chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, color_type, 0, 0, 0))
+
+    def _chunk(self, kind, data):
+        self.file.write(struct.pack(">I", len(data)))
+        self.file.write(kind)
+        self.file.write(data)
+        self.file.write(struct.pack(">I", zlib.crc32(data, zlib.crc32(kind)) & 0xFFFFFFFF))
+
+    def _idat(self, data):
+        if not self.started:
+            data = ZLIB_HEADER + data
+            self.started = True
+        if data:
+            self._chunk(b"IDAT", data)
+
+    def write_rows(self, data):
+        raw = filter_rows(data, self.width * self.channels)
+        self.write_deflated(raw, self.compressor.compress(raw))
+
+    def write_deflated(self, raw, compressed):
+        # compressed: raw deflate data of `raw` (filtered rows), either from
+        # self.compressor or a sync-flushed block from deflate_block()
+        self.adler = zlib.adler32(raw, self.adler)
+        self.rows_written += len(raw) // (self.width * self.channels + 1)
+        self._idat(compressed)
+
+    def close(self):
+        if self.file.closed:
+            return
+        if self.rows_written != self.height:
+            self.file.close()
+            raise ValueError(f"PNG: записано {self.rows_written} строк из {self.height}")
+        self._idat(self.compressor.flush() + struct.pack(">I", self.adler & 0xFFFFFFFF))
+        self._chunk(b"IEND", b"")
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.file.close()
+
+
+def filter_rows(data, stride):
+    # Every PNG row starts with its filter type, 0 = none
+    return b"".join(b"\x00" + data[i:i + stride] for i in range(0, len(data), stride))
+
+
+def deflate_block(raw, compress_level):
+    compressor = zlib.compressobj(compress_level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    return compressor.compress(raw) + compressor.flush(zlib.Z_SYNC_FLUSH)
+
+
+def frame_rows(frame, top, bottom):
+    # Raw RGB rows of a spooled frame or a PIL image
+    if hasattr(frame, "read_rows"):
+        return frame.read_rows(top, bottom)
+    return frame.crop((0, top, frame.width, bottom)).convert("RGB").tobytes()
+
+
+def pad_rows(data, width, target_width):
+    if width == target_width:
+        return data
+    stride = width * 3
+    pad = bytes([WHITE]) * ((target_width - width) * 3)
+    return b"".join(data[i:i + stride] + pad for i in range(0, len(data), stride))
+
+
+def iter_bands(frames, band_rows=BAND_ROWS):
+    # (frame, top, bottom) pieces in output order
+    for frame in frames:
+        for top in range(0, frame.height, band_rows):
+            yield frame, top, min(frame.height, top + band_rows)
+
+
+def encode_band(frame, top, bottom, width, compress_level):
+    raw = filter_rows(pad_rows(frame_rows(frame, top, bottom), frame.width, width), width * 3)
+    return raw, deflate_block(raw, compress_level)
+
+
+def stitch_png(frames, path, band_rows=BAND_ROWS, compress_level=6, progress=None, workers=1):
+    width = max(frame.width for frame in frames)
+    height = sum(frame.height for frame in frames)
+    with PngStreamWriter(path, width, height, "RGB", compress_level) as writer:
+        if workers <= 1:
+            for frame, top, bottom in iter_bands(frames, band_rows):
+                writer.write_rows(pad_rows(frame_rows(frame, top, bottom), frame.width, width))
+                if progress:
+                    progress(writer.rows_written, height)
+            return [path]
+
+        # At most 2 bands per worker are in flight, memory stays bounded
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="sosiska-png") as pool:
+            window = deque()
+            bands = iter_bands(frames, band_rows)
+            while True:
+                for frame, top, bottom in bands:
+                    window.append(pool.submit(encode_band, frame, top, bottom, width, compress_level))
+                    if len(window) >= workers * 2:
+                        break
+                if not window:
+                    break
+                writer.write_deflated(*window.popleft().result())
+                if progress:
+                    progress(writer.rows_written, height)
+    return [path]
+
+
+class FrameSlice:
+    # Rows [top, bottom) of a frame, can be stitched like a frame
+    def __init__(self, frame, top, bottom):
+        self.frame = frame
+        self.top = top
+        self.bottom = bottom
+
+    @property
+    def width(self):
+        return self.frame.width
+
+    @property
+    def height(self):
+        return self.bottom - self.top
+
+    def read_rows(self, top, bottom):
+        return frame_rows(self.frame, self.top + top, self.top + min(bottom, self.height))
+
+
+def frame_keys(frame, band_rows=BAND_ROWS):
+    # Row hashes and the first textured row of a frame, read in bands
+    stride = frame.width * 3
+    keys = []
+    textured = None
+    for top in range(0, frame.height, band_rows):
+        data = frame_rows(frame, top, min(frame.height, top + band_rows))
+        keys += overlap.row_keys(data, stride)
+        if textured is None:
+            textured = overlap.first_textured_row(data, stride, top)
+    return keys, textured
+
+
+def merge_overlaps(frames):
+    # Frames (or FrameSlices) without what repeats the previous frame. Text
+    # line keys are used when both frames have them, pixel rows otherwise
+    tops = [0] * len(frames)
+    bottoms = [frame.height for frame in frames]
+    cached = {}
+
+    def rows(i):
+        # Keys of the last two frames are kept, each frame is hashed once
+        if i not in cached:
+            for old in [j for j in cached if j < i - 1]:
+                del cached[old]
+            cached[i] = frame_keys(frames[i])
+        return cached[i]
+
+    for i in range(1, len(frames)):
+        a_lines = getattr(frames[i - 1], "lines", None)
+        b_lines = getattr(frames[i], "lines", None)
+        if a_lines and b_lines:
+            k = overlap.longest_overlap([line[2] for line in a_lines], [line[2] for line in b_lines],
+                                        lambda k: k >= overlap.MIN_OVERLAP_LINES)
+            if k:
+                # Previous frame ends after its last line, this one goes on after the repeated ones
+                bottoms[i - 1] = max(tops[i - 1], a_lines[-1][1])
+                tops[i] = b_lines[k - 1][1]
+        elif frames[i - 1].width == frames[i].width:
+            a_keys, _ = rows(i - 1)
+            b_keys, textured = rows(i)
+            k = overlap.longest_overlap(a_keys, b_keys,
+                                        lambda k: k >= overlap.MIN_OVERLAP_ROWS and textured is not None and k > textured)
+            tops[i] = max(tops[i], k)
+
+    merged = []
+    for frame, top, bottom in zip(frames, tops, bottoms):
+        if bottom <= top:
+            continue
+        merged.append(frame if (top, bottom) == (0, frame.height) else FrameSlice(frame, top, bottom))
+    return merged
+
+
+def split_parts(frames, max_height):
+    parts = [[]]
+    height = 0
+    for frame in frames:
+        if parts[-1] and height + frame.height > max_height:
+            parts.append([])
+            height = 0
+        parts[-1].append(frame)
+        height += frame.height
+    return parts
+
+
+def stitch_image(frames):
+    width = max(frame.width for frame in frames)
+    combined = Image.new("RGB", (width, sum(frame.height for frame in frames)), "white")
+    y = 0
+    for frame in frames:
+        for top in range(0, frame.height, BAND_ROWS):
+            bottom = min(frame.height, top + BAND_ROWS)
+            band = Image.frombytes("RGB", (frame.width, bottom - top), frame_rows(frame, top, bottom))
+            combined.paste(band, (0, y + top))
+        y += frame.height
+    return combined
+
+
+def stitch_vertical(frames, path, progress=None, options=None, workers=1):
+    # Returns the list of files written. options: see encoding.DEFAULT_OPTIONS
+    if not frames:
+        raise ValueError("нет кадров для склейки")
+    fmt = encoding.image_format(path)
+    options = encoding.export_options(options)
+    if options["merge_overlap"]:
+        frames = merge_overlaps(frames)
+    if fmt == "PNG":
+        return stitch_png(frames, path, compress_level=options["png_compress_level"], progress=progress, workers=workers)
+
+    parts = split_parts(frames, encoding.MAX_SIDE.get(fmt, 2 ** 31))
+    base, ext = os.path.splitext(path)
+    paths = [path] if len(parts) == 1 else [f"{base}_{i:03d}{ext}" for i in range(1, len(parts) + 1)]
+
+    def encode(i):
+        return encoding.save(stitch_image(parts[i]), paths[i], options)
+
+    # Every part is a whole image in memory, so not more of them than workers
+    with ThreadPoolExecutor(max_workers=max(1, min(workers, len(parts))), thread_name_prefix="sosiska-encode") as pool:
+        for done, _ in enumerate(pool.map(encode, range(len(parts))), 1):
+            if progress:
+                progress(done, len(parts))
+    return paths
@@ -0,0 +1,343 @@
+import queue
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+
+import tkinter as tk
+from PIL import Image, ImageTk
+
+from stitch import frame_rows, merge_overlaps
+from tiles import TileCache
+
+# Memory view: a thumbnail strip of the collage memory and a preview of the
+# stitched result, without exporting anything.
+# Thumbnails are made on a worker thread: a frame is read in bands, each band
+# reduce()d by an integer factor and pasted into a small image that thumbnail()
+# brings to the final size - a whole frame is never decoded at once. They are
+# kept per frame handle (weakly, a frame dropped from memory and history takes
+# its thumbnail along), so reordering frames costs nothing, and only the
+# thumbnails scrolled into view are asked for. The app shuts the cache and its
+# thread down when the view is closed.
+# The preview is laid out like stitch_vertical() would stitch it (repeated
+# chat lines merged away when the export settings say so; the layout is found
+# on the worker thread) and only the rows in view are read, in tiles of
+# PREVIEW_TILE rows kept in a TileCache.
+# Frames are reordered by dragging a thumbnail or with the buttons, the app
+# gets the new list and records it in the undo history.
+
+THUMB_SIZE = (120, 120)
+THUMB_BAND = 32  # Reduced rows per band read from a frame
+THUMB_GAP = 8
+PREVIEW_TILE = 256
+PREVIEW_CACHE_BYTES = 48 * 1024 * 1024
+POLL_MS = 30
+
+
+def frame_image(frame, top, bottom):
+    return Image.frombytes("RGB", (frame.width, bottom - top), frame_rows(frame, top, bottom))
+
+
+def make_thumbnail(frame, size=THUMB_SIZE):
+    factor = max(1, min(frame.width // size[0], frame.height // size[1]))
+    step = factor * THUMB_BAND
+    reduced = Image.new("RGB", (-(-frame.width // factor), -(-frame.height // factor)), "white")
+    for top in range(0, frame.height, step):
+        band = frame_image(frame, top, min(frame.height, top + step))
+        reduced.paste(band.reduce(factor) if factor > 1 else band, (0, top // factor))
+    reduced.thumbnail(size)
+    return reduced
+
+
+class CollageLayout:
+    # Where every frame (or the part of it that is kept) lands in the collage
+    def __init__(self, frames, merge=True):
+        self.parts = merge_overlaps(frames) if merge and len(frames) > 1 else list(frames)
+        self.tops = []
+        height = 0
+        for part in self.parts:
+            self.tops.append(height)
+            height += part.height
+        self.width = max((part.width for part in self.parts), default=0)
+        self.height = height
+
+    def rows(self, top, bottom):
+        # Collage rows [top, bottom) as an image, narrower frames padded with white
+        image = Image.new("RGB", (self.width, bottom - top), "white")
+        for part, part_top in zip(self.parts, self.tops):
+            start, end = max(top, part_top), min(bottom, part_top + part.height)
+            if start < end:
+                image.paste(frame_image(part, start - part_top, end - part_top), (0, start - top))
+        return image
+
+
+class ThumbnailCache:
+    def __init__(self, master, size=THUMB_SIZE):
+        self.master = master
+        self.size = size
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sosiska-thumbs")
+        self.photos = weakref.WeakKeyDictionary()  # frame -> PhotoImage
+        self.waiting = {}  # frame -> [callbacks], while its thumbnail is being made
+        self.results = queue.Queue()
+        self.pending = 0
+        self.polling = False
+        self.stopped = False
+
+    def get(self, frame, callback):
+        # callback(photo) on the Tk thread, right away when the thumbnail is there
+        photo = self.photos.get(frame)
+        if photo is not None:
+            callback(photo)
+            return
+        if frame in self.waiting:
+            self.waiting[frame].append(callback)
+            return
+        self.waiting[frame] = [callback]
+        self.submit(lambda: make_thumbnail(frame, self.size), lambda image: self.on_thumbnail(frame, image),
+                    lambda e: self.waiting.pop(frame, None))
+
+    def on_thumbnail(self, frame, image):
+        photo = self.photos[frame] = ImageTk.PhotoImage(image)
+        for callback in self.waiting.pop(frame, ()):
+            callback(photo)
+
+    def submit(self, task, on_done, on_error=None):
+        # task() on the worker thread, on_done(result) or on_error(exception) on the Tk thread
+        self.pending += 1
+        self.executor.submit(self._work, task, on_done, on_error)
+        if not self.polling:
+            self.polling = True
+            self.master.after(POLL_MS, self._poll)
+
+    def _work(self, task, on_done, on_error):
+        try:
+            self.results.put((on_done, task()))
+        except Exception as e:
+            self.results.put((on_error, e))
+
+    def _poll(self):
+        if self.stopped:
+            self.polling = False
+            return
+        while True:
+            try:
+                callback, arg = self.results.get_nowait()
+            except queue.Empty:
+                break
+            self.pending -= 1
+            if callback:
+                callback(arg)
+
+        if self.pending:
+            self.master.after(POLL_MS, self._poll)
+        else:
+            self.polling = False
+
+    def shutdown(self):
+        # Queued work is dropped, results of a task still running are never delivered
+        self.executor.shutdown(wait=False, cancel_futures=True)
+        self.stopped = True
+        self.waiting.clear()
+        self.photos.clear()
+
+
+class MemoryWindow:
+    def __init__(self, master, thumbnails, on_change, on_close=None):
+        # on_change(frames) gets the reordered list, on_close() is called when the window is closed
+        self.thumbnails = thumbnails
+        self.on_change = on_change
+        self.on_close = on_close
+        self.frames = []
+        self.merge = True
+        self.selected = None
+        self.dragging = None
+        self.layout = None
+        self.layout_ticket = 0
+        self.shown = set()  # Strip slots whose thumbnail was asked for
+        self.preview_items = {}  # tile index -> canvas item
+        self.preview_tiles = TileCache(PREVIEW_CACHE_BYTES)
+        self.slot = THUMB_SIZE[0] + THUMB_GAP
+
+        self.top = tk.Toplevel(master)
+        self.top.title("Память")
+        self.top.geometry("760x820")
+        self.top.protocol("WM_DELETE_WINDOW", self.close)
+
+        strip_frame = tk.Frame(self.top)
+        strip_frame.pack(fill=tk.X)
+        self.strip = tk.Canvas(strip_frame, height=THUMB_SIZE[1] + 24, bg="#d0d0d0", highlightthickness=0)
+        self.strip.pack(fill=tk.X)
+        strip_scroll = tk.Scrollbar(strip_frame, orient=tk.HORIZONTAL, command=self.scroll_strip)
+        strip_scroll.pack(fill=tk.X)
+        self.strip.config(xscrollcommand=lambda first, last: (strip_scroll.set(first, last), self.show_thumbnails()))
+        self.strip.bind("<ButtonPress-1>", self.start_drag)
+        self.strip.bind("<ButtonRelease-1>", self.drop)
+        self.strip.bind("<Configure>", lambda event: self.show_thumbnails())
+
+        buttons = tk.Frame(self.top)
+        buttons.pack(pady=4)
+        tk.Button(buttons, text="< Левее", command=lambda: self.move_selected(-1)).pack(side=tk.LEFT, padx=5)
+        tk.Button(buttons, text="Правее >", command=lambda: self.move_selected(1)).pack(side=tk.LEFT, padx=5)
+        tk.Button(buttons, text="Удалить", command=self.delete_selected).pack(side=tk.LEFT, padx=5)
+        self.status = tk.Label(buttons, text="")
+        self.status.pack(side=tk.LEFT, padx=10)
+
+        preview_frame = tk.Frame(self.top)
+        preview_frame.pack(fill=tk.BOTH, expand=True)
+        self.preview = tk.Canvas(preview_frame, bg="#808080", highlightthickness=0)
+        preview_scroll = tk.Scrollbar(preview_frame, orient=tk.VERTICAL, command=self.preview.yview)
+        preview_scroll.pack(side=tk.RIGHT, fill=tk.Y)
+        self.preview.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
+        self.preview.config(yscrollcommand=lambda first, last: (preview_scroll.set(first, last), self.show_preview()))
+        self.preview.bind("<Configure>", lambda event: self.show_preview())
+        self.preview.bind("<MouseWheel>", lambda event: self.preview.yview_scroll(-event.delta // 120 * 3, "units"))
+        self.preview.bind("<Button-4>", lambda event: self.preview.yview_scroll(-3, "units"))
+        self.preview.bind("<Button-5>", lambda event: self.preview.yview_scroll(3, "units"))
+
+    def raise_(self):
+        self.top.deiconify()
+        self.top.lift()
+
+    def close(self):
+        self.top.destroy()
+        if self.on_close:
+            self.on_close()
+
+    def refresh(self, frames, merge=True):
+        # Memory changed (or was reordered here): strip and preview follow
+        if frames == self.frames and merge == self.merge and self.layout is not None:
+            return
+        self.frames = list(frames)
+        self.merge = merge
+        if self.selected is not None and self.selected >= len(self.frames):
+            self.selected = len(self.frames) - 1 if self.frames else None
+        self.draw_strip()
+        self.update_layout()
+
+    # Strip
+
+    def scroll_strip(self, *args):
+        self.strip.xview(*args)
+
+    def draw_strip(self):
+        self.strip.delete("all")
+        height = THUMB_SIZE[1]
+        for i in range(len(self.frames)):
+            x = i * self.slot + THUMB_GAP // 2
+            self.strip.create_rectangle(x - 2, 2, x + THUMB_SIZE[0] + 2, height + 6,
+                                        outline="blue" if i == self.selected else "#a0a0a0",
+                                        width=3 if i == self.selected else 1, tags=(f"slot{i}",))
+            self.strip.create_text(x + THUMB_SIZE[0] // 2, height + 15, text=str(i + 1))
+        self.strip.config(scrollregion=(0, 0, max(1, len(self.frames) * self.slot), height + 24))
+        self.shown = set()
+        self.show_thumbnails()
+
+    def visible_slots(self):
+        left = int(self.strip.canvasx(0))
+        right = int(self.strip.canvasx(self.strip.winfo_width()))
+        return range(max(0, left // self.slot), min(len(self.frames), right // self.slot + 1))
+
+    def show_thumbnails(self):
+        # Only the thumbnails in view are made
+        for i in self.visible_slots():
+            if i in self.shown:
+                continue
+            self.shown.add(i)
+            frame = self.frames[i]
+            self.thumbnails.get(frame, lambda photo, i=i, frame=frame: self.put_thumbnail(i, frame, photo))
+
+    def put_thumbnail(self, i, frame, photo):
+        if not self.top.winfo_exists() or i >= len(self.frames) or self.frames[i] is not frame:
+            return  # Closed, or reordered meanwhile and the strip was redrawn
+        x = i * self.slot + THUMB_GAP // 2
+        item = self.strip.create_image(x + (THUMB_SIZE[0] - photo.width()) // 2, 4 + (THUMB_SIZE[1] - photo.height()) // 2,
+                                       anchor=tk.NW, image=photo)
+        self.strip.tag_raise(f"slot{i}", item)
+
+    def slot_at(self, event):
+        return int(self.strip.canvasx(event.x)) // self.slot
+
+    def start_drag(self, event):
+        i = self.slot_at(event)
+        if 0 <= i < len(self.frames):
+            self.dragging = i
+            self.select(i)
+
+    def drop(self, event):
+        source, self.dragging = self.dragging, None
+        if source is None:
+            return
+        target = max(0, min(len(self.frames) - 1, self.slot_at(event)))
+        if target != source:
+            self.move(source, target)
+
+    def select(self, i):
+        self.selected = i
+        for j in range(len(self.frames)):
+            self.strip.itemconfig(f"slot{j}", outline="blue" if j == i else "#a0a0a0", width=3 if j == i else 1)
+        if self.layout is not None and self.frames:
+            self.scroll_to_frame(i)
+
+    def move(self, source, target):
+        frames = list(self.frames)
+        frames.insert(target, frames.pop(source))
+        self.selected = target
+        self.on_change(frames)
+
+    def move_selected(self, step):
+        if self.selected is not None and 0 <= self.selected + step < len(self.frames):
+            self.move(self.selected, self.selected + step)
+
+    def delete_selected(self):
+        if self.selected is not None:
+            frames = list(self.frames)
+            del frames[self.selected]
+            self.on_change(frames)
+
+    # Preview
+
+    def update_layout(self):
+        # Merging needs the frames' row hashes when they have no text lines, so it runs on the worker
+        self.layout_ticket += 1
+        ticket = self.layout_ticket
+        frames, merge = list(self.frames), self.merge
+        self.status.config(text="Склейка...")
+        self.thumbnails.submit(lambda: CollageLayout(frames, merge), lambda layout: self.on_layout(ticket, layout),
+                               lambda e: self.on_layout_error(ticket, e))
+
+    def on_layout_error(self, ticket, error):
+        if ticket == self.layout_ticket and self.top.winfo_exists():
+            self.status.config(text=f"Ошибка: {error}")
+
+    def on_layout(self, ticket, layout):
+        if ticket != self.layout_ticket or not self.top.winfo_exists():
+            return
+        self.layout = layout
+        self.preview.delete("all")
+        self.preview_items = {}
+        self.preview_tiles.clear()
+        self.preview.config(scrollregion=(0, 0, layout.width, layout.height))
+        self.status.config(text=f"Кадров: {len(self.frames)}, склейка {layout.width}x{layout.height}")
+        self.show_preview()
+
+    def scroll_to_frame(self, i):
+        # The frame's first kept row at the top of the preview
+        frame = self.frames[i]
+        for part, top in zip(self.layout.parts, self.layout.tops):
+            if part is frame or getattr(part, "frame", None) is frame:
+                self.preview.yview_moveto(top / max(1, self.layout.height))
+                return
+
+    def show_preview(self):
+        layout = self.layout
+        if layout is None or not layout.height:
+            return
+        top = int(self.preview.canvasy(0))
+        bottom = int(self.preview.canvasy(self.preview.winfo_height()))
+        visible = set(range(max(0, top // PREVIEW_TILE), min(layout.height - 1, bottom) // PREVIEW_TILE + 1))
+        for index in [index for index in self.preview_items if index not in visible]:
+            self.preview.delete(self.preview_items.pop(index))
+        for index in self.preview_items:
+            self.preview_tiles.touch((self.layout_ticket, index))
+        for index in visible - self.preview_items.keys():
+            rows = (index * PREVIEW_TILE, min(layout.height, (index + 1) * PREVIEW_TILE))
+            photo = self.preview_tiles.get((self.layout_ticket, index), lambda rows=rows: layout.rows(*rows))
+            self.preview_items[index] = self.preview.create_image(0, rows[0], anchor=tk.NW, image=photo)
@@ -0,0 +1,132 @@
+from collections import OrderedDict
+
+import tkinter as tk
+from PIL import ImageTk
+
+from scaling import scale_key
+
+# Tiled background layer for the canvas scene.
+# The scaled background is split into TILE_SIZE squares and only the tiles
+# that overlap the canvas get a PhotoImage and a canvas item. Panning moves
+# the existing items and adds/removes tiles at the edges. Tile PhotoImages are
+# kept in an LRU cache (limited in bytes), keyed by scale, quality and tile
+# position, so panning back or returning to an earlier scale is free. Keys
+# don't hold the ScaledImageCache: a new background starts a new generation
+# and clears the layer's cache, the old one can be freed right away.
+# The view passed to update() is (ScaledImageCache, scale, final).
+
+TILE_SIZE = 256
+TILE_CACHE_BYTES = 96 * 1024 * 1024
+
+
+class TileCache:
+    def __init__(self, max_bytes=TILE_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.photos = OrderedDict()
+
+    def get(self, key, render):
+        photo = self.photos.get(key)
+        if photo is not None:
+            self.photos.move_to_end(key)
+            return photo
+
+        photo = ImageTk.PhotoImage(render())
+        self.photos[key] = photo
+        self.nbytes += photo.width() * photo.height() * 4
+        while self.nbytes > self.max_bytes and len(self.photos) > 1:
+            _, old = self.photos.popitem(last=False)
+            self.nbytes -= old.width() * old.height() * 4
+        return photo
+
+    def touch(self, key):
+        # Tiles on screen must not be evicted, Tk would blank them
+        if key in self.photos:
+            self.photos.move_to_end(key)
+
+    def clear(self):
+        self.photos.clear()
+        self.nbytes = 0
+
+
+class TileLayer:
+    def __init__(self, canvas, frame_color, tile_size=TILE_SIZE, cache=None):
+        self.canvas = canvas
+        self.frame_color = frame_color
+        self.tile_size = tile_size
+        self.cache = cache or TileCache()
+        self.tag = f"tiles{id(self)}"
+        self.frame_id = None
+        self.items = {}  # (tx, ty) -> canvas item
+        self.scaler = None
+        self.generation = 0
+        self.view = None
+        self.x = None
+        self.y = None
+        self.size = None
+
+    def visible_tiles(self, size, x, y, viewport):
+        t = self.tile_size
+        x1, y1 = max(0, -x), max(0, -y)
+        x2, y2 = min(size[0], viewport[0] - x), min(size[1], viewport[1] - y)
+        if x2 <= x1 or y2 <= y1:
+            return set()
+        return {(tx, ty) for tx in range(x1 // t, (x2 - 1) // t + 1) for ty in range(y1 // t, (y2 - 1) // t + 1)}
+
+    def update(self, view, x, y, viewport, above):
+        if view is None:
+            self.remove()
+            return above
+
+        scaler, scale, final = view
+        if scaler is not self.scaler:
+            # Another background, its tiles are of no use; the items go below
+            self.cache.clear()
+            self.scaler = scaler
+            self.generation += 1
+        size = scaler.scaled_size(scale)
+        key = (self.generation, scale_key(scale), final)
+
+        if self.frame_id is None:
+            self.frame_id = self.canvas.create_rectangle(x, y, x + size[0], y + size[1], outline=self.frame_color)
+            self.canvas.tag_raise(self.frame_id, above)
+        elif (x, y, size) != (self.x, self.y, self.size):
+            self.canvas.coords(self.frame_id, x, y, x + size[0], y + size[1])
+
+        if key != self.view:
+            self.canvas.delete(self.tag)
+            self.items = {}
+            self.view = key
+        elif (x, y) != (self.x, self.y) and self.items:
+            self.canvas.move(self.tag, x - self.x, y - self.y)
+        self.x, self.y, self.size = x, y, size
+
+        visible = self.visible_tiles(size, x, y, viewport)
+        for tile in [tile for tile in self.items if tile not in visible]:
+            self.canvas.delete(self.items.pop(tile))
+        for tile in self.items:
+            self.cache.touch(key + tile)
+        for tile in visible - self.items.keys():
+            photo = self.cache.get(key + tile, lambda tile=tile: scaler.render_box(scale, self.tile_box(tile, size), final))
+            tx, ty = tile
+            item = self.canvas.create_image(x + tx * self.tile_size, y + ty * self.tile_size,
+                                            anchor=tk.NW, image=photo, tags=(self.tag,))
+            self.canvas.tag_lower(item, self.frame_id)
+            self.items[tile] = item
+        return self.frame_id
+
+    def tile_box(self, tile, size):
+        t = self.tile_size
+        tx, ty = tile
+        return tx * t, ty * t, min(size[0], (tx + 1) * t), min(size[1], (ty + 1) * t)
+
+    def remove(self):
+        self.canvas.delete(self.tag)
+        if self.frame_id is not None:
+            self.canvas.delete(self.frame_id)
+        self.items = {}
+        self.frame_id = None
+        self.scaler = None
+        self.cache.clear()
+        self.view = None
+        self.x = self.y = self.size = None
@@ -0,0 +1,254 @@
+import ctypes
+import ctypes.util
+import os
+import queue
+import select
+import struct
+import sys
+import threading
+import time
+
+from PIL import Image
+
+import diskcache
+from encoding import IMAGE_EXTENSIONS
+from layers import LayerStack
+from render_core import cached_chat, render_frame
+
+# Screenshot folder watcher.
+# The game (or a Lua script in it) drops a screenshot into a folder every N
+# chat lines; each new file is keyed, cropped, outlined, put on the canvas and
+# spooled into the collage memory without anyone pressing a button.
+# FolderWatcher finds new files - inotify on Linux, polling a directory
+# listing anywhere else - and waits until a file has stopped changing and
+# decodes, so half-written screenshots are never read. Ready files go into a
+# bounded queue: when processing falls behind, the watcher thread blocks on
+# it (new files wait in the inotify queue or the next listing) instead of
+# piling up images in RAM. CaptureIngest processes the queue on its own
+# thread and hands finished frames to the Tk thread through a queue polled
+# with after(), a burst of captures never blocks the UI.
+
+POLL_MS = 100
+POLL_SECONDS = 0.5  # Directory listing interval without inotify
+SETTLE_SECONDS = 0.4  # A file must keep its size and mtime this long
+GIVE_UP_SECONDS = 30  # Unchanged this long and still not an image: not a screenshot
+QUEUE_SIZE = 4
+FRAMES_PER_POLL = 4  # Tk thread work per poll stays small in a burst
+
+IN_MODIFY = 0x002
+IN_CLOSE_WRITE = 0x008
+IN_MOVED_TO = 0x080
+IN_CREATE = 0x100
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+INOTIFY_EVENT = struct.Struct("iIII")  # wd, mask, cookie, name length
+
+
+def open_inotify(directory):
+    # Non-blocking inotify descriptor watching `directory`, None where it isn't available
+    if not sys.platform.startswith("linux"):
+        return None
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if fd < 0:
+            return None
+        mask = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_MODIFY
+        if libc.inotify_add_watch(fd, os.fsencode(directory), mask) < 0:
+            os.close(fd)
+            return None
+        return fd
+    except (OSError, AttributeError):
+        return None
+
+
+def read_inotify(fd):
+    # [(name, closed)] of the events waiting on fd; closed: the writer is done with the file
+    try:
+        data = os.read(fd, 64 * 1024)
+    except BlockingIOError:
+        return []
+    events = []
+    offset = 0
+    while offset + INOTIFY_EVENT.size <= len(data):
+        _, mask, _, length = INOTIFY_EVENT.unpack_from(data, offset)
+        offset += INOTIFY_EVENT.size
+        name = data[offset:offset + length].rstrip(b"\0")
+        offset += length
+        if name:
+            events.append((os.fsdecode(name), bool(mask & (IN_CLOSE_WRITE | IN_MOVED_TO))))
+    return events
+
+
+def is_complete(path):
+    # The image decodes up to its end (PNG checks every chunk's CRC)
+    try:
+        with Image.open(path) as img:
+            img.verify()
+        return True
+    except Exception:
+        return False
+
+
+class FolderWatcher:
+    def __init__(self, directory, ready, extensions=IMAGE_EXTENSIONS, settle=SETTLE_SECONDS, poll=POLL_SECONDS):
+        # ready: bounded queue.Queue that gets the paths of complete new images
+        self.directory = directory
+        self.ready = ready
+        self.extensions = extensions
+        self.settle = settle
+        self.poll = poll
+        self.stopped = threading.Event()
+        self.pending = {}  # name -> (size, mtime, since when unchanged, closed)
+        self.seen = set(self.listing())  # Files already there are not captures
+        self.fd = open_inotify(directory)
+        self.thread = threading.Thread(target=self._run, name="sosiska-watcher", daemon=True)
+
+    @property
+    def mode(self):
+        return "inotify" if self.fd is not None else "polling"
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+
+    def listing(self):
+        try:
+            return [entry.name for entry in os.scandir(self.directory)
+                    if entry.is_file() and entry.name.lower().endswith(self.extensions)]
+        except OSError:
+            return []
+
+    def _run(self):
+        try:
+            while not self.stopped.is_set():
+                if self.fd is not None:
+                    # Events for new files, or a timeout to look at the pending ones again
+                    select.select([self.fd], [], [], self.settle / 2 if self.pending else self.poll)
+                    for name, closed in read_inotify(self.fd):
+                        if name.lower().endswith(self.extensions) and name not in self.seen:
+                            self.touch(name, closed)
+                else:
+                    self.stopped.wait(min(self.poll, self.settle / 2) if self.pending else self.poll)
+                    for name in self.listing():
+                        if name not in self.seen and name not in self.pending:
+                            self.touch(name, False)
+                self.check_pending()
+        finally:
+            if self.fd is not None:
+                os.close(self.fd)
+
+    def touch(self, name, closed):
+        entry = self.pending.get(name)
+        self.pending[name] = (None, None, time.monotonic(), closed or bool(entry and entry[3]))
+
+    def check_pending(self):
+        now = time.monotonic()
+        for name, (size, mtime, since, closed) in list(self.pending.items()):
+            path = os.path.join(self.directory, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                del self.pending[name]  # Removed or renamed away meanwhile
+                continue
+            if (stat.st_size, stat.st_mtime_ns) != (size, mtime):
+                self.pending[name] = (stat.st_size, stat.st_mtime_ns, now, closed)
+                if not closed:
+                    continue
+            elif now - since < self.settle and not closed:
+                continue
+            if stat.st_size and is_complete(path):
+                del self.pending[name]
+                self.seen.add(name)
+                self.put(path)
+            elif closed:
+                self.pending[name] = (stat.st_size, stat.st_mtime_ns, now, False)  # Closed but broken, wait for more
+            elif now - since > GIVE_UP_SECONDS:
+                del self.pending[name]
+                self.seen.add(name)
+
+    def put(self, path):
+        # Blocks while the queue is full: that is the backpressure
+        while not self.stopped.is_set():
+            try:
+                self.ready.put(path, timeout=0.5)
+                return
+            except queue.Full:
+                pass
+
+
+class CaptureIngest:
+    # Watches a folder and turns every new screenshot into a spooled memory frame.
+    # settings: threshold, softness, outline radius/color/softness, canvas, chat_pos
+    # and layers - background and pinned chats the captured chat is put on
+    def __init__(self, master, directory, spool, settings, on_frame, on_error=None, cache=None):
+        self.master = master
+        self.spool = spool
+        self.settings = settings
+        self.on_frame = on_frame
+        self.on_error = on_error
+        self.cache = cache
+        self.ready = queue.Queue(maxsize=QUEUE_SIZE)
+        self.results = queue.Queue()
+        self.stack = LayerStack(settings["canvas"])  # Only the chat's place is redrawn per capture
+        self.watcher = FolderWatcher(directory, self.ready)
+        self.worker = threading.Thread(target=self._work, name="sosiska-ingest", daemon=True)
+        self.polling = False
+
+    def start(self):
+        self.watcher.start()
+        self.worker.start()
+        self.polling = True
+        self.master.after(POLL_MS, self._poll)
+
+    def stop(self):
+        self.watcher.stop()
+        try:
+            self.ready.put_nowait(None)  # Wakes the worker; with a full queue it sees `running` after the current file
+        except queue.Full:
+            pass
+
+    @property
+    def running(self):
+        return not self.watcher.stopped.is_set()
+
+    def process(self, path):
+        settings = self.settings
+        steps = ("auto", settings["threshold"], settings["softness"], True,
+                 settings["outline_radius"], settings["outline_color"], settings["outline_softness"])
+
+        def open_chat():
+            with Image.open(path) as img:
+                img.load()
+                return img
+        source = diskcache.file_source(path) if self.cache else None
+        chat = cached_chat(self.cache, source, open_chat, *steps)
+
+        frame, lines = render_frame(self.stack, settings["layers"], chat, settings["chat_pos"], settings["threshold"])
+        return self.spool.append(frame, lines)
+
+    def _work(self):
+        while True:
+            path = self.ready.get()
+            if path is None or not self.running:
+                break
+            try:
+                self.results.put((self.on_frame, (self.process(path), path)))
+            except Exception as e:
+                self.results.put((self.on_error, (path, e)))
+
+    def _poll(self):
+        for _ in range(FRAMES_PER_POLL):
+            try:
+                callback, args = self.results.get_nowait()
+            except queue.Empty:
+                break
+            if callback:
+                callback(*args)
+
+        if self.running or not self.results.empty():
+            self.master.after(POLL_MS, self._poll)
+        else:
+            self.polling = False